@@ -6,6 +6,8 @@ database_name = os.environ['DATABASE_NAME']
 video_table_name = os.environ['VIDEO_TABLE_NAME']
 entities_table_name = os.environ['ENTITIES_TABLE_NAME']
 content_table_name = os.environ['CONTENT_TABLE_NAME']
+content_hash_table_name = os.environ['CONTENT_HASH_TABLE_NAME']
+fingerprint_table_name = os.environ['FINGERPRINT_TABLE_NAME']
 secret_name = os.environ['SECRET_NAME']
 embedding_dimension = os.environ["EMBEDDING_DIMENSION"]
 writer_endpoint = os.environ['DB_WRITER_ENDPOINT']
@@ -20,6 +22,8 @@ class Database():
         self.video_table_name = video_table_name
         self.entities_table_name = entities_table_name 
         self.content_table_name = content_table_name 
+        self.content_hash_table_name = content_hash_table_name
+        self.fingerprint_table_name = fingerprint_table_name
         self.secret_name = secret_name
         self.embedding_dimension = embedding_dimension
         self.conn = None
@@ -70,6 +74,30 @@ class Database():
         # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
         cur.execute(f"CREATE TABLE {self.content_table_name} (id bigserial PRIMARY KEY NOT NULL, chunk text NOT NULL, chunk_embedding vector({str(embedding_dimension)}), video_name varchar(200) NOT NULL REFERENCES {self.video_table_name}(name));")
 
+        self.conn.commit()
+        cur.close()
+
+        self.setup_additional_tables()
+        return True
+
+    def setup_additional_tables(self):
+        # Tables added after the initial release. These statements are idempotent so that they can also run on stack update for existing deployments.
+        if self.conn is None:
+            self.connect_for_writing()
+
+        cur = self.conn.cursor()
+
+        # Create content hash registry table, which maps the content of an analyzed video file to the video whose analysis results can be reused for identical uploads
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {self.content_hash_table_name} (content_hash varchar(200) NOT NULL, content_size bigint NOT NULL, video_name varchar(200) NOT NULL REFERENCES {self.video_table_name}(name), PRIMARY KEY (content_hash, content_size));")
+
+        # Create video fingerprint table, which holds a perceptual hash per analyzed frame. Each 16-bit band of the hash is indexed to look up near-duplicate frames.
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {self.fingerprint_table_name} (video_name varchar(200) NOT NULL REFERENCES {self.video_table_name}(name), timestamp_millis integer NOT NULL, frame_hash bigint NOT NULL, hash_band_0 integer NOT NULL, hash_band_1 integer NOT NULL, hash_band_2 integer NOT NULL, hash_band_3 integer NOT NULL, PRIMARY KEY (video_name, timestamp_millis));")
+        for band_number in range(4):
+            # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {self.fingerprint_table_name}_hash_band_{band_number}_index ON {self.fingerprint_table_name} (hash_band_{band_number});")
+
         self.conn.commit()
         cur.close()
         return True
@@ -98,7 +126,12 @@ def on_create(event):
 
 def on_update(event):
     physical_id = event["PhysicalResourceId"]
-    print("no op")
+    try:
+        db = Database(writer=writer_endpoint, database_name = database_name, embedding_dimension = embedding_dimension)
+        db.setup_additional_tables()
+        db.close_connection()
+    except Exception as e:
+        print(e)
     #return {'PhysicalResourceId': physical_id}
     return {'PhysicalResourceId': "VectorDBDatabaseSetup"}
 
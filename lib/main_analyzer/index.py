@@ -1,14 +1,18 @@
-import os, time, json, copy, math, re, io
+import os, time, json, copy, math, re, shutil, tempfile, threading, mmap, bisect, subprocess, heapq, uuid, signal
+from collections import OrderedDict
+from datetime import datetime, timezone
 from abc import ABC, abstractmethod
 import boto3, botocore
 from botocore.config import Config
-from sqlalchemy import create_engine, Column, DateTime, String, Text, Integer, func, ForeignKey, update
+from sqlalchemy import create_engine, Column, DateTime, String, Text, Integer, BigInteger, func, ForeignKey, update, select, delete, or_, cast, column, values
+from sqlalchemy.dialects.postgresql import insert as db_insert, BIT
 from sqlalchemy.orm import mapped_column, sessionmaker,  declarative_base
 from pgvector.sqlalchemy import Vector
 from typing import Union, Self
 import cv2
+import numpy
+import ijson
 import base64
-from PIL import Image
 import concurrent.futures
 from multiprocessing import Pool
 import logging
@@ -18,12 +22,30 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %
 
 CONFIG_LABEL_DETECTION_ENABLED = "label_detection_enabled"
 CONFIG_TRANSCRIPTION_ENABLED = "transcription_enabled"
+CONFIG_SPEECH_DETECTION_ENABLED = "speech_detection_enabled"
+
+ANALYZER_MODE_FULL = "full" # Analyze the whole video in this task
+ANALYZER_MODE_SHARD = "shard" # Preprocess only one time shard of the video and store the partial result in S3
+ANALYZER_MODE_REDUCE = "reduce" # Merge the stored shard results and run the video analysis
+ANALYZER_MODE_WORKER = "worker" # Long-running process which pulls video jobs from a queue and runs them in any of the modes above
+SAMPLING_MODE_ALL = "all"
+SAMPLING_MODE_KEYFRAME = "keyframe"
+SAMPLING_MODE_REFINE = "refine" # Sample at a coarse interval first, then sample in between where the scene changes
+FRAME_KIND_SHARED = "shared" # Frame going to face detection, and possibly also to VQA
+FRAME_KIND_VQA = "vqa" # Frame going to VQA only
+FRAME_KIND_VQA_TEXT = "vqa_text" # Frame going to VQA only, where Rekognition detected text
+IMAGE_FORMAT_JPEG = "jpeg"
+IMAGE_FORMAT_WEBP = "webp"
 
 secrets_manager = boto3.client('secretsmanager')
 ssm = boto3.client('ssm')
+sqs = boto3.client('sqs')
+sfn = boto3.client('stepfunctions')
 
 model_id = os.environ["MODEL_ID"]
 vqa_model_id = os.environ["VQA_MODEL_ID"]
+vqa_fast_model_id = os.environ.get("VQA_FAST_MODEL_ID", "") # Model for frames repeating the previous frame. Empty to use VQA_MODEL_ID for all frames.
+vqa_novelty_threshold = float(os.environ.get("VQA_NOVELTY_THRESHOLD", "0.15")) # Frames with at least this novelty go to VQA_MODEL_ID
 frame_interval = os.environ['FRAME_INTERVAL']
 embedding_model_id = os.environ["EMBEDDING_MODEL_ID"]
 embedding_dimension = os.environ['EMBEDDING_DIMENSION']
@@ -34,22 +56,60 @@ transcription_folder = os.environ["TRANSCRIPTION_FOLDER"]
 entity_sentiment_folder = os.environ["ENTITY_SENTIMENT_FOLDER"]
 summary_folder = os.environ["SUMMARY_FOLDER"]
 video_caption_folder = os.environ["VIDEO_CAPTION_FOLDER"]
+analysis_shard_folder = os.environ.get("ANALYSIS_SHARD_FOLDER", "analysis_shards")
+run_report_folder = os.environ.get("RUN_REPORT_FOLDER", "run_reports")
+frame_analysis_folder = os.environ.get("FRAME_ANALYSIS_FOLDER", "frame_analysis")
 
 database_name = os.environ['DATABASE_NAME']
 video_table_name = os.environ['VIDEO_TABLE_NAME']
 entities_table_name = os.environ['ENTITIES_TABLE_NAME']
 content_table_name = os.environ['CONTENT_TABLE_NAME']
+content_hash_table_name = os.environ['CONTENT_HASH_TABLE_NAME']
+fingerprint_table_name = os.environ['FINGERPRINT_TABLE_NAME']
 secret_name = os.environ['SECRET_NAME']
 writer_endpoint = os.environ['DB_WRITER_ENDPOINT']
 
-video_s3_path = os.environ['VIDEO_S3_PATH'] 
-transcription_job_name = os.environ['TRANSCRIPTION_JOB_NAME']
-label_detection_job_id = os.environ['LABEL_DETECTION_JOB_ID']
-label_detection_enabled = True if os.environ[CONFIG_LABEL_DETECTION_ENABLED] == "1" else False
-transcription_enabled = True if os.environ[CONFIG_TRANSCRIPTION_ENABLED] == "1" else False
-
 ssm_parameter_name = os.environ['CONFIG_PARAMETER_NAME']
 
+# The per-video parameters (e.g. VIDEO_S3_PATH) are read by the handler from the job, which is either this process' environment variables or a message from the job queue in worker mode.
+analyzer_mode = os.environ.get('ANALYZER_MODE', ANALYZER_MODE_FULL)
+job_queue_url = os.environ.get('JOB_QUEUE_URL', "")
+worker_concurrency = int(os.environ.get('WORKER_CONCURRENCY', "2"))
+job_heartbeat_seconds = int(os.environ.get('JOB_HEARTBEAT_SECONDS', "60")) # How often a worker reports that a job is still in progress
+job_visibility_timeout_seconds = int(os.environ.get('JOB_VISIBILITY_TIMEOUT_SECONDS', "300")) # How long a job stays hidden from other workers after each heartbeat
+
+download_chunk_size = int(os.environ.get('DOWNLOAD_CHUNK_SIZE_MB', "8")) * 1024 * 1024
+download_concurrency = int(os.environ.get('DOWNLOAD_CONCURRENCY', "8"))
+sampling_mode = os.environ.get('SAMPLING_MODE', SAMPLING_MODE_ALL) # In keyframe mode, only the keyframes nearest to the requested timestamps are decoded
+keyframe_tolerance_millis = os.environ.get('KEYFRAME_TOLERANCE_MILLIS', "") # Defaults to the frame interval when empty
+refinement_coarse_interval_multiple = int(os.environ.get('REFINEMENT_COARSE_INTERVAL_MULTIPLE', "8")) # In refine sampling mode, the first pass samples at this multiple of the frame interval
+refinement_scene_distance = float(os.environ.get('REFINEMENT_SCENE_DISTANCE', "0.5")) # Word-level Jaccard distance between two scene descriptions above which the frames in between are sampled
+refinement_hash_distance = float(os.environ.get('REFINEMENT_HASH_DISTANCE', "0.25")) # Fraction of differing frame hash bits above which the frames in between are sampled
+frame_image_format = os.environ.get('FRAME_IMAGE_FORMAT', IMAGE_FORMAT_JPEG) # Format of the frames sent only to VQA. Frames sent to Rekognition are always JPEG, which it requires.
+frame_image_quality = int(os.environ.get('FRAME_IMAGE_QUALITY', "75"))
+frame_image_max_bytes = int(os.environ.get('FRAME_IMAGE_MAX_BYTES', "0")) # Per-frame byte budget, enforced by lowering the quality. 0 means no budget.
+frame_image_min_quality = 20
+frame_quality_filter_enabled = True if os.environ.get('FRAME_QUALITY_FILTER_ENABLED', "1") == "1" else False
+vqa_adaptive_resolution_enabled = True if os.environ.get('VQA_ADAPTIVE_RESOLUTION_ENABLED', "1") == "1" else False
+vqa_image_token_budget = int(os.environ.get('VQA_IMAGE_TOKEN_BUDGET', "0")) # Image input tokens for all VQA frames of a video. 0 means no budget.
+frame_budget_max_frames = int(os.environ.get('FRAME_BUDGET_MAX_FRAMES', "0")) # Maximum VQA frames per video, which the frame interval is sized to. 0 means no budget.
+frame_budget_target_seconds = int(os.environ.get('FRAME_BUDGET_TARGET_SECONDS', "0")) # Target time for the frame analysis of a video, which caps the VQA and face detection frames. 0 means no target.
+frame_budget_concurrency = int(os.environ.get('FRAME_BUDGET_CONCURRENCY', "8")) # Number of frames analyzed at the same time, as allowed by the model quotas
+analysis_deadline_seconds = int(os.environ.get('ANALYSIS_DEADLINE_SECONDS', "0")) # Time from the video upload by which the frame analysis stops, analyzing the most valuable frames first. 0 means no deadline.
+analysis_deadline_reserve_seconds = int(os.environ.get('ANALYSIS_DEADLINE_RESERVE_SECONDS', "120")) # Time kept before the deadline for the summary and the other video-level outputs
+label_aggregate_by = os.environ.get('LABEL_AGGREGATE_BY', "TIMESTAMPS") # "SEGMENTS" reads one entry per continuous appearance of a label instead of one per sampled frame
+person_segment_max_gap_millis = int(os.environ.get('PERSON_SEGMENT_MAX_GAP_MILLIS', "1000")) # Person detections closer than this belong to the same segment
+person_frame_min_interval_millis = int(os.environ.get('PERSON_FRAME_MIN_INTERVAL_MILLIS', "1000")) # Minimum time between the person frames picked within a segment, which caps the rate of face detection calls
+celebrity_mosaic_tiles = int(os.environ.get('CELEBRITY_MOSAIC_TILES', "4")) # Number of person frames tiled into one image per celebrity recognition call. 1 sends each frame on its own.
+face_tracking_enabled = True if os.environ.get('FACE_TRACKING_ENABLED', "1") == "1" else False
+utterance_max_pause_millis = int(os.environ.get('UTTERANCE_MAX_PAUSE_MILLIS', "1000")) # Transcribed words further apart than this start a new utterance
+timeline_similarity_threshold = float(os.environ.get('TIMELINE_SIMILARITY_THRESHOLD', "0.8")) # Word-level Jaccard similarity of consecutive scene or caption descriptions above which they are merged into one time range. 1 merges only identical ones.
+frame_store_memory_budget = int(os.environ.get('FRAME_STORE_MEMORY_MB', "256")) * 1024 * 1024
+
+fingerprint_enabled = True if os.environ.get('FINGERPRINT_ENABLED', "1") == "1" else False
+fingerprint_match_threshold = float(os.environ.get('FINGERPRINT_MATCH_THRESHOLD', "0.5")) # Minimum fraction of this video's frames matching a known video for its analysis to be reused
+fingerprint_max_hamming_distance = int(os.environ.get('FINGERPRINT_MAX_HAMMING_DISTANCE', "3")) # Maximum number of differing bits (out of 64) for two frame hashes to be considered the same frame, up to 3
+
 credentials = json.loads(secrets_manager.get_secret_value(SecretId=secret_name)["SecretString"])
 username = credentials["username"]
 password = credentials["password"]
@@ -58,25 +118,64 @@ engine = create_engine(f'postgresql://{username}:{password}@{writer_endpoint}:54
 Base = declarative_base()
 
 Session = sessionmaker(bind=engine)  
-session = Session()   
+
+# Codecs which FFmpeg can decode directly at 1/2, 1/4, or 1/8 of the resolution. H.264 and HEVC have no such mode and are downscaled after decoding.
+lowres_decode_fourccs: set[str] = {"mp4v", "xvid", "divx", "fmp4", "dx50", "mjpg", "mjpa", "mjpb", "jpeg", "mpg1", "mpg2", "h263"}
+
+def encode_frame(frame, image_format: str = IMAGE_FORMAT_JPEG, quality: int = frame_image_quality, max_bytes: int = frame_image_max_bytes) -> bytes:
+    # Encode straight from the BGR array OpenCV decodes into. The quality steps down until the image fits in the byte budget.
+    extension, quality_flag = (".webp", cv2.IMWRITE_WEBP_QUALITY) if image_format == IMAGE_FORMAT_WEBP else (".jpg", cv2.IMWRITE_JPEG_QUALITY)
+    while True:
+        success, buffer = cv2.imencode(extension, frame, [quality_flag, quality])
+        if not success: raise ValueError(f"Could not encode frame as {image_format}")
+        if max_bytes <= 0 or buffer.nbytes <= max_bytes or quality <= frame_image_min_quality:
+            return buffer.tobytes()
+        quality = max(frame_image_min_quality, quality - 10)
+
+def token_jaccard_similarity(text_a: str, text_b: str) -> float:
+    # Overlap of the lowercase word sets of two texts, from 0 for no common word to 1 for the same words
+    tokens_a = set(re.findall(r"\w+", text_a.lower()))
+    tokens_b = set(re.findall(r"\w+", text_b.lower()))
+    if len(tokens_a) == 0 and len(tokens_b) == 0: return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+def get_image_format(image: bytes) -> str:
+    # WebP files start with "RIFF", then the size, then "WEBP"
+    return IMAGE_FORMAT_WEBP if image[8:12] == b"WEBP" else IMAGE_FORMAT_JPEG
+
+# Frame decoding runs in worker processes. The pool is created once per process and reused across videos, so that worker mode does not pay for process startup per video.
+decode_pool: Pool = None
+
+def get_decode_pool() -> Pool:
+    global decode_pool
+    if decode_pool is None:
+        decode_pool = Pool(os.cpu_count())
+    return decode_pool
 
 class CelebrityFinding():
     celebrity_match_confidence_threshold: int = 97
     face_bounding_box_overlap_threshold: float = 0.1
     celebrity_emotion_confidence_threshold: int = 85
     celebrity_feature_confidence_threshold: int = 90
+    # One finding is created per detection, so the attributes are slots instead of a per-instance dict
+    __slots__ = ('name', 'match_confidence', 'top', 'left', 'height', 'width')
 
     def __init__(self, celebrity_dict: dict):
         self.name: str = celebrity_dict['Name']
         self.match_confidence: int = int(celebrity_dict['MatchConfidence'])
         self.top: float = float(celebrity_dict['Face']['BoundingBox']['Top'])
-        self.top_display: str = str(round(self.top, 2))
         self.left: float = float(celebrity_dict['Face']['BoundingBox']['Left'])
-        self.left_display: str = str(round(self.left, 2))
         self.height: float = float(celebrity_dict['Face']['BoundingBox']['Height'])
-        self.height_display: str = str(round(self.height, 2))
         self.width: float = float(celebrity_dict['Face']['BoundingBox']['Width'])
-        self.width_display: str = str(round(self.width, 2))
+
+    @property
+    def top_display(self) -> str: return str(round(self.top, 2))
+    @property
+    def left_display(self) -> str: return str(round(self.left, 2))
+    @property
+    def height_display(self) -> str: return str(round(self.height, 2))
+    @property
+    def width_display(self) -> str: return str(round(self.width, 2))
 
     def is_matching_face(self, bb_top:float , bb_left: float, bb_height: float, bb_width: float) -> bool:
         return (
@@ -86,6 +185,19 @@ class CelebrityFinding():
             (abs(self.width - bb_width) <= self.face_bounding_box_overlap_threshold)
         )
 
+    @staticmethod
+    def is_matching_any(celebrity_list: list[Self], bb_top:float , bb_left: float, bb_height: float, bb_width: float) -> bool:
+        # There are only a few celebrities per timestamp, so the loop stops at the first match
+        return any(celebrity_finding.is_matching_face(bb_top, bb_left, bb_height, bb_width) for celebrity_finding in celebrity_list)
+
+    def to_dict(self) -> dict:
+        # Same shape as the Rekognition celebrity dict, so that the finding can be reconstructed with the constructor.
+        return {
+            'Name': self.name,
+            'MatchConfidence': self.match_confidence,
+            'Face': {'BoundingBox': {'Top': self.top, 'Left': self.left, 'Height': self.height, 'Width': self.width}}
+        }
+
     def display(self) -> str:
         display_string = f"Name is {self.name}. "
         display_string += f"The celeb's face is located at {self.left_display} of frame's width from left and {self.top_display} of frame's height from top, with face height of {self.height_display} of frame's height and face width of {self.width_display} of the frame's width. "
@@ -97,19 +209,22 @@ class FaceFinding():
     face_feature_confidence_threshold: int = 97
     face_age_range_match_threshold: float = 3
     face_emotion_confidence_threshold: int = 85
+    # One finding is created per detection, so the attributes are slots instead of a per-instance dict
+    __slots__ = (
+        'confidence', 'age_low', 'age_high', 'top', 'left', 'height', 'width',
+        'beard', 'beard_confidence', 'eyeglasses', 'eyeglasses_confidence', 'eyesopen', 'eyesopen_confidence',
+        'sunglasses', 'sunglasses_confidence', 'mouthopen', 'mouthopen_confidence', 'mustache', 'mustache_confidence',
+        'gender', 'gender_confidence'
+    )
 
     def __init__(self, face_dict: dict):
         self.confidence: int = int(face_dict['Confidence'])
         self.age_low: int = int(face_dict['AgeRange']['Low'])
         self.age_high: int = int(face_dict['AgeRange']['High'])
         self.top: float = float(face_dict['BoundingBox']['Top'])
-        self.top_display: str = str(round(self.top, 2))
         self.left: float = float(face_dict['BoundingBox']['Left'])
-        self.left_display: str = str(round(self.left, 2))
         self.height: float = float(face_dict['BoundingBox']['Height'])
-        self.height_display: str = str(round(self.height, 2))
         self.width: float = float(face_dict['BoundingBox']['Width'])
-        self.width_display: str = str(round(self.width, 2))
         self.beard: bool = bool(face_dict['Beard']['Value'])
         self.beard_confidence: int = int(face_dict['Beard']['Confidence'])
         self.eyeglasses: bool = bool(face_dict['Eyeglasses']['Value'])
@@ -125,12 +240,36 @@ class FaceFinding():
         self.gender: str = str(face_dict['Gender']['Value']).lower()
         self.gender_confidence: int = int(face_dict['Gender']['Confidence'])
 
+    @property
+    def top_display(self) -> str: return str(round(self.top, 2))
+    @property
+    def left_display(self) -> str: return str(round(self.left, 2))
+    @property
+    def height_display(self) -> str: return str(round(self.height, 2))
+    @property
+    def width_display(self) -> str: return str(round(self.width, 2))
+
     def is_duplicate(self, face_list: list[Self]) -> bool:
-        found = False
-        face_finding: Self
-        for face_finding in face_list:
-            if (abs(self.age_low - face_finding.age_low) <= self.face_age_range_match_threshold) and (abs(self.age_high - face_finding.age_high) <= self.face_age_range_match_threshold): found = True
-        return found
+        # There are only a few faces per timestamp, so the loop stops at the first match
+        return any(
+            (abs(self.age_low - face_finding.age_low) <= self.face_age_range_match_threshold) and (abs(self.age_high - face_finding.age_high) <= self.face_age_range_match_threshold)
+            for face_finding in face_list
+        )
+
+    def to_dict(self) -> dict:
+        # Same shape as the Rekognition face detail dict, so that the finding can be reconstructed with the constructor.
+        return {
+            'Confidence': self.confidence,
+            'AgeRange': {'Low': self.age_low, 'High': self.age_high},
+            'BoundingBox': {'Top': self.top, 'Left': self.left, 'Height': self.height, 'Width': self.width},
+            'Beard': {'Value': self.beard, 'Confidence': self.beard_confidence},
+            'Eyeglasses': {'Value': self.eyeglasses, 'Confidence': self.eyeglasses_confidence},
+            'EyesOpen': {'Value': self.eyesopen, 'Confidence': self.eyesopen_confidence},
+            'Sunglasses': {'Value': self.sunglasses, 'Confidence': self.sunglasses_confidence},
+            'MouthOpen': {'Value': self.mouthopen, 'Confidence': self.mouthopen_confidence},
+            'Mustache': {'Value': self.mustache, 'Confidence': self.mustache_confidence},
+            'Gender': {'Value': self.gender, 'Confidence': self.gender_confidence}
+        }
 
     def display(self) -> str:
         display_string = f"The person is about {self.age_low} to {self.age_high} years old. "
@@ -155,18 +294,773 @@ class FaceFinding():
 class ObjectFinding():
     confidence_score_threshold: float = 80.0
     top_n_threshold: int = 10
+    __slots__ = ('label', 'confidence_score')
+
     def __init__(self, label: str, confidence_score: float):
         self.label: str = label
         self.confidence_score: float = confidence_score
+
+    def to_dict(self) -> dict:
+        return {'label': self.label, 'confidence_score': self.confidence_score}
     
     def display(self) -> str:
         return self.label
 
+class FrameQualityFilter():
+    min_mean_luminance: float = 16.0 # Darker frames without edges are treated as black, e.g. fades to black
+    max_mean_luminance: float = 240.0 # Brighter frames without edges are treated as blank white
+    min_luminance_variance: float = 40.0 # Frames with less variance are a solid color, e.g. slates and color transitions
+    min_sharpness: float = 20.0 # Variance of the Laplacian. Blurrier frames without edges are treated as motion blur.
+    min_edge_density: float = 0.01 # Fraction of pixels on an edge
+    edge_gradient_threshold: float = 32.0 # Minimum gradient magnitude for a pixel to be on an edge
+    max_simple_edge_density: float = 0.03 # Frames with fewer edges are simple scenes, which VQA reads well at a small size
+    min_detailed_edge_density: float = 0.12 # Frames with more edges are detailed scenes, which VQA gets at a larger size
+
+    @classmethod
+    def get_edge_density(cls, gray) -> float:
+        gradient_x = gray[:-1, 1:] - gray[:-1, :-1]
+        gradient_y = gray[1:, :-1] - gray[:-1, :-1]
+        return float((numpy.hypot(gradient_x, gradient_y) > cls.edge_gradient_threshold).mean())
+
+    @classmethod
+    def is_acceptable(cls, frame) -> bool:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(numpy.float32)
+        if gray.var() < cls.min_luminance_variance: return False
+
+        edge_density = cls.get_edge_density(gray)
+        # Frames with enough edges are kept even when dark or soft, e.g. white text on a black slate
+        if edge_density >= cls.min_edge_density: return True
+
+        mean_luminance = gray.mean()
+        if mean_luminance < cls.min_mean_luminance or mean_luminance > cls.max_mean_luminance: return False
+        laplacian = gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1]
+        return laplacian.var() >= cls.min_sharpness
+
+class FrameBudgetPlanner():
+    vqa_latency_millis: int = 3000 # Typical time of one VQA call
+    face_detection_latency_millis: int = 600 # Typical time of face detection and celebrity recognition of one frame
+    face_detection_time_share: float = 0.2 # Share of the target completion time for face detection. VQA gets the rest.
+    max_text_frame_share: float = 0.2 # Maximum share of the VQA frames which are extra frames at text detections
+    min_frame_interval: int = 250 # Millisecond
+
+    def __init__(self, max_frames: int, target_completion_seconds: int, concurrency: int):
+        self.max_frames: int = max_frames
+        self.target_completion_seconds: int = target_completion_seconds
+        self.concurrency: int = max(concurrency, 1)
+
+    def is_enabled(self) -> bool:
+        return self.max_frames > 0 or self.target_completion_seconds > 0
+
+    def plan(self, duration_millis: int, frame_interval: int) -> dict:
+        # Size the frame interval so that the regular frames, plus the capped text frames, fit the frame budget and the completion time target.
+        # Only an explicit frame budget makes the interval shorter than the configured one, e.g. for short clips. The completion time target only makes it longer.
+        max_vqa_frames = None
+        max_person_frames = None
+        if self.max_frames > 0:
+            max_vqa_frames = self.max_frames
+        if self.target_completion_seconds > 0:
+            target_millis = self.target_completion_seconds * 1000
+            frames_in_time = int(target_millis * (1 - self.face_detection_time_share) / self.vqa_latency_millis * self.concurrency)
+            max_vqa_frames = max(min(frames_in_time, max_vqa_frames if max_vqa_frames is not None else frames_in_time), 1)
+            max_person_frames = int(target_millis * self.face_detection_time_share / self.face_detection_latency_millis * self.concurrency)
+
+        interval = frame_interval
+        max_text_frames = None
+        if max_vqa_frames is not None:
+            max_text_frames = int(max_vqa_frames * self.max_text_frame_share)
+            max_regular_frames = max(max_vqa_frames - max_text_frames, 1)
+            interval = max(math.ceil(duration_millis / max_regular_frames), self.min_frame_interval)
+            if self.max_frames <= 0: interval = max(interval, frame_interval)
+
+        return {
+            "duration_millis": duration_millis,
+            "frame_interval_millis": interval,
+            "max_vqa_frames": max_vqa_frames,
+            "max_text_frames": max_text_frames,
+            "max_person_frames": max_person_frames
+        }
+
+    @staticmethod
+    def cap(timestamps_millis: list[int], max_count: Union[int, None]) -> list[int]:
+        # Keep evenly spread timestamps, so that the capped frames still cover the whole timeline
+        if max_count is None or len(timestamps_millis) <= max_count: return timestamps_millis
+        if max_count <= 0: return []
+        return [timestamps_millis[int(i * len(timestamps_millis) / max_count)] for i in range(max_count)]
+
+class FrameWorkScheduler():
+    # Runs frame work (VQA or face detection of one frame) in priority order on a thread pool.
+    # Work which would not finish before the deadline, by the average duration of the same kind of work so far, is skipped, so the least valuable frames are the ones dropped.
+    default_work_seconds: float = 3.0 # Estimated duration of work before any work of its kind has completed
+    novelty_weight: float = 1.0
+    text_weight: float = 1.0
+    person_weight: float = 0.5
+    coverage_weight: float = 1.0
+
+    def __init__(self, deadline: Union[float, None], max_workers: int):
+        self.deadline: Union[float, None] = deadline # In seconds since the epoch. None to run all work.
+        self.max_workers: int = max_workers
+        self.queue: list[tuple] = []
+        self.sequence: int = 0 # Keeps the order of work with the same priority
+        self.lock = threading.Lock()
+        self.work_seconds: dict[str, tuple[float, int]] = {} # Total duration and count of the completed work of each kind
+        self.completed: dict[str, list[int]] = {}
+        self.skipped: dict[str, list[int]] = {}
+
+    @classmethod
+    def get_priority(cls, novelty: float = 0.0, has_text: bool = False, has_person: bool = False, coverage: float = 0.0) -> float:
+        return cls.novelty_weight * novelty + (cls.text_weight if has_text else 0.0) + (cls.person_weight if has_person else 0.0) + cls.coverage_weight * coverage
+
+    @staticmethod
+    def get_coverage_priorities(timestamps_millis: list[int]) -> dict[int, float]:
+        # Coarse to fine: the first frame, then every other half, quarter, and so on of the frames get decreasing priority, so that frames analyzed before the deadline spread over the whole timeline
+        timestamps_millis = sorted(timestamps_millis)
+        max_level = max(len(timestamps_millis) - 1, 1).bit_length()
+        return {t: ((i & -i).bit_length() - 1 if i > 0 else max_level) / max_level for i, t in enumerate(timestamps_millis)}
+
+    def push(self, priority: float, kind: str, timestamp_millis: int, work, skip):
+        heapq.heappush(self.queue, (-priority, self.sequence, kind, timestamp_millis, work, skip))
+        self.sequence += 1
+
+    def estimate_seconds(self, kind: str) -> float:
+        total_seconds, count = self.work_seconds.get(kind, (0.0, 0))
+        return total_seconds / count if count > 0 else self.default_work_seconds
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if len(self.queue) == 0: return
+                _, _, kind, timestamp_millis, work, skip = heapq.heappop(self.queue)
+                in_time = self.deadline is None or time.time() + self.estimate_seconds(kind) <= self.deadline
+                if not in_time: self.skipped.setdefault(kind, []).append(timestamp_millis)
+            if not in_time:
+                skip(timestamp_millis)
+                continue
+
+            start_time = time.time()
+            try:
+                work(timestamp_millis)
+            except Exception as e:
+                logging.error(f"Error in {kind} work at timestamp {timestamp_millis}: {e}")
+            with self.lock:
+                total_seconds, count = self.work_seconds.get(kind, (0.0, 0))
+                self.work_seconds[kind] = (total_seconds + time.time() - start_time, count + 1)
+                self.completed.setdefault(kind, []).append(timestamp_millis)
+
+    def run(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for _ in range(self.max_workers):
+                executor.submit(self._work)
+
+class FaceTracker():
+    # Tracks faces across consecutive person frames with a local face detector, so that Rekognition is only called on the frames where a track starts, ends, becomes uncertain, or ages.
+    # The other frames take the findings of the last recognized frame, with the bounding boxes moved along the tracks.
+    min_iou: float = 0.3 # Minimum overlap of a face box with a box of the previous frame to continue its track
+    max_gap_millis: int = 2000 # Frames further apart than this do not continue each other's tracks
+    max_track_age_millis: int = 10000 # Tracks are recognized again after this long
+    min_face_size: float = 0.05 # Of the frame height. Smaller faces are not tracked.
+    thread_local = threading.local() # The face detector is not thread-safe, so each thread has its own
+
+    def __init__(self):
+        self.boxes: dict[int, list[tuple[float, float, float, float]]] = {} # Face boxes (left, top, width, height) of each frame, as fractions of the frame like Rekognition bounding boxes
+        self.track_ids: dict[int, list[int]] = {} # Track of each face box of each frame
+        self.anchors: dict[int, int] = {} # Recognized frame whose findings each frame takes
+        self.next_track_id: int = 0
+
+    @classmethod
+    def detect_face_boxes(cls, image: bytes) -> list[tuple[float, float, float, float]]:
+        if not hasattr(cls.thread_local, "face_detector"):
+            cls.thread_local.face_detector = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+        gray = cv2.imdecode(numpy.frombuffer(image, numpy.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None: return []
+        height, width = gray.shape
+        min_size = max(int(height * cls.min_face_size), 1)
+        boxes = cls.thread_local.face_detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
+        return [(x / width, y / height, w / width, h / height) for x, y, w, h in boxes]
+
+    @staticmethod
+    def get_iou(box_a: tuple[float, float, float, float], box_b: tuple[float, float, float, float]) -> float:
+        intersection_width = max(min(box_a[0] + box_a[2], box_b[0] + box_b[2]) - max(box_a[0], box_b[0]), 0)
+        intersection_height = max(min(box_a[1] + box_a[3], box_b[1] + box_b[3]) - max(box_a[1], box_b[1]), 0)
+        intersection = intersection_width * intersection_height
+        union = box_a[2] * box_a[3] + box_b[2] * box_b[3] - intersection
+        return intersection / union if union > 0 else 0.0
+
+    @classmethod
+    def match(cls, previous_boxes: list[tuple], boxes: list[tuple]) -> dict[int, int]:
+        # Greedy matching by overlap, from the index of a box to the index of the previous box it continues
+        pairs = sorted(((cls.get_iou(previous_box, box), i, j) for i, box in enumerate(boxes) for j, previous_box in enumerate(previous_boxes)), reverse=True)
+        matches: dict[int, int] = {}
+        for iou, i, j in pairs:
+            if iou < cls.min_iou: break
+            if i in matches or j in matches.values(): continue
+            matches[i] = j
+        return matches
+
+    def plan(self) -> list[int]:
+        # Returns the frames to recognize. A frame continues the tracks of the previous frame when all its boxes, and no more, continue a previous box.
+        # A person frame without any local face box is uncertain, as the local detector misses profile and small faces that Rekognition finds, so it is always recognized.
+        recognized_timestamps_millis: list[int] = []
+        previous_timestamp_millis = None
+        anchor_timestamp_millis = None
+        for timestamp_millis in sorted(self.boxes):
+            boxes = self.boxes[timestamp_millis]
+            continuous = False
+            if previous_timestamp_millis is not None and timestamp_millis - previous_timestamp_millis <= self.max_gap_millis:
+                previous_boxes = self.boxes[previous_timestamp_millis]
+                matches = self.match(previous_boxes, boxes)
+                continuous = len(boxes) > 0 and len(boxes) == len(previous_boxes) == len(matches)
+
+            if continuous:
+                self.track_ids[timestamp_millis] = [self.track_ids[previous_timestamp_millis][matches[i]] for i in range(len(boxes))]
+            else:
+                self.track_ids[timestamp_millis] = list(range(self.next_track_id, self.next_track_id + len(boxes)))
+                self.next_track_id += len(boxes)
+
+            if not continuous or timestamp_millis - anchor_timestamp_millis > self.max_track_age_millis:
+                anchor_timestamp_millis = timestamp_millis
+                recognized_timestamps_millis.append(timestamp_millis)
+            self.anchors[timestamp_millis] = anchor_timestamp_millis
+            previous_timestamp_millis = timestamp_millis
+        return recognized_timestamps_millis
+
+    def follow(self, anchor_timestamp_millis: int, timestamp_millis: int, bounding_box: dict) -> dict:
+        # Moves a Rekognition bounding box of the anchor frame along the track of the face box it overlaps most
+        anchor_boxes = self.boxes[anchor_timestamp_millis]
+        box = (bounding_box['Left'], bounding_box['Top'], bounding_box['Width'], bounding_box['Height'])
+        if len(anchor_boxes) == 0: return bounding_box
+        best_index = max(range(len(anchor_boxes)), key=lambda i: self.get_iou(anchor_boxes[i], box))
+        track_id = self.track_ids[anchor_timestamp_millis][best_index]
+        if self.get_iou(anchor_boxes[best_index], box) == 0 or track_id not in self.track_ids[timestamp_millis]: return bounding_box
+        left, top, width, height = self.boxes[timestamp_millis][self.track_ids[timestamp_millis].index(track_id)]
+        return {'Left': left, 'Top': top, 'Width': width, 'Height': height}
+
+class CelebrityMosaic():
+    # Tiles several person frames into one image, so that one celebrity recognition call covers all of them. The bounding boxes found in the mosaic are mapped back to their tile.
+    min_face_height: float = 0.15 # Of the tile height. Frames with smaller faces are recognized on their own, as the mosaic may miss such faces.
+    tile_border_tolerance: float = 0.01 # Of the tile size. A face box crossing its tile border by more than this spans two frames.
+
+    def __init__(self, images: list[bytes], tile_dim: tuple[int, int]):
+        self.tile_count: int = len(images)
+        self.columns: int = math.ceil(math.sqrt(self.tile_count))
+        self.rows: int = math.ceil(self.tile_count / self.columns)
+        width, height = tile_dim
+        mosaic = numpy.zeros((self.rows * height, self.columns * width, 3), dtype=numpy.uint8)
+        for i, image in enumerate(images):
+            frame = cv2.imdecode(numpy.frombuffer(image, numpy.uint8), cv2.IMREAD_COLOR)
+            if frame is None: continue
+            row, column = divmod(i, self.columns)
+            mosaic[row * height:(row + 1) * height, column * width:(column + 1) * width] = cv2.resize(frame, tile_dim, interpolation = cv2.INTER_AREA)
+        self.image: bytes = encode_frame(mosaic, IMAGE_FORMAT_JPEG)
+
+    def to_tile(self, bounding_box: dict) -> tuple[Union[int, None], dict]:
+        # Returns the tile of a mosaic bounding box and the box relative to that tile, or None as the tile when the box crosses a tile border
+        left, top = bounding_box['Left'] * self.columns, bounding_box['Top'] * self.rows
+        width, height = bounding_box['Width'] * self.columns, bounding_box['Height'] * self.rows
+        column, row = min(int(left + width / 2), self.columns - 1), min(int(top + height / 2), self.rows - 1)
+        tile_box = {'Left': left - column, 'Top': top - row, 'Width': width, 'Height': height}
+        if (tile_box['Left'] < -self.tile_border_tolerance or tile_box['Top'] < -self.tile_border_tolerance or
+            tile_box['Left'] + width > 1 + self.tile_border_tolerance or tile_box['Top'] + height > 1 + self.tile_border_tolerance):
+            return None, tile_box
+        tile = row * self.columns + column
+        return (tile if tile < self.tile_count else None), tile_box
+
+    def split(self, recognize_celebrity_response: dict) -> list[Union[tuple[list[dict], list[dict]], None]]:
+        # Celebrities and unrecognized faces of each tile, with tile-relative bounding boxes. A tile is None when its faces need a call on the frame on its own.
+        tiles: list = [([], []) for _ in range(self.tile_count)]
+        faces = [(0, f, f['Face']) for f in recognize_celebrity_response["CelebrityFaces"]] + [(1, f, f) for f in recognize_celebrity_response["UnrecognizedFaces"]]
+        for kind, finding, face in faces:
+            tile, tile_box = self.to_tile(face['BoundingBox'])
+            if tile is None:
+                # A face across two tiles may belong to either frame, so both are recognized on their own
+                tiles = [None if self.overlaps_tile(face['BoundingBox'], i) else tiles[i] for i in range(self.tile_count)]
+                continue
+            if tiles[tile] is None: continue
+            if tile_box['Height'] < self.min_face_height:
+                tiles[tile] = None
+                continue
+            face = {**face, 'BoundingBox': tile_box}
+            tiles[tile][kind].append({**finding, 'Face': face} if kind == 0 else face)
+        return tiles
+
+    def overlaps_tile(self, bounding_box: dict, tile: int) -> bool:
+        row, column = divmod(tile, self.columns)
+        left, top = bounding_box['Left'] * self.columns, bounding_box['Top'] * self.rows
+        right, bottom = left + bounding_box['Width'] * self.columns, top + bounding_box['Height'] * self.rows
+        return left < column + 1 and right > column and top < row + 1 and bottom > row
+
+class VideoFingerprint():
+    match_threshold: float = fingerprint_match_threshold
+    number_of_bands: int = 4 # The 64-bit frame hash is split into bands of 16 bits, each looked up by index. Two hashes differing in fewer bits than the number of bands share at least one band.
+    band_bits: int = 16
+    max_hamming_distance: int = min(fingerprint_max_hamming_distance, number_of_bands - 1) # Larger distances could not be found through the bands
+    lookup_batch_size: int = 500 # Frames looked up per database query
+
+    @staticmethod
+    def compute_frame_hash(frame) -> int:
+        # Difference hash of a 9x8 grayscale thumbnail. It compares adjacent pixels' brightness, so it survives re-encoding, resizing, and small color changes.
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+        frame_hash = 0
+        for bit in (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten():
+            frame_hash = (frame_hash << 1) | int(bit)
+        return frame_hash
+
+    @staticmethod
+    def is_informative(frame_hash: int) -> bool:
+        # Flat frames such as black or solid color frames hash to all zeros or all ones, and would match any other flat frame
+        return frame_hash not in (0, (1 << 64) - 1)
+
+    @classmethod
+    def get_bands(cls, frame_hash: int) -> list[int]:
+        band_mask = (1 << cls.band_bits) - 1
+        return [(frame_hash >> (band_number * cls.band_bits)) & band_mask for band_number in range(cls.number_of_bands)]
+
+    @staticmethod
+    def to_signed(frame_hash: int) -> int:
+        # The database stores the hash as a signed 64-bit integer
+        return frame_hash - (1 << 64) if frame_hash >= (1 << 63) else frame_hash
+
+    @staticmethod
+    def to_unsigned(frame_hash: int) -> int:
+        return frame_hash + (1 << 64) if frame_hash < 0 else frame_hash
+
+    @classmethod
+    def find_best_match(cls, frame_hashes: dict[int, int], candidates: list[tuple[str, int, int]], frame_interval: int) -> Union[tuple[str, int, list[int]], None]:
+        # Every pair of matching frames votes for a (video, time offset) alignment. The alignment with most matching frames wins, which also handles trimmed videos.
+        frames_by_band: dict[tuple[int, int], list[tuple[int, int]]] = {}
+        for timestamp_millis, frame_hash in frame_hashes.items():
+            for band_number, band in enumerate(cls.get_bands(frame_hash)):
+                frames_by_band.setdefault((band_number, band), []).append((timestamp_millis, frame_hash))
+
+        votes: dict[tuple[str, int], set[int]] = {}
+        for video_name, candidate_timestamp_millis, candidate_hash in candidates:
+            for band_number, band in enumerate(cls.get_bands(candidate_hash)):
+                for timestamp_millis, frame_hash in frames_by_band.get((band_number, band), []):
+                    if (frame_hash ^ candidate_hash).bit_count() > cls.max_hamming_distance: continue
+                    offset_millis = round((timestamp_millis - candidate_timestamp_millis) / frame_interval) * frame_interval
+                    votes.setdefault((video_name, offset_millis), set()).add(timestamp_millis)
+
+        if len(votes) == 0: return None
+        (video_name, offset_millis), matched_timestamps_millis = max(votes.items(), key=lambda vote: len(vote[1]))
+        if len(matched_timestamps_millis) < cls.match_threshold * len(frame_hashes): return None
+        return video_name, offset_millis, sorted(matched_timestamps_millis)
+
+    @staticmethod
+    def get_matched_ranges(matched_timestamps_millis: list[int], frame_interval: int) -> list[tuple[int, int]]:
+        # Merge the matched frames into time ranges, bridging single unmatched frames in between
+        ranges: list[list[int]] = []
+        for timestamp_millis in matched_timestamps_millis:
+            if len(ranges) > 0 and timestamp_millis - ranges[-1][1] <= 2 * frame_interval:
+                ranges[-1][1] = timestamp_millis
+            else:
+                ranges.append([timestamp_millis, timestamp_millis])
+        return [(start - frame_interval // 2, stop + frame_interval // 2) for start, stop in ranges]
+
+class SpeechDetector():
+    # Finds the segments of the audio track with speech from the RMS energy of short frames, so that videos without speech are not transcribed.
+    # Speech alternates syllables with short pauses, so a window counts as speech when it is loud enough and enough of its frames are much quieter than its mean. Music and steady noise rarely are.
+    sample_rate: int = 16000
+    frame_millis: int = 20
+    window_millis: int = 1000
+    min_speech_dbfs: float = -45.0 # Windows quieter than this are silence
+    min_snr_db: float = 10.0 # Windows must also be this much louder than the noise floor of the track
+    noise_floor_percentile: float = 10.0
+    min_low_energy_ratio: float = 0.15 # Fraction of the frames of a window below half of its mean RMS
+    max_gap_millis: int = 1000 # Speech windows closer than this belong to the same segment
+    min_speech_millis: int = 2000 # Total speech below this is treated as no speech
+
+    @classmethod
+    def has_audio(cls, filename: str) -> bool:
+        streams = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a", "-show_entries", "stream=index", "-of", "csv=p=0", filename],
+            capture_output=True, text=True, check=True
+        ).stdout
+        return streams.strip() != ""
+
+    @classmethod
+    def get_frame_rms(cls, filename: str) -> numpy.ndarray:
+        # Decode the first audio track as 16 kHz mono in the voice band, and reduce each block to the RMS of its frames as it is read, so that the memory does not grow with the decoded audio
+        frame_samples = cls.sample_rate * cls.frame_millis // 1000
+        block_bytes = frame_samples * 2 * 500
+        decoder = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-i", filename, "-map", "0:a:0", "-vn", "-ac", "1", "-ar", str(cls.sample_rate),
+             "-af", "highpass=f=300,lowpass=f=3400", "-f", "s16le", "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        frame_rms: list[numpy.ndarray] = []
+        try:
+            while True:
+                block = decoder.stdout.read(block_bytes)
+                if len(block) == 0: break
+                samples = numpy.frombuffer(block[:len(block) - len(block) % (frame_samples * 2)], numpy.int16).astype(numpy.float32) / 32768
+                frame_rms.append(numpy.sqrt(numpy.mean(samples.reshape(-1, frame_samples) ** 2, axis=1)))
+        finally:
+            decoder.stdout.close()
+            return_code = decoder.wait()
+        if return_code != 0: raise subprocess.CalledProcessError(return_code, "ffmpeg")
+        return numpy.concatenate(frame_rms) if len(frame_rms) > 0 else numpy.zeros(0, numpy.float32)
+
+    @classmethod
+    def get_speech_segments(cls, frame_rms: numpy.ndarray) -> list[tuple[int, int]]:
+        frames_per_window = cls.window_millis // cls.frame_millis
+        window_count = len(frame_rms) // frames_per_window
+        if window_count == 0: return []
+        windows = frame_rms[:window_count * frames_per_window].reshape(window_count, frames_per_window)
+        window_rms = windows.mean(axis=1)
+        window_dbfs = 20 * numpy.log10(window_rms + 1e-10)
+        noise_floor_dbfs = numpy.percentile(20 * numpy.log10(frame_rms + 1e-10), cls.noise_floor_percentile)
+        low_energy_ratio = (windows < 0.5 * window_rms[:, None]).mean(axis=1)
+        is_speech = (window_dbfs >= max(cls.min_speech_dbfs, noise_floor_dbfs + cls.min_snr_db)) & (low_energy_ratio >= cls.min_low_energy_ratio)
+
+        segments: list[list[int]] = []
+        for window_index in numpy.flatnonzero(is_speech):
+            start_millis = int(window_index) * cls.window_millis
+            if len(segments) > 0 and start_millis - segments[-1][1] <= cls.max_gap_millis:
+                segments[-1][1] = start_millis + cls.window_millis
+            else:
+                segments.append([start_millis, start_millis + cls.window_millis])
+        return [(start, stop) for start, stop in segments]
+
+    @classmethod
+    def detect(cls, filename: str) -> list[tuple[int, int]]:
+        if not cls.has_audio(filename): return []
+        return cls.get_speech_segments(cls.get_frame_rms(filename))
+
+    @classmethod
+    def has_speech(cls, segments: list[tuple[int, int]]) -> bool:
+        return sum(stop - start for start, stop in segments) >= cls.min_speech_millis
+
+class FrameDecoder():
+    # Decodes runs of frames in the decoding processes. It holds only what decoding needs, so that little is pickled to the processes for each run.
+    def __init__(self,
+        filename: str,
+        decode_lowres: int,
+        frame_dim_for_vqa: tuple[int, int],
+        vqa_frame_dims: dict[str, tuple[int, int]],
+        frame_interval_tolerance: int,
+        keyframe_timestamps_millis: list[int],
+        strict: bool = False):
+
+        self.filename: str = filename
+        self.decode_lowres: int = decode_lowres
+        self.frame_dim_for_vqa: tuple[int, int] = frame_dim_for_vqa
+        self.vqa_frame_dims: dict[str, tuple[int, int]] = vqa_frame_dims
+        self.frame_interval_tolerance: int = frame_interval_tolerance
+        self.keyframe_timestamps_millis: list[int] = keyframe_timestamps_millis # Only the keyframes within the timestamps to decode
+        self.strict: bool = strict # While the file is still downloading, frames decoded with any FFmpeg error are failed, so that they are retried on the complete file
+
+    def load_video(self) -> cv2.VideoCapture:
+        video: cv2.VideoCapture = cv2.VideoCapture(self.filename)
+        return video
+
+    def get_lowres_options(self) -> list[str]:
+        # With lowres, the decoder outputs frames already reduced by a power of two. OpenCV does not pass this option to the decoder, so only the FFmpeg CLI decodes at low resolution.
+        return ["-lowres", str(self.decode_lowres)] if self.decode_lowres > 0 else []
+
+    @staticmethod
+    def downscale_frame(frame, dim: tuple[int, int]):
+        # Reduce by the largest integer factor first, which OpenCV does with a cheap box filter when the size divides evenly, then resize the small intermediate frame to the target size.
+        height, width = frame.shape[:2]
+        factor = min(width // dim[0], height // dim[1])
+        if factor >= 2:
+            frame = cv2.resize(frame[:height - height % factor, :width - width % factor], (width // factor, height // factor), interpolation = cv2.INTER_AREA)
+        return cv2.resize(frame, dim, interpolation = cv2.INTER_AREA)
+
+    def decode(self, run: list[tuple[int, str]]) -> list:
+        # The run lists the timestamps along with the kind of each frame, which decides its size, image format, and filtering
+        frame_kinds: dict[int, str] = dict(run)
+        timestamps_millis: list[int] = [t for t, _ in run]
+        frames: dict[int, list] = {}
+        if len(self.keyframe_timestamps_millis) > 0:
+            keyframes = set(self.keyframe_timestamps_millis)
+            keyframe_run = [t for t in timestamps_millis if t in keyframes]
+            if len(keyframe_run) > 0: frames.update(self._extract_keyframes(keyframe_run, frame_kinds))
+
+        remaining_timestamps_millis = [t for t in timestamps_millis if t not in frames]
+        if self.decode_lowres > 0 and len(remaining_timestamps_millis) > 0:
+            frames.update(self._extract_lowres_frames(remaining_timestamps_millis, frame_kinds))
+
+        # The video is opened once for a run of nearby timestamps, instead of once per frame
+        remaining_timestamps_millis = [t for t in timestamps_millis if t not in frames]
+        if len(remaining_timestamps_millis) > 0:
+            video = self.load_video()
+            for timestamp_millis in remaining_timestamps_millis:
+                frames[timestamp_millis] = self._extract_frame(timestamp_millis, video, frame_kinds[timestamp_millis])
+            video.release()
+        return [frames[t] for t in timestamps_millis]
+
+    def _extract_keyframes(self, timestamps_millis: list[int], frame_kinds: dict[int, str]) -> dict[int, list]:
+        # Decode only the keyframes between the first and last timestamps with FFmpeg, which skips all other frames without decoding them
+        first = bisect.bisect_left(self.keyframe_timestamps_millis, timestamps_millis[0])
+        last = bisect.bisect_right(self.keyframe_timestamps_millis, timestamps_millis[-1])
+        window_keyframes_millis = self.keyframe_timestamps_millis[first:last]
+        # Scale to the largest size needed in this run, and resize each frame to its own size afterwards
+        width = max(self.get_frame_dim(frame_kinds[t])[0] for t in timestamps_millis)
+        height = max(self.get_frame_dim(frame_kinds[t])[1] for t in timestamps_millis)
+        decoded_frames, damaged = self._decode_with_ffmpeg(
+            ["-skip_frame", "nokey", *self.get_lowres_options(), "-ss", f"{timestamps_millis[0]/1000:.3f}"],
+            ["-t", f"{(timestamps_millis[-1] - timestamps_millis[0])/1000 + 0.0015:.4f}", "-vf", f"scale={width}:{height}:flags=area"],
+            (width, height)
+        )
+        if damaged: return {t: None for t in timestamps_millis}
+
+        # The output frames map to the keyframes in order. If the count differs, fall back to decoding these frames exactly.
+        if decoded_frames is None or len(decoded_frames) != len(window_keyframes_millis): return {}
+        wanted = set(timestamps_millis)
+        frames: dict[int, list] = {}
+        for keyframe_millis, frame in zip(window_keyframes_millis, decoded_frames):
+            if keyframe_millis not in wanted: continue
+            logging.info(f"Extracting keyframe at timestamp: {keyframe_millis}")
+            frames[keyframe_millis] = self._process_frame(keyframe_millis, frame, frame_kinds[keyframe_millis])
+        return frames
+
+    def _extract_lowres_frames(self, timestamps_millis: list[int], frame_kinds: dict[int, str]) -> dict[int, list]:
+        # Decode the run at reduced resolution with FFmpeg, selecting the first frame at or after each timestamp like a seek does.
+        # Frames rejected by the quality filter are left out, so that the nearby frames are tried at full resolution.
+        width = max(self.get_frame_dim(frame_kinds[t])[0] for t in timestamps_millis)
+        height = max(self.get_frame_dim(frame_kinds[t])[1] for t in timestamps_millis)
+        # After the input seek, the frame times start from 0 at the first timestamp
+        relative_seconds = [(t - timestamps_millis[0]) / 1000 - 0.0005 for t in timestamps_millis]
+        select_expression = "+".join(f"gte(t,{s:.4f})*not(gte(prev_selected_t,{s:.4f}))" for s in relative_seconds)
+        decoded_frames, damaged = self._decode_with_ffmpeg(
+            [*self.get_lowres_options(), "-ss", f"{timestamps_millis[0]/1000:.3f}"],
+            ["-t", f"{(timestamps_millis[-1] - timestamps_millis[0])/1000 + 1:.4f}", "-vf", f"select='{select_expression}',scale={width}:{height}:flags=area"],
+            (width, height)
+        )
+        if damaged: return {t: None for t in timestamps_millis}
+
+        # The output frames map to the timestamps in order. If the count differs, fall back to decoding these frames with OpenCV.
+        if decoded_frames is None or len(decoded_frames) != len(timestamps_millis): return {}
+        frames: dict[int, list] = {}
+        for timestamp_millis, frame in zip(timestamps_millis, decoded_frames):
+            logging.info(f"Extracting frame at timestamp: {timestamp_millis}")
+            extracted_frame = self._process_frame(timestamp_millis, frame, frame_kinds[timestamp_millis])
+            if extracted_frame is not None and extracted_frame[1] is None: continue
+            frames[timestamp_millis] = extracted_frame
+        return frames
+
+    def _decode_with_ffmpeg(self, input_options: list[str], output_options: list[str], dim: tuple[int, int]) -> tuple[Union[list, None], bool]:
+        # Decodes the video stream with the FFmpeg CLI into raw BGR frames of the given size. Returns no frames when FFmpeg fails, along with whether the output is damaged.
+        width, height = dim
+        try:
+            result = subprocess.run(
+                ["ffmpeg", "-v", "error", *input_options, "-i", self.filename, *output_options,
+                 "-map", "0:v:0", "-fps_mode", "passthrough", "-pix_fmt", "bgr24", "-f", "rawvideo", "-"],
+                capture_output=True, check=True
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None, False
+        # FFmpeg conceals damaged data and still outputs a frame, so any reported error fails these frames while the file may have missing ranges
+        if self.strict and len(result.stderr.strip()) > 0: return None, True
+
+        frame_size = width * height * 3
+        if len(result.stdout) % frame_size != 0: return None, False
+        return [numpy.frombuffer(result.stdout, dtype=numpy.uint8, count=frame_size, offset=i * frame_size).reshape((height, width, 3)) for i in range(len(result.stdout) // frame_size)], False
+
+    def _extract_frame(self, timestamp_millis, video: cv2.VideoCapture, frame_kind: str = FRAME_KIND_SHARED):
+        logging.info(f"Extracting frame at timestamp: {timestamp_millis}")
+        # When the frame has no usable content, try the nearby frames within the tolerance, which are considered the same frame in the timeline
+        offsets_millis = [0]
+        if frame_kind != FRAME_KIND_SHARED and frame_quality_filter_enabled:
+            offsets_millis += [self.frame_interval_tolerance // 2, -(self.frame_interval_tolerance // 2), self.frame_interval_tolerance, -self.frame_interval_tolerance]
+        for offset_millis in offsets_millis:
+            if timestamp_millis + offset_millis < 0: continue
+            video.set(cv2.CAP_PROP_POS_MSEC, int(timestamp_millis + offset_millis))
+            success, frame = video.read()
+            if not success:
+                if offset_millis == 0: return None
+                continue
+            extracted_frame = self._process_frame(timestamp_millis, frame, frame_kind)
+            if extracted_frame is None or extracted_frame[1] is not None: return extracted_frame
+        return [timestamp_millis, None, 0, None]
+
+    def get_frame_dim(self, frame_kind: str) -> tuple[int, int]:
+        # Frames going to VQA only are first resized to the largest size they may get
+        if frame_kind == FRAME_KIND_VQA_TEXT: return self.vqa_frame_dims["text"]
+        if frame_kind == FRAME_KIND_VQA: return self.vqa_frame_dims["detailed"]
+        return self.frame_dim_for_vqa
+
+    def _process_frame(self, timestamp_millis, frame, frame_kind: str = FRAME_KIND_SHARED):
+        # Resize frame to 512 x 512 px, or to the size of its kind for frames going to VQA only
+        # This may fail if the frame is empty. Just skip the frame if so.
+        try:
+            frame = self.downscale_frame(frame, self.get_frame_dim(frame_kind))
+        except:
+            return None
+
+        # Frames rejected by the quality filter come back without an image. The filter only applies to frames going to VQA only.
+        if frame_kind != FRAME_KIND_SHARED and frame_quality_filter_enabled and not FrameQualityFilter.is_acceptable(frame):
+            return [timestamp_millis, None, 0, None]
+
+        # Frames with less detail need less resolution
+        if frame_kind == FRAME_KIND_VQA:
+            edge_density = FrameQualityFilter.get_edge_density(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(numpy.float32))
+            if edge_density < FrameQualityFilter.min_detailed_edge_density:
+                dim = self.vqa_frame_dims["simple"] if edge_density < FrameQualityFilter.max_simple_edge_density else self.vqa_frame_dims["regular"]
+                if dim != self.vqa_frame_dims["detailed"]: frame = cv2.resize(frame, dim, interpolation = cv2.INTER_AREA)
+
+        # Frames going to face detection are JPEG, as required by Rekognition
+        image = encode_frame(frame, IMAGE_FORMAT_JPEG if frame_kind == FRAME_KIND_SHARED else frame_image_format)
+        frame_hash = VideoFingerprint.compute_frame_hash(frame)
+        # Hue and saturation histogram, which tells color changes between frames apart from structure changes
+        histogram = cv2.calcHist([cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)], [0, 1], None, [8, 4], [0, 180, 0, 256]).flatten()
+        return [timestamp_millis, image, frame_hash, (histogram / max(float(histogram.sum()), 1.0)).tolist()]
+
+class VideoDownload():
+    # Downloads an S3 object with parallel ranged GETs into a sparse local file, so that frames can be decoded from the byte ranges already written while the rest is still downloading.
+    def __init__(self, s3_client, bucket_name: str, key: str, filename: str, chunk_size: int = download_chunk_size, concurrency: int = download_concurrency):
+        self.s3_client = s3_client
+        self.bucket_name: str = bucket_name
+        self.key: str = key
+        self.filename: str = filename
+        self.chunk_size: int = chunk_size
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        self.size: int = head["ContentLength"]
+        self.last_modified: datetime = head["LastModified"] # Upload time of the video
+        self.chunk_count: int = math.ceil(self.size / chunk_size)
+        self.completed_chunks: set[int] = set()
+        self.error: Exception = None
+        self.cancelled: bool = False
+        self.condition = threading.Condition()
+
+        # Size the file up front without writing to it, so that the chunks can be written at their offsets in any order
+        with open(filename, 'wb') as f:
+            f.truncate(self.size)
+        self.fd: int = os.open(filename, os.O_WRONLY)
+
+        # The first and last chunks hold the container header (e.g. the moov atom of MP4 and MOV, which may be at either end) and are fetched first. The rest follow in playback order.
+        chunk_order: list[int] = list(range(self.chunk_count))
+        if self.chunk_count > 1: chunk_order.insert(1, chunk_order.pop())
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        for chunk_index in chunk_order:
+            self.executor.submit(self._download_chunk, chunk_index)
+
+    def _download_chunk(self, chunk_index: int):
+        if self.cancelled: return
+        start = chunk_index * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        try:
+            body: bytes = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key, Range=f"bytes={start}-{end}")["Body"].read()
+            os.pwrite(self.fd, body, start)
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            return
+
+        with self.condition:
+            self.completed_chunks.add(chunk_index)
+            if len(self.completed_chunks) == self.chunk_count: self._close_file()
+            self.condition.notify_all()
+
+    def _close_file(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait_for_bytes(self, stop_offset: int):
+        # Waits until the bytes before stop_offset, as well as the last chunk holding the trailing container header, are written
+        required_chunks: set[int] = set(range(min(math.ceil(stop_offset / self.chunk_size), self.chunk_count)))
+        if self.chunk_count > 0: required_chunks.add(self.chunk_count - 1)
+        with self.condition:
+            self.condition.wait_for(lambda: self.error is not None or required_chunks <= self.completed_chunks)
+            if self.error is not None: raise self.error
+
+    def wait_for_all(self):
+        self.wait_for_bytes(self.size)
+
+    def is_complete(self) -> bool:
+        with self.condition:
+            return len(self.completed_chunks) == self.chunk_count
+
+    def cancel(self):
+        self.cancelled = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.condition:
+            self._close_file()
+
+class FrameStore():
+    # Holds the extracted frames within a memory budget. The oldest frames beyond the budget are spilled to a memory-mapped file on local disk, and each frame is dropped once all its consumers have released it.
+    consumer_vqa: str = "vqa"
+    consumer_faces: str = "faces"
+    spill_growth_bytes: int = 16 * 1024 * 1024
+
+    def __init__(self, memory_budget: int = frame_store_memory_budget):
+        self.memory_budget: int = memory_budget
+        self.memory_frames: OrderedDict[int, bytes] = OrderedDict()
+        self.memory_size: int = 0
+        self.spilled_frames: dict[int, tuple[int, int]] = {} # Offset and length in the spill file by timestamp
+        self.consumers: dict[int, set[str]] = {}
+        self.lock = threading.Lock()
+        self.spill_directory: str = ""
+        self.spill_file = None
+        self.spill_map: mmap.mmap = None
+        self.spill_capacity: int = 0
+        self.spill_size: int = 0
+
+    def _spill(self, timestamp_millis: int, image: bytes):
+        if self.spill_file is None:
+            self.spill_directory = tempfile.mkdtemp()
+            self.spill_file = open(os.path.join(self.spill_directory, "frames"), "w+b")
+        if self.spill_size + len(image) > self.spill_capacity:
+            # Grow the file and map it again. Readers holding the previous map keep a valid view of the bytes already written.
+            self.spill_capacity = max(2 * self.spill_capacity, self.spill_size + len(image), self.spill_growth_bytes)
+            self.spill_file.truncate(self.spill_capacity)
+            self.spill_map = mmap.mmap(self.spill_file.fileno(), self.spill_capacity)
+        self.spill_map[self.spill_size:self.spill_size + len(image)] = image
+        self.spilled_frames[timestamp_millis] = (self.spill_size, len(image))
+        self.spill_size += len(image)
+
+    def put(self, timestamp_millis: int, image: bytes, consumers: set[str]):
+        with self.lock:
+            self.consumers[timestamp_millis] = set(consumers)
+            self.memory_frames[timestamp_millis] = image
+            self.memory_size += len(image)
+            while self.memory_size > self.memory_budget and len(self.memory_frames) > 0:
+                spilled_timestamp_millis, spilled_image = self.memory_frames.popitem(last=False)
+                self.memory_size -= len(spilled_image)
+                self._spill(spilled_timestamp_millis, spilled_image)
+
+    def get(self, timestamp_millis: int) -> Union[bytes, None]:
+        with self.lock:
+            if timestamp_millis in self.memory_frames: return self.memory_frames[timestamp_millis]
+            if timestamp_millis in self.spilled_frames:
+                offset, length = self.spilled_frames[timestamp_millis]
+                return self.spill_map[offset:offset + length]
+            return None
+
+    def release(self, timestamp_millis: int, consumer: str):
+        with self.lock:
+            consumers = self.consumers.get(timestamp_millis)
+            if consumers is None: return
+            consumers.discard(consumer)
+            if len(consumers) > 0: return
+            del self.consumers[timestamp_millis]
+            if timestamp_millis in self.memory_frames:
+                self.memory_size -= len(self.memory_frames.pop(timestamp_millis))
+            # The space of spilled frames is not reused. The spill file is removed as a whole on close.
+            self.spilled_frames.pop(timestamp_millis, None)
+
+    def close(self):
+        with self.lock:
+            self.memory_frames.clear()
+            self.memory_size = 0
+            self.spilled_frames.clear()
+            self.consumers.clear()
+            self.spill_map = None
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+            if self.spill_directory != "":
+                shutil.rmtree(self.spill_directory, ignore_errors=True)
+                self.spill_directory = ""
+
 class VideoPreprocessor(ABC):
     s3_client = boto3.client("s3")
     transcribe_client = boto3.client("transcribe")
     rekognition_client = boto3.client("rekognition")
     bedrock_agent_client = boto3.client('bedrock-agent')
+    prompt_templates: dict[tuple[str, str, str], dict] = {} # Cache of prompt templates by (prompt id, version, variant name), shared across videos in worker mode
     
     def __init__(self, 
         label_detection_job_id: str,
@@ -174,10 +1068,20 @@ class VideoPreprocessor(ABC):
         bucket_name: str,
         video_s3_path: str,
         video_transcript_s3_path: str,
-        frame_interval: str):
+        frame_interval: str,
+        shard_index: int = 0,
+        shard_count: int = 1,
+        label_detection_enabled: bool = True,
+        transcription_enabled: bool = True,
+        celebrity_recognition_job_id: str = "",
+        face_detection_job_id: str = "",
+        speech_detection_enabled: bool = False):
 
         self.label_detection_job_id: str = label_detection_job_id
         self.transcription_job_name: str = transcription_job_name
+        # Video-level Rekognition jobs, which replace the per-frame face and celebrity calls when both are given
+        self.celebrity_recognition_job_id: str = celebrity_recognition_job_id
+        self.face_detection_job_id: str = face_detection_job_id
         self.bucket_name: str = bucket_name
         self.video_s3_path: str = video_s3_path
         self.video_transcript_s3_path: str = video_transcript_s3_path
@@ -187,25 +1091,79 @@ class VideoPreprocessor(ABC):
         self.visual_scenes: dict[int, str] = {}
         self.visual_captions: dict[int, str] = {}
         self.visual_texts: dict[int, list[str]] = {}
-        self.transcript: dict = {}
+        self.transcript: list[tuple[int, Union[int, None], Union[str, None], str]] = [] # (start millis, speaker number, language code, text) of each utterance
+        self.utterance_max_millis: int = 30000 # Longer utterances are split, so that each line of the video script stays close to its time
+        self.sentence_end_punctuation: set[str] = {".", "?", "!", "。", "？", "！"}
         self.celebrities: dict[int, list[CelebrityFinding]] = {}
         self.faces: dict[int, list[FaceFinding]] = {}
+        self.video_celebrity_findings: list[tuple[int, dict]] = [] # Celebrities of the video-level Rekognition job by their reported timestamp, until they are aligned to the frames
+        self.video_face_findings: list[tuple[int, dict]] = [] # Faces of the video-level Rekognition job by their reported timestamp, until they are aligned to the frames
         self.person_timestamps_millis: list[int] = []
         self.text_timestamps_millis: list[int] = []
         self.frame_interval: int = int(frame_interval) # Millisecond
         self.frame_interval_tolerance: int = int(0.25*self.frame_interval) # In millisecond. This means, any frame located within this tolerance in the timeline will be considered the same as the main frame being taken at regular interval
+        self.planned_frame_interval: int = self.frame_interval # In millisecond. Interval of the regular frames, which the frame budget planner may change. Shards stay aligned to frame_interval.
+        self.keyframe_tolerance: int = int(keyframe_tolerance_millis) if keyframe_tolerance_millis != "" else self.frame_interval # In millisecond. In keyframe sampling mode, a requested timestamp is replaced by the nearest keyframe within this tolerance, otherwise the exact frame is decoded.
+        self.keyframe_timestamps_millis: list[int] = []
+        self.packet_dts_millis: list[int] = [] # Decoding time of each video packet, in decoding order
+        self.packet_end_offsets: list[int] = [] # Byte offset by which all video packets up to each packet in decoding order are in the file
+        self.packet_reorder_margin_millis: int = 1000 # Packets decoded this long after a frame's timestamp may still be needed for the frame, e.g. with B-frames
         self.frame_dim_for_vqa: tuple(int) = (512, 512)
+        # Sizes of the frames going to VQA only. Frames with text get the largest size to keep the text legible, and the others get a size by their level of detail.
+        # Frames only go above the default size when an image token budget is set, which they are then shrunk to fit. Without a budget, simple frames shrink and no frame grows.
+        self.vqa_frame_dims: dict[str, tuple[int, int]] = {
+            "text": (1024, 1024) if vqa_image_token_budget > 0 else self.frame_dim_for_vqa,
+            "detailed": (768, 768) if vqa_image_token_budget > 0 else self.frame_dim_for_vqa,
+            "regular": self.frame_dim_for_vqa,
+            "simple": (256, 256)
+        } if vqa_adaptive_resolution_enabled else {"text": self.frame_dim_for_vqa, "detailed": self.frame_dim_for_vqa, "regular": self.frame_dim_for_vqa, "simple": self.frame_dim_for_vqa}
+        self.vqa_image_token_budget: int = vqa_image_token_budget # Of this shard, once the frames are planned
+        self.vqa_image_tokens: float = 0 # Estimated image tokens of the VQA frames planned so far
+        self.frame_budget_plan: dict = {} # Of this shard, planned once the video duration is known. Empty without a frame budget.
+        self.max_vqa_frames: Union[int, None] = None # VQA frames of this shard allowed by the frame budget planner. None means no budget.
         self.video_filename = ""
-        self.frame_bytes: list[list[Union[int, bytes]]] = []
-        self.person_frame_bytes: list[list[Union[int, bytes]]] = []
+        self.video_directory = ""
+        self.decode_lowres: int = 0 # Power of two by which the decoder reduces the resolution, when the codec supports it
+        self.video_download: VideoDownload = None
+        self.frame_store: FrameStore = None
+        self.frame_timestamps_millis: list[int] = [] # Frames to be analyzed by VQA
+        self.person_frame_timestamps_millis: list[int] = [] # Frames to be analyzed for faces and celebrities
         self.parallel_degree = os.cpu_count()
         self.visual_extraction_prompt_id: string = ""
         self.visual_extraction_prompt_variant_name: string = ""
         self.visual_extraction_prompt_version: string = ""
         self.visual_extraction_prompt_template: dict = {}
+        self.shard_index: int = shard_index
+        self.shard_count: int = shard_count
+        self.shard_s3_prefix: str = f"{analysis_shard_folder}/{video_s3_path}"
+        self.video_path: str = '/'.join(video_s3_path.split('/')[1:]) # Name of the video in database, which excludes the raw folder
+        self.frame_hashes: dict[int, int] = {}
+        self.frame_histograms: dict[int, list[float]] = {}
+        self.frame_novelty: dict[int, float] = {}
+        self.text_frame_timestamps_millis: set[int] = set()
+        self.vqa_calls: list[tuple[str, int]] = [] # Model and latency in milliseconds of each VQA call
+        self.run_report: dict = {}
+        self.face_tracker: FaceTracker = None
+        self.deadline: Union[float, None] = None # In seconds since the epoch, by which the frame analysis stops in deadline mode
+        self.label_detection_enabled: bool = label_detection_enabled
+        self.transcription_enabled: bool = transcription_enabled
+        # With speech detection, the transcription job is started by the analyzer once speech is found, instead of by the state machine
+        self.speech_detection_enabled: bool = speech_detection_enabled
+        self.speech_detection_thread: threading.Thread = None
     
+    class VideoFingerprints(Base):
+        __tablename__ = fingerprint_table_name
+
+        video_name = Column(ForeignKey(f"{video_table_name}.name"), primary_key=True, nullable=False)
+        timestamp_millis = Column(Integer, primary_key=True, nullable=False)
+        frame_hash = Column(BigInteger, nullable=False)
+        hash_band_0 = Column(Integer, nullable=False)
+        hash_band_1 = Column(Integer, nullable=False)
+        hash_band_2 = Column(Integer, nullable=False)
+        hash_band_3 = Column(Integer, nullable=False)
+
     @abstractmethod
-    def call_vqa(self, image_data: str) ->str:
+    def call_vqa(self, image_data: str, timestamp_millis: int = 0) ->str:
         pass
 
     def retrieve_config(self):
@@ -222,6 +1180,12 @@ class VideoPreprocessor(ABC):
         self.visual_extraction_prompt_version = prompt_config.get('version_id')
     
     def retrieve_prompts(self):
+        # Prompt versions are immutable, so a template fetched once can be reused for as long as the configuration points to the same version.
+        prompt_key = (self.visual_extraction_prompt_id, self.visual_extraction_prompt_version, self.visual_extraction_prompt_variant_name)
+        if prompt_key in self.prompt_templates:
+            self.visual_extraction_prompt_template = self.prompt_templates[prompt_key]
+            return
+
         visual_extraction_prompt_variants = self.bedrock_agent_client.get_prompt(
             promptIdentifier=self.visual_extraction_prompt_id,
             promptVersion=self.visual_extraction_prompt_version
@@ -229,12 +1193,27 @@ class VideoPreprocessor(ABC):
         for variant in visual_extraction_prompt_variants:
             if variant['name'] == self.visual_extraction_prompt_variant_name:
                 self.visual_extraction_prompt_template = variant['templateConfiguration']
+                self.prompt_templates[prompt_key] = self.visual_extraction_prompt_template
 
     def wait_for_rekognition_label_detection(self, sort_by):
-        get_object_detection = self.rekognition_client.get_label_detection(JobId=self.label_detection_job_id, SortBy=sort_by)
+        # Only the job status is needed here, so the polls read a single label instead of a full page
+        get_object_detection = self.rekognition_client.get_label_detection(JobId=self.label_detection_job_id, SortBy=sort_by, MaxResults=1)
         while(get_object_detection['JobStatus'] == 'IN_PROGRESS'):
             time.sleep(5)
-            get_object_detection = self.rekognition_client.get_label_detection(JobId=self.label_detection_job_id, SortBy=sort_by)
+            get_object_detection = self.rekognition_client.get_label_detection(JobId=self.label_detection_job_id, SortBy=sort_by, MaxResults=1)
+
+    def is_video_face_detection_enabled(self) -> bool:
+        return self.label_detection_enabled and self.celebrity_recognition_job_id != "" and self.face_detection_job_id != ""
+
+    def wait_for_rekognition_face_jobs(self):
+        get_celebrity_recognition = self.rekognition_client.get_celebrity_recognition(JobId=self.celebrity_recognition_job_id, MaxResults=1)
+        while(get_celebrity_recognition['JobStatus'] == 'IN_PROGRESS'):
+            time.sleep(5)
+            get_celebrity_recognition = self.rekognition_client.get_celebrity_recognition(JobId=self.celebrity_recognition_job_id, MaxResults=1)
+        get_face_detection = self.rekognition_client.get_face_detection(JobId=self.face_detection_job_id, MaxResults=1)
+        while(get_face_detection['JobStatus'] == 'IN_PROGRESS'):
+            time.sleep(5)
+            get_face_detection = self.rekognition_client.get_face_detection(JobId=self.face_detection_job_id, MaxResults=1)
 
     def wait_for_transcription_job(self):
         get_transcription = self.transcribe_client.get_transcription_job(TranscriptionJobName=self.transcription_job_name)
@@ -242,42 +1221,111 @@ class VideoPreprocessor(ABC):
         while(job_status == 'IN_PROGRESS' or job_status == "QUEUED"):
             time.sleep(5)
             get_transcription = self.transcribe_client.get_transcription_job(TranscriptionJobName=self.transcription_job_name)
+            job_status = get_transcription["TranscriptionJob"]["TranscriptionJobStatus"]
+
+    def start_transcription_job(self):
+        # Same job as the state machine starts when speech detection is disabled
+        self.transcription_job_name = str(uuid.uuid4())
+        self.transcribe_client.start_transcription_job(
+            TranscriptionJobName=self.transcription_job_name,
+            Media={"MediaFileUri": f"s3://{self.bucket_name}/{self.video_s3_path}"},
+            MediaFormat="mp4",
+            OutputBucketName=self.bucket_name,
+            OutputKey=self.video_transcript_s3_path,
+            Settings={"ShowSpeakerLabels": True, "MaxSpeakerLabels": 10},
+            IdentifyMultipleLanguages=True
+        )
+
+    def detect_speech(self):
+        # Runs alongside the frame analysis, as the audio track is spread over the whole file. If the detection fails, the video is transcribed anyway.
+        start_time = time.time()
+        speech_segments_millis: Union[list[tuple[int, int]], None] = None
+        try:
+            self.video_download.wait_for_all()
+            speech_segments_millis = SpeechDetector.detect(self.video_filename)
+        except Exception as e:
+            logging.warning(f"Could not detect speech, transcribing anyway: {e}")
+        if speech_segments_millis is None or SpeechDetector.has_speech(speech_segments_millis):
+            self.start_transcription_job()
+        else:
+            logging.info("No speech found, skipping transcription")
+
+        self.run_report["speech"] = {
+            "seconds": round(time.time() - start_time, 1),
+            "speech_segments_millis": speech_segments_millis,
+            "speech_millis": sum(stop - start for start, stop in speech_segments_millis) if speech_segments_millis is not None else None,
+            "transcription_job_name": self.transcription_job_name
+        }
+
+    def start_speech_detection(self):
+        # In sharded analysis, only the first shard detects speech and starts the transcription of the whole video
+        if not self.transcription_enabled or not self.speech_detection_enabled or self.shard_index != 0: return
+        self.speech_detection_thread = threading.Thread(target=self.detect_speech)
+        self.speech_detection_thread.start()
     
     def extract_visual_objects(self, get_object_detection_result: dict):
-        person_timestamps_seconds: list(int) = []
+        # Only the top N confident labels per timestamp are used later, so each page keeps those, along with the person and text timestamps, and the rest of the page is dropped
         label: dict
         for label in get_object_detection_result['Labels']:
-            objects_at_this_timestamp: list = []
-            timestamp_millis: int = int(label['Timestamp'])
-            timestamp_second: int = round(timestamp_millis/1000, 1)
-
-            # If this timestamp millis is already in self.visual_objects dictionary, then use it and append. Otherwise, add a new key to the dict.
-            if timestamp_millis in self.visual_objects:
-                objects_at_this_timestamp = self.visual_objects[timestamp_millis]
-            else:
-                self.visual_objects[timestamp_millis] = objects_at_this_timestamp
-
             object_name: str = label['Label']['Name']
             confidence: float = label['Label']['Confidence']
+            # With segment aggregation, a label covers a time range from its start timestamp
+            timestamp_millis: int = int(label['StartTimestampMillis'] if 'StartTimestampMillis' in label else label['Timestamp'])
+            end_timestamp_millis: int = int(label.get('EndTimestampMillis', timestamp_millis))
 
             # If this is a Person object, then register this into the timestamp list for face detection.
+            # A person segment is registered at the rate of person frames, and the clustering picks from these timestamps.
             if object_name == "Person" and confidence >= FaceFinding.face_detection_confidence_threshold:
-                self.person_timestamps_millis.append(timestamp_millis)
-                person_timestamps_seconds.append(timestamp_second)
+                self.person_timestamps_millis.extend(range(timestamp_millis, end_timestamp_millis + 1, person_frame_min_interval_millis))
             
             if object_name == "Text":
                 self.text_timestamps_millis.append(timestamp_millis)
 
-            if (object_name not in objects_at_this_timestamp):
-                # Append the object name to the list of objects for timestamp second
-                object_finding = ObjectFinding(label=object_name, confidence_score=confidence)
-                objects_at_this_timestamp.append(object_finding)
+            if confidence < ObjectFinding.confidence_score_threshold: continue
+            objects_at_this_timestamp: list[ObjectFinding] = self.visual_objects.setdefault(timestamp_millis, [])
+            existing_object = next((o for o in objects_at_this_timestamp if o.label == object_name), None)
+            if existing_object is not None:
+                existing_object.confidence_score = max(existing_object.confidence_score, confidence)
+            elif len(objects_at_this_timestamp) < ObjectFinding.top_n_threshold:
+                objects_at_this_timestamp.append(ObjectFinding(label=object_name, confidence_score=confidence))
+            else:
+                # Replace the least confident of the top N
+                least_confident_object = min(objects_at_this_timestamp, key=lambda o: o.confidence_score)
+                if confidence > least_confident_object.confidence_score:
+                    objects_at_this_timestamp[objects_at_this_timestamp.index(least_confident_object)] = ObjectFinding(label=object_name, confidence_score=confidence)
   
+    def cluster_person_timestamps(self):
+        # Rekognition reports a person several times per second. The detections are merged into segments, and each segment keeps the detections nearest to evenly spaced times at most one per person_frame_min_interval_millis.
+        detections_millis: list[int] = sorted(set(self.person_timestamps_millis))
+        segments: list[list[int]] = []
+        for t in detections_millis:
+            if len(segments) > 0 and t - segments[-1][-1] <= person_segment_max_gap_millis:
+                segments[-1].append(t)
+            else:
+                segments.append([t])
+
+        person_timestamps_millis: list[int] = []
+        for segment in segments:
+            number_of_frames = (segment[-1] - segment[0]) // person_frame_min_interval_millis + 1
+            step_millis = (segment[-1] - segment[0]) / max(number_of_frames - 1, 1)
+            for k in range(number_of_frames):
+                target_millis = segment[0] + k * step_millis
+                i = bisect.bisect_left(segment, target_millis)
+                person_timestamps_millis.append(min(segment[max(i - 1, 0):i + 1], key=lambda t: abs(t - target_millis)))
+        self.person_timestamps_millis = list(dict.fromkeys(person_timestamps_millis))
+
+        self.run_report["person_clustering"] = {
+            "detections": len(detections_millis),
+            "segments": len(segments),
+            "timestamps": len(self.person_timestamps_millis)
+        }
+
     def iterate_object_detection_result(self):
         get_object_detection_result: dict = self.rekognition_client.get_label_detection(
             JobId=self.label_detection_job_id,
             MaxResults=1000,
-            SortBy='TIMESTAMP'
+            SortBy='TIMESTAMP',
+            AggregateBy=label_aggregate_by
         )
 
         if get_object_detection_result["JobStatus"] == "FAILED": return # In case the job failed, just skip this channel.
@@ -293,40 +1341,294 @@ class VideoPreprocessor(ABC):
             get_object_detection_result: dict = self.rekognition_client.get_label_detection(
                 JobId=self.label_detection_job_id,
                 MaxResults=1000,
+                SortBy='TIMESTAMP',
+                AggregateBy=label_aggregate_by,
                 NextToken=get_object_detection_result["NextToken"]
             )
             self.extract_visual_objects(get_object_detection_result)
 
+        self.cluster_person_timestamps()
+
+    def get_frame_aligned_timestamp(self, sorted_frame_timestamps_millis: list[int], timestamp_millis: int) -> int:
+        # Nearest of the extracted frames, found by bisection. The frames are not on a fixed grid in keyframe sampling mode or in a shard.
+        i = bisect.bisect_left(sorted_frame_timestamps_millis, timestamp_millis)
+        return min(sorted_frame_timestamps_millis[max(i - 1, 0):i + 1], key=lambda t: abs(t - timestamp_millis))
+
+    def align_video_findings(self):
+        # Rekognition Video reports findings several times per second. Once the frames are extracted, each finding moves to the nearest frame, so that it lands on a timestamp of the video script.
+        # Celebrities are aligned first, so that the faces of recognized celebrities are not added again as faces
+        sorted_frame_timestamps_millis: list[int] = sorted(self.frame_timestamps_millis)
+        if len(sorted_frame_timestamps_millis) > 0:
+            for timestamp_millis, celebrity_dict in self.video_celebrity_findings:
+                celebrities = self.celebrities.setdefault(self.get_frame_aligned_timestamp(sorted_frame_timestamps_millis, timestamp_millis), [])
+                # The same celebrity is reported at each of the several timestamps aligned to this one
+                if celebrity_dict['Name'] in [c.name for c in celebrities]: continue
+                celebrities.append(CelebrityFinding(celebrity_dict))
+            for timestamp_millis, face_dict in self.video_face_findings:
+                self.add_face_finding(self.get_frame_aligned_timestamp(sorted_frame_timestamps_millis, timestamp_millis), FaceFinding(face_dict))
+        self.video_celebrity_findings = []
+        self.video_face_findings = []
+
+    def extract_celebrities(self, get_celebrity_recognition_result: dict):
+        celebrity: dict
+        for celebrity in get_celebrity_recognition_result['Celebrities']:
+            celebrity_dict: dict = celebrity['Celebrity']
+            if int(celebrity_dict['Confidence']) < CelebrityFinding.celebrity_match_confidence_threshold: continue
+            # The bounding box is reported under Face, or directly under Celebrity by older responses. A celebrity without one is skipped.
+            bounding_box: Union[dict, None] = (celebrity_dict.get('Face') or {}).get('BoundingBox') or celebrity_dict.get('BoundingBox')
+            if bounding_box is None: continue
+            # In sharded analysis, only the findings within this shard's time range are kept
+            if not self.is_in_shard(int(celebrity['Timestamp'])): continue
+            self.video_celebrity_findings.append((int(celebrity['Timestamp']), {
+                'Name': celebrity_dict['Name'],
+                'MatchConfidence': celebrity_dict['Confidence'],
+                'Face': {'BoundingBox': bounding_box}
+            }))
+
+    def extract_faces(self, get_face_detection_result: dict):
+        face: dict
+        for face in get_face_detection_result['Faces']:
+            if int(face['Face']['Confidence']) < FaceFinding.face_detection_confidence_threshold: continue
+            if not self.is_in_shard(int(face['Timestamp'])): continue
+            self.video_face_findings.append((int(face['Timestamp']), face['Face']))
+
+    def iterate_face_detection_results(self):
+        # Celebrities are read first, so that the faces of recognized celebrities are not added again as faces
+        get_celebrity_recognition_result: dict = self.rekognition_client.get_celebrity_recognition(
+            JobId=self.celebrity_recognition_job_id,
+            MaxResults=1000,
+            SortBy='TIMESTAMP'
+        )
+        if get_celebrity_recognition_result["JobStatus"] != "FAILED": # In case the job failed, just skip this channel.
+            self.extract_celebrities(get_celebrity_recognition_result)
+            while("NextToken" in get_celebrity_recognition_result):
+                get_celebrity_recognition_result = self.rekognition_client.get_celebrity_recognition(
+                    JobId=self.celebrity_recognition_job_id,
+                    MaxResults=1000,
+                    SortBy='TIMESTAMP',
+                    NextToken=get_celebrity_recognition_result["NextToken"]
+                )
+                self.extract_celebrities(get_celebrity_recognition_result)
+
+        get_face_detection_result: dict = self.rekognition_client.get_face_detection(
+            JobId=self.face_detection_job_id,
+            MaxResults=1000
+        )
+        if get_face_detection_result["JobStatus"] == "FAILED": return # In case the job failed, just skip this channel.
+        self.extract_faces(get_face_detection_result)
+        while("NextToken" in get_face_detection_result):
+            get_face_detection_result = self.rekognition_client.get_face_detection(
+                JobId=self.face_detection_job_id,
+                MaxResults=1000,
+                NextToken=get_face_detection_result["NextToken"]
+            )
+            self.extract_faces(get_face_detection_result)
+
     def fetch_transcription(self) -> dict:
         get_transcription = self.transcribe_client.get_transcription_job(TranscriptionJobName=self.transcription_job_name)
         if get_transcription["TranscriptionJob"]["TranscriptionJobStatus"] == "FAILED": return # In case the job failed, just skip this channel.
 
+        # Stream the items out of the Transcribe output and group the words into utterances as they come, so that only the words of the current utterance are held and the memory of long transcripts does not grow with the number of words.
+        # An utterance ends at a change of speaker or language, a long pause, or the end of a sentence.
         video_transcription_file: dict = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.video_transcript_s3_path)
-        self.transcript = json.loads(video_transcription_file['Body'].read().decode('utf-8'))
+        self.transcript = []
+        utterance: Union[dict, None] = None
+        def finish_utterance():
+            self.transcript.append((utterance["start_millis"], utterance["speaker_number"], utterance["language_code"], " ".join(utterance["words"])))
+
+        item: dict
+        for item in ijson.items(video_transcription_file['Body'], 'results.items.item'):
+            content: str = item['alternatives'][0]['content']
+            if item['type'] == 'punctuation':
+                # Punctuation attaches to the previous word
+                if utterance is None: continue
+                utterance["words"][-1] += content
+                if content in self.sentence_end_punctuation: utterance["ended"] = True
+                continue
+
+            speaker_number: Union[int, None] = None
+            if "speaker_label" in item:
+                match = re.search(r"spk_(\d+)", item['speaker_label'])
+                speaker_number = int(match.group(1)) + 1 # So that it starts from 1, not 0
+            language_code: Union[str, None] = item.get('language_code')
+            start_millis = int(float(item['start_time'])*1000)
+            end_millis = int(float(item['end_time'])*1000) if 'end_time' in item else start_millis
+
+            if utterance is None or utterance["ended"] \
+                or speaker_number != utterance["speaker_number"] or language_code != utterance["language_code"] \
+                or start_millis - utterance["end_millis"] > utterance_max_pause_millis \
+                or end_millis - utterance["start_millis"] > self.utterance_max_millis:
+                if utterance is not None: finish_utterance()
+                utterance = {"start_millis": start_millis, "end_millis": end_millis, "speaker_number": speaker_number, "language_code": language_code, "words": [], "ended": False}
+            utterance["end_millis"] = end_millis
+            utterance["words"].append(content)
+        if utterance is not None: finish_utterance()
+
+    def start_video_download(self):
+        # Create the decoding processes before the download threads start, so that they are not forked while a download thread holds a lock
+        get_decode_pool()
+        # Download into a directory of its own, so that concurrent videos with the same file name do not overwrite each other in worker mode
+        self.video_directory = tempfile.mkdtemp()
+        self.video_filename = os.path.join(self.video_directory, os.path.basename(self.video_s3_path))
+        self.video_download = VideoDownload(self.s3_client, self.bucket_name, self.video_s3_path, self.video_filename)
 
     def download_video_and_load_metadata(self):
-        filename: str = os.path.basename(self.video_s3_path)
-        self.s3_client.download_file(self.bucket_name, self.video_s3_path, filename)
-        self.video_filename = filename
+        if self.video_download is None:
+            self.start_video_download()
+
+        # The metadata is read from the container header, which is in the first or last chunk for most files. Otherwise wait for the whole file.
+        self.video_download.wait_for_bytes(self.video_download.chunk_size)
         video: cv2.VideoCapture = cv2.VideoCapture(self.video_filename)
         frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
         fps = video.get(cv2.CAP_PROP_FPS)
+        if frame_count <= 0 or fps <= 0:
+            self.video_download.wait_for_all()
+            video = cv2.VideoCapture(self.video_filename)
+            frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
+            fps = video.get(cv2.CAP_PROP_FPS)
         self.video_duration_seconds = float(frame_count/fps)
         self.video_duration_millis = int(self.video_duration_seconds*1000)
+        self.decode_lowres = self.get_decode_lowres(video)
+        self.build_packet_index()
+
+    def build_packet_index(self):
+        # List the byte ranges of the video packets from the container index, which is in the header already downloaded, so that decoding waits for the exact bytes of its frames
+        try:
+            packets = subprocess.run(
+                ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=dts_time,pos,size", "-of", "csv=p=0", self.video_filename],
+                capture_output=True, text=True, check=True
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f"Could not build packet index, decoding after the whole video is downloaded: {e}")
+            return
+
+        end_offset = 0
+        for packet in packets.splitlines():
+            fields = packet.strip().split(",")
+            if len(fields) < 3 or "N/A" in fields or "" in fields: continue
+            end_offset = max(end_offset, int(fields[1]) + int(fields[2]))
+            self.packet_dts_millis.append(math.floor(float(fields[0]) * 1000))
+            self.packet_end_offsets.append(end_offset)
+        # Without a complete index, e.g. for fragmented files whose index is spread over the file, decoding waits for the whole video
+        if len(self.packet_dts_millis) == 0 or self.packet_dts_millis[-1] < self.video_duration_millis - 2 * self.frame_interval:
+            self.packet_dts_millis, self.packet_end_offsets = [], []
+
+    def wait_for_video_position(self, timestamp_millis: int):
+        # Wait for the bytes of all video packets decoded up to the timestamp, including the nearby frames tried by the quality filter and the packets reordered after it
+        download = self.video_download
+        if download is None: return
+        last_timestamp_millis = timestamp_millis + self.frame_interval_tolerance + self.packet_reorder_margin_millis
+        if len(self.packet_dts_millis) == 0 or last_timestamp_millis >= self.packet_dts_millis[-1]:
+            download.wait_for_all()
+            return
+        download.wait_for_bytes(self.packet_end_offsets[bisect.bisect_right(self.packet_dts_millis, last_timestamp_millis) - 1])
+
+    def _extract_frames_in_order(self, timestamps_millis: list[int], get_consumers, text_timestamps_millis: set[int] = set()) -> list[int]:
+        # Decode in batches along the timeline, so that decoding runs on the beginning of the video while its later part is still downloading.
+        # Each decoded frame goes into the frame store as it arrives, and the timestamps of the extracted frames are returned.
+        p = get_decode_pool()
+        batch_size = self.parallel_degree * 4
+        timestamps_millis = sorted(set(timestamps_millis))
+        extracted_timestamps_millis: list[int] = []
+
+        def store_frames(timestamps_millis_to_extract: list[int]) -> list[int]:
+            failed_timestamps_millis: list[int] = []
+            frames_to_extract = [
+                (t, FRAME_KIND_SHARED if get_consumers(t) != {FrameStore.consumer_vqa} else (FRAME_KIND_VQA_TEXT if t in text_timestamps_millis else FRAME_KIND_VQA))
+                for t in timestamps_millis_to_extract
+            ]
+            run_length = max(1, math.ceil(len(frames_to_extract) / self.parallel_degree))
+            runs = [frames_to_extract[i:i + run_length] for i in range(0, len(frames_to_extract), run_length)]
+            decoder = FrameDecoder(
+                filename=self.video_filename,
+                decode_lowres=self.decode_lowres,
+                frame_dim_for_vqa=self.frame_dim_for_vqa,
+                vqa_frame_dims=self.vqa_frame_dims,
+                frame_interval_tolerance=self.frame_interval_tolerance,
+                keyframe_timestamps_millis=self.keyframe_timestamps_millis[
+                    bisect.bisect_left(self.keyframe_timestamps_millis, timestamps_millis_to_extract[0]):bisect.bisect_right(self.keyframe_timestamps_millis, timestamps_millis_to_extract[-1])
+                ],
+                strict=self.video_download is not None and not self.video_download.is_complete()
+            )
+            frames = (frame for run_frames in p.imap(decoder.decode, runs) for frame in run_frames)
+            for timestamp_millis, frame in zip(timestamps_millis_to_extract, frames):
+                if frame is None:
+                    failed_timestamps_millis.append(timestamp_millis)
+                    continue
+                if frame[1] is None:
+                    logging.info(f"Skipping frame at timestamp {timestamp_millis} which has no usable content")
+                    continue
+                consumers: set[str] = get_consumers(timestamp_millis)
+                self.frame_store.put(timestamp_millis, frame[1], consumers)
+                if FrameStore.consumer_vqa in consumers:
+                    self.frame_hashes[timestamp_millis] = frame[2]
+                    self.frame_histograms[timestamp_millis] = frame[3]
+                extracted_timestamps_millis.append(timestamp_millis)
+            return failed_timestamps_millis
+
+        failed_timestamps_millis: list[int] = []
+        for batch_start in range(0, len(timestamps_millis), batch_size):
+            batch = timestamps_millis[batch_start:batch_start + batch_size]
+            self.wait_for_video_position(batch[-1])
+            failed_timestamps_millis.extend(store_frames(batch))
+
+        # Frames which failed to decode while the download was in progress are retried on the complete file
+        if len(failed_timestamps_millis) > 0 and self.video_download is not None:
+            self.video_download.wait_for_all()
+            store_frames(failed_timestamps_millis)
+
+        return sorted(extracted_timestamps_millis)
+
+    def get_decode_lowres(self, video: cv2.VideoCapture) -> int:
+        # Pick the largest reduction which still decodes at least the VQA frame size
+        fourcc = int(video.get(cv2.CAP_PROP_FOURCC)).to_bytes(4, 'little').decode('ascii', errors='ignore').lower()
+        if fourcc not in lowres_decode_fourccs: return 0
+        width, height = int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        lowres = 0
+        target_width = max(dim[0] for dim in [self.frame_dim_for_vqa] + list(self.vqa_frame_dims.values()))
+        target_height = max(dim[1] for dim in [self.frame_dim_for_vqa] + list(self.vqa_frame_dims.values()))
+        while lowres < 3 and (width >> (lowres + 1)) >= target_width and (height >> (lowres + 1)) >= target_height:
+            lowres += 1
+        return lowres
 
-    def load_video(self, filename) -> cv2.VideoCapture:
-        video: cv2.VideoCapture = cv2.VideoCapture(filename)
-        return video
-    
     def _detect_faces_and_celebrities_at_timestamp(self, timestamp_data):
         timestamp_millis: int = timestamp_data[0]
         image: bytes = timestamp_data[1]
 
         # Call Rekognition to detect celebrity
         recognize_celebrity_response: dict = self.rekognition_client.recognize_celebrities(Image={'Bytes': image})
-        celebrity_findings: list[dict] = recognize_celebrity_response["CelebrityFaces"]
-        unrecognized_faces: list[dict] = recognize_celebrity_response["UnrecognizedFaces"]
-        
+        self.add_celebrity_findings(timestamp_millis, recognize_celebrity_response["CelebrityFaces"])
+
+        # Only call the detect face APU if there are other faces beside the recognized celebrity in this frame
+        # This also applies when there is 0 celebrity detected, but there are more faces in the frame.
+        if len(recognize_celebrity_response["UnrecognizedFaces"]) == 0: return None
+        self.detect_faces_at_timestamp(timestamp_millis, image)
+
+    def _detect_faces_and_celebrities_in_mosaic(self, timestamps_millis: list[int]):
+        # Recognizes the celebrities of several frames in one call. Frames whose faces are too small or cross a tile border in the mosaic are recognized on their own.
+        try:
+            images: dict[int, bytes] = {t: self.frame_store.get(t) for t in timestamps_millis}
+            images = {t: image for t, image in images.items() if image is not None}
+            if len(images) == 0: return
+            single_timestamps_millis: list[int] = list(images.keys())
+            if len(images) > 1:
+                mosaic = CelebrityMosaic(list(images.values()), self.frame_dim_for_vqa)
+                recognize_celebrity_response: dict = self.rekognition_client.recognize_celebrities(Image={'Bytes': mosaic.image})
+                single_timestamps_millis = []
+                for timestamp_millis, tile in zip(images.keys(), mosaic.split(recognize_celebrity_response)):
+                    if tile is None:
+                        single_timestamps_millis.append(timestamp_millis)
+                        continue
+                    celebrity_findings, unrecognized_faces = tile
+                    self.add_celebrity_findings(timestamp_millis, celebrity_findings)
+                    if len(unrecognized_faces) > 0: self.detect_faces_at_timestamp(timestamp_millis, images[timestamp_millis])
+            for timestamp_millis in single_timestamps_millis:
+                self._detect_faces_and_celebrities_at_timestamp([timestamp_millis, images[timestamp_millis]])
+        finally:
+            for timestamp_millis in timestamps_millis:
+                self.frame_store.release(timestamp_millis, FrameStore.consumer_faces)
+
+    def add_celebrity_findings(self, timestamp_millis: int, celebrity_findings: list[dict]):
         # Parse Rekognition celebrity detection data and add to dictionary as appropriate
         if len(celebrity_findings) > 0:
             if timestamp_millis not in self.celebrities: self.celebrities[timestamp_millis] = []
@@ -336,80 +1638,276 @@ class VideoPreprocessor(ABC):
                 celebrity_finding = CelebrityFinding(celebrity_finding_dict)
                 self.celebrities[timestamp_millis].append(celebrity_finding)
 
-        # Only call the detect face APU if there are other faces beside the recognized celebrity in this frame
-        # This also applies when there is 0 celebrity detected, but there are more faces in the frame.
-        if len(unrecognized_faces) == 0: return None
-
+    def detect_faces_at_timestamp(self, timestamp_millis: int, image: bytes):
         # Call Rekognition to detect faces
         face_findings: dict = self.rekognition_client.detect_faces(Image={'Bytes': image}, Attributes=['ALL'])['FaceDetails']
 
         if len(face_findings) == 0: return None
 
-        if timestamp_millis not in self.faces: self.faces[timestamp_millis] = []
         face_finding_dict: dict
         for face_finding_dict in face_findings:
             if int(face_finding_dict["Confidence"]) < FaceFinding.face_detection_confidence_threshold : continue
-            face_finding = FaceFinding(face_finding_dict)
+            self.add_face_finding(timestamp_millis, FaceFinding(face_finding_dict))
 
-            # The below code checks if this face is already captured as celebrity by checking the bounding box for the detected celebrities at this frame
-            face_found_in_celebrities_list = False
-            if timestamp_millis in self.celebrities:
-                for celebrity_finding in self.celebrities[timestamp_millis]:
-                    if celebrity_finding.is_matching_face(face_finding.top, face_finding.left, face_finding.height, face_finding.width): 
-                        face_found_in_celebrities_list = True
+    def add_face_finding(self, timestamp_millis: int, face_finding: FaceFinding):
+        if timestamp_millis not in self.faces: self.faces[timestamp_millis] = []
+
+        # The below code checks if this face is already captured as celebrity by checking the bounding box for the detected celebrities at this frame
+        face_found_in_celebrities_list = CelebrityFinding.is_matching_any(self.celebrities.get(timestamp_millis, []), face_finding.top, face_finding.left, face_finding.height, face_finding.width)
 
-            # Only add if the face is not found in the celebrity list
-            if not face_found_in_celebrities_list:
-                # Only add if there is no other face with similar age range at the same millisecond.
-                if not face_finding.is_duplicate(self.faces[timestamp_millis]):
-                    self.faces[timestamp_millis].append(face_finding)
+        # Only add if the face is not found in the celebrity list
+        if not face_found_in_celebrities_list:
+            # Only add if there is no other face with similar age range at the same millisecond.
+            if not face_finding.is_duplicate(self.faces[timestamp_millis]):
+                self.faces[timestamp_millis].append(face_finding)
 
     def detect_faces_and_celebrities(self):
         if len(self.person_timestamps_millis) == 0:
             logging.warning("detect_faces_and_celebrities may be called before objects detection, which caused 0 'person' result")
         
+        recognized_timestamps_millis = self.track_faces()
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel_degree*15) as executor:
-            executor.map(self._detect_faces_and_celebrities_at_timestamp, self.person_frame_bytes)
+            if celebrity_mosaic_tiles > 1:
+                executor.map(self._detect_faces_and_celebrities_in_mosaic, self.group_for_mosaic(recognized_timestamps_millis))
+            else:
+                executor.map(lambda t: self._consume_frame(t, FrameStore.consumer_faces, self._detect_faces_and_celebrities_at_timestamp), recognized_timestamps_millis)
+        self.propagate_face_tracks()
+
+    def group_for_mosaic(self, timestamps_millis: list[int]) -> list[list[int]]:
+        # Frames where the tracked faces are already too small for the mosaic go on their own
+        def is_mosaic_friendly(timestamp_millis: int) -> bool:
+            if self.face_tracker is None or timestamp_millis not in self.face_tracker.boxes: return True
+            return all(box[3] >= CelebrityMosaic.min_face_height for box in self.face_tracker.boxes[timestamp_millis])
+        mosaic_timestamps_millis = [t for t in sorted(timestamps_millis) if is_mosaic_friendly(t)]
+        single_timestamps_millis = [t for t in timestamps_millis if not is_mosaic_friendly(t)]
+        groups = [mosaic_timestamps_millis[i:i + celebrity_mosaic_tiles] for i in range(0, len(mosaic_timestamps_millis), celebrity_mosaic_tiles)]
+        self.run_report["celebrity_mosaic"] = {"mosaics": len([g for g in groups if len(g) > 1]), "single_frames": len(single_timestamps_millis)}
+        return groups + [[t] for t in single_timestamps_millis]
+
+    def track_faces(self) -> list[int]:
+        # Returns the person frames to recognize with Rekognition. The other person frames are released, as they take the findings of a recognized frame.
+        if not face_tracking_enabled: return self.person_frame_timestamps_millis
+        self.face_tracker = FaceTracker()
+        def find_face_boxes(timestamp_millis: int):
+            image: bytes = self.frame_store.get(timestamp_millis)
+            self.face_tracker.boxes[timestamp_millis] = FaceTracker.detect_face_boxes(image) if image is not None else []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel_degree) as executor:
+            list(executor.map(find_face_boxes, set(self.person_frame_timestamps_millis)))
+
+        recognized_timestamps_millis = self.face_tracker.plan()
+        for timestamp_millis in set(self.person_frame_timestamps_millis) - set(recognized_timestamps_millis):
+            self.frame_store.release(timestamp_millis, FrameStore.consumer_faces)
+        self.run_report["face_tracking"] = {
+            "person_frames": len(self.face_tracker.boxes),
+            "recognized_frames": len(recognized_timestamps_millis)
+        }
+        return recognized_timestamps_millis
+
+    def propagate_face_tracks(self):
+        if self.face_tracker is None: return
+        for timestamp_millis, anchor_timestamp_millis in self.face_tracker.anchors.items():
+            if timestamp_millis == anchor_timestamp_millis: continue
+            if anchor_timestamp_millis in self.celebrities:
+                celebrity_dicts = [c.to_dict() for c in self.celebrities[anchor_timestamp_millis]]
+                for celebrity_dict in celebrity_dicts:
+                    celebrity_dict['Face']['BoundingBox'] = self.face_tracker.follow(anchor_timestamp_millis, timestamp_millis, celebrity_dict['Face']['BoundingBox'])
+                self.celebrities[timestamp_millis] = [CelebrityFinding(c) for c in celebrity_dicts]
+            if anchor_timestamp_millis in self.faces:
+                face_dicts = [f.to_dict() for f in self.faces[anchor_timestamp_millis]]
+                for face_dict in face_dicts:
+                    face_dict['BoundingBox'] = self.face_tracker.follow(anchor_timestamp_millis, timestamp_millis, face_dict['BoundingBox'])
+                self.faces[timestamp_millis] = [FaceFinding(f) for f in face_dicts]
+
+    def _consume_frame(self, timestamp_millis: int, consumer: str, consume):
+        # Passes the stored frame to the consumer, then releases it so that the frame is dropped once all its consumers are done with it
+        try:
+            image: bytes = self.frame_store.get(timestamp_millis)
+            if image is not None: consume([timestamp_millis, image])
+        finally:
+            self.frame_store.release(timestamp_millis, consumer)
+
+    def build_keyframe_index(self):
+        # List the keyframes from the container's packet flags. This reads the packets without decoding them.
+        self.video_download.wait_for_all()
+        try:
+            packets = subprocess.run(
+                ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", self.video_filename],
+                capture_output=True, text=True, check=True
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f"Could not build keyframe index, decoding exact frames instead: {e}")
+            return
+
+        keyframe_timestamps_millis: set[int] = set()
+        for packet in packets.splitlines():
+            fields = packet.strip().split(",")
+            if len(fields) < 2 or "K" not in fields[1] or fields[0] in ["", "N/A"]: continue
+            # Round down, so that seeking to the timestamp never lands after the keyframe
+            keyframe_timestamps_millis.add(math.floor(float(fields[0]) * 1000))
+        self.keyframe_timestamps_millis = sorted(keyframe_timestamps_millis)
+
+    def snap_to_keyframes(self, timestamps_millis: list[int]) -> list[int]:
+        # Replace each timestamp with its nearest keyframe within the tolerance. Timestamps without a keyframe nearby are kept, and decoded exactly.
+        if len(self.keyframe_timestamps_millis) == 0: return timestamps_millis
+        snapped_timestamps_millis: list[int] = []
+        for t in timestamps_millis:
+            i = bisect.bisect_left(self.keyframe_timestamps_millis, t)
+            nearest = min(self.keyframe_timestamps_millis[max(i - 1, 0):i + 1], key=lambda k: abs(k - t))
+            snapped_timestamps_millis.append(nearest if abs(nearest - t) <= self.keyframe_tolerance else t)
+        # Several timestamps may share the same keyframe
+        return list(dict.fromkeys(snapped_timestamps_millis))
+
+    def plan_vqa_frame_dims(self, number_of_frames: int, number_of_text_frames: int):
+        # Shrink the VQA frame sizes to fit the image token budget, assuming every other frame is detailed. The other frames shrink first, then the frames with text.
+        if self.vqa_image_token_budget <= 0 or number_of_frames == 0: return
+        # The budget of the video is split across the shards by their duration, like the frame budget
+        shard_start_millis, shard_stop_millis = self.get_shard_range_millis()
+        self.vqa_image_token_budget = math.ceil(vqa_image_token_budget * (shard_stop_millis - shard_start_millis) / max(self.video_duration_millis, 1))
+        get_tokens = self.get_vqa_image_tokens
+        def fit(dim: tuple[int, int], max_tokens: float) -> tuple[int, int]:
+            if get_tokens(dim) <= max_tokens: return dim
+            scale = math.sqrt(max(max_tokens, 0) / get_tokens(dim))
+            return (max(int(dim[0] * scale), self.vqa_frame_dims["simple"][0]), max(int(dim[1] * scale), self.vqa_frame_dims["simple"][1]))
+
+        number_of_other_frames = number_of_frames - number_of_text_frames
+        if number_of_other_frames > 0:
+            tokens_per_other_frame = (self.vqa_image_token_budget - number_of_text_frames * get_tokens(self.vqa_frame_dims["text"])) / number_of_other_frames
+            self.vqa_frame_dims["detailed"] = fit(self.vqa_frame_dims["detailed"], tokens_per_other_frame)
+            self.vqa_frame_dims["regular"] = fit(self.vqa_frame_dims["regular"], tokens_per_other_frame)
+        if number_of_text_frames > 0:
+            tokens_per_text_frame = (self.vqa_image_token_budget - number_of_other_frames * get_tokens(self.vqa_frame_dims["detailed"])) / number_of_text_frames
+            self.vqa_frame_dims["text"] = fit(self.vqa_frame_dims["text"], tokens_per_text_frame)
+        self.vqa_image_tokens = number_of_text_frames * get_tokens(self.vqa_frame_dims["text"]) + number_of_other_frames * get_tokens(self.vqa_frame_dims["detailed"])
+        logging.info(f"VQA frame sizes within the budget of {self.vqa_image_token_budget} image tokens: {self.vqa_frame_dims}")
+
+    @staticmethod
+    def get_vqa_image_tokens(dim: tuple[int, int]) -> float:
+        # Approximate image token count of Anthropic Claude models
+        return dim[0] * dim[1] / 750
+
+    def get_refinement_allowance(self) -> Union[int, None]:
+        # Refined frames count against what the frame budget and the image token budget leave after the frames analyzed so far. None means no budget.
+        allowances: list[int] = []
+        if self.max_vqa_frames is not None:
+            allowances.append(self.max_vqa_frames - len(self.frame_timestamps_millis))
+        if self.vqa_image_token_budget > 0:
+            allowances.append(int((self.vqa_image_token_budget - self.vqa_image_tokens) / self.get_vqa_image_tokens(self.vqa_frame_dims["detailed"])))
+        return max(min(allowances), 0) if len(allowances) > 0 else None
+
+    def get_shard_range_millis(self) -> tuple[int, int]:
+        # The timeline is split into shards aligned to the frame interval, so that the regular frames of all shards together are the same as those of a single full run.
+        # For example, a 10 seconds video with 1000 milliseconds interval and 3 shards is split into [0, 4000), [4000, 8000), and [8000, 10000).
+        if self.shard_count <= 1: return 0, self.video_duration_millis
+        number_of_regular_frames = math.ceil(self.video_duration_millis / self.frame_interval)
+        frames_per_shard = math.ceil(number_of_regular_frames / self.shard_count)
+        start_millis = min(self.shard_index * frames_per_shard * self.frame_interval, self.video_duration_millis)
+        stop_millis = min((self.shard_index + 1) * frames_per_shard * self.frame_interval, self.video_duration_millis)
+        return start_millis, stop_millis
+
+    def is_in_shard(self, timestamp_millis: int) -> bool:
+        if self.shard_count <= 1: return True
+        start_millis, stop_millis = self.get_shard_range_millis()
+        # The last shard also owns any timestamp beyond the probed duration
+        if self.shard_index == self.shard_count - 1: return timestamp_millis >= start_millis
+        return start_millis <= timestamp_millis < stop_millis
+
+    def is_refining(self) -> bool:
+        # Refined frames would be analyzed outside the priority order of the deadline mode, so with a deadline all regular frames are sampled at once and the deadline decides which are analyzed
+        return sampling_mode == SAMPLING_MODE_REFINE and self.deadline is None
+
+    def get_sampling_interval(self) -> int:
+        # In refine sampling mode, the regular frames start at a coarse interval and are refined where the scene changes
+        if self.is_refining(): return self.planned_frame_interval * refinement_coarse_interval_multiple
+        return self.planned_frame_interval
+
+    def is_scene_changed(self, timestamp_millis_a: int, timestamp_millis_b: int) -> bool:
+        if timestamp_millis_a in self.frame_hashes and timestamp_millis_b in self.frame_hashes:
+            if (self.frame_hashes[timestamp_millis_a] ^ self.frame_hashes[timestamp_millis_b]).bit_count() / 64 > refinement_hash_distance: return True
+        if timestamp_millis_a in self.visual_scenes and timestamp_millis_b in self.visual_scenes:
+            if 1 - token_jaccard_similarity(self.visual_scenes[timestamp_millis_a], self.visual_scenes[timestamp_millis_b]) > refinement_scene_distance: return True
+        return False
+
+    def refine_sampling(self):
+        # Sample the midpoint between consecutive analyzed frames which differ, and repeat on the halves, down to the planned frame interval.
+        # Steady segments keep the coarse interval, while segments with scene changes get up to the density of the frame interval.
+        coarse_frame_count = len(self.frame_timestamps_millis)
+        refinement_passes = 0
+        pairs: list[tuple[int, int]] = list(zip(sorted(self.frame_timestamps_millis), sorted(self.frame_timestamps_millis)[1:]))
+        while len(pairs) > 0:
+            midpoints: dict[int, tuple[int, int]] = {}
+            for a, b in pairs:
+                if b - a < 2 * self.planned_frame_interval or not self.is_scene_changed(a, b): continue
+                midpoint = round((a + b) / 2 / self.planned_frame_interval) * self.planned_frame_interval
+                if a < midpoint < b and midpoint not in self.visual_scenes: midpoints[midpoint] = (a, b)
+            allowance = self.get_refinement_allowance()
+            if allowance is not None:
+                midpoints = {t: midpoints[t] for t in FrameBudgetPlanner.cap(sorted(midpoints), allowance)}
+            if len(midpoints) == 0 or self.is_deadline_near(): break
+
+            refinement_passes += 1
+            extracted_timestamps_millis = self._extract_frames_in_order(list(midpoints.keys()), lambda t: {FrameStore.consumer_vqa}, self.text_frame_timestamps_millis)
+            self.frame_timestamps_millis = sorted(self.frame_timestamps_millis + extracted_timestamps_millis)
+            self.vqa_image_tokens += len(extracted_timestamps_millis) * self.get_vqa_image_tokens(self.vqa_frame_dims["detailed"])
+            self.extract_scenes_from_vqa(extracted_timestamps_millis)
+            pairs = [pair for midpoint in extracted_timestamps_millis for pair in [(midpoints[midpoint][0], midpoint), (midpoint, midpoints[midpoint][1])]]
+
+        self.run_report["refinement"] = {
+            "coarse_interval_millis": self.get_sampling_interval(),
+            "coarse_frames": coarse_frame_count,
+            "refined_frames": len(self.frame_timestamps_millis) - coarse_frame_count,
+            "passes": refinement_passes
+        }
 
-    def _extract_frame(self, timestamp_millis):
-        logging.info(f"Extracting frame at timestamp: {timestamp_millis}")
-        video = self.load_video(self.video_filename)
-        video.set(cv2.CAP_PROP_POS_MSEC, int(timestamp_millis))
-        success, frame = video.read()
-        if success:
-            # Resize frame to 512 x 512 px
-            dim = self.frame_dim_for_vqa
-            # This may fail if the frame is empty. Just skip the frame if so.
-            try:
-                frame = cv2.resize(frame, dim, interpolation = cv2.INTER_AREA)
-            except:
-                return None
-        
-            image_pil = Image.fromarray(frame)
-            io_stream = io.BytesIO()
-            image_pil.save(io_stream, format='JPEG')
-            image = io_stream.getvalue()
-            return [timestamp_millis, image]
-        del video
+    def find_nearby_timestamp(self, sorted_timestamps_millis: list[int], timestamp_millis: int) -> Union[int, None]:
+        # Nearest timestamp within the frame interval tolerance, found by bisection in the sorted timestamps
+        i = bisect.bisect_left(sorted_timestamps_millis, timestamp_millis)
+        candidates = sorted_timestamps_millis[max(i - 1, 0):i + 1]
+        if len(candidates) == 0: return None
+        nearest = min(candidates, key=lambda r: abs(r - timestamp_millis))
+        return nearest if abs(nearest - timestamp_millis) < self.frame_interval_tolerance else None
+
+    def plan_frame_budget(self, shard_start_millis: int, shard_stop_millis: int) -> dict:
+        # The frame budget of the video is split across the shards by their duration, while each shard has the whole completion time target as shards run at the same time
+        planner = FrameBudgetPlanner(
+            max_frames=math.ceil(frame_budget_max_frames * (shard_stop_millis - shard_start_millis) / max(self.video_duration_millis, 1)),
+            target_completion_seconds=frame_budget_target_seconds,
+            concurrency=frame_budget_concurrency
+        )
+        if not planner.is_enabled(): return {}
+        plan = planner.plan(shard_stop_millis - shard_start_millis, self.frame_interval)
+        self.planned_frame_interval = plan["frame_interval_millis"]
+        self.frame_interval_tolerance = int(0.25*self.planned_frame_interval)
+        if sampling_mode == SAMPLING_MODE_KEYFRAME and keyframe_tolerance_millis == "": self.keyframe_tolerance = self.planned_frame_interval
+        logging.info(f"Frame budget plan: {plan}")
+        return plan
 
     def extract_frames(self):
         # Create a list containing milliseconds where frame should be extracted from the video, according to the interval.
         # This may look like [0, 1000, 2000, 3000]
-        regular_timestamps_millis = list(range(0, self.video_duration_millis, self.frame_interval))
+        # When running as a shard, only the timestamps within this shard's time range are extracted.
+        shard_start_millis, shard_stop_millis = self.get_shard_range_millis()
+        plan = self.frame_budget_plan
+        self.max_vqa_frames = plan.get("max_vqa_frames")
+        regular_timestamps_millis = list(range(shard_start_millis, shard_stop_millis, self.get_sampling_interval()))
+
+        # In keyframe sampling mode, the timestamps move to their nearest keyframes, which decode without decoding any other frame
+        if sampling_mode == SAMPLING_MODE_KEYFRAME:
+            self.build_keyframe_index()
+            regular_timestamps_millis = self.snap_to_keyframes(regular_timestamps_millis)
 
         # Remove duplicate text_timestamp_millis timestamps (too close to each other) as compared to regular_timestamp_millis
         # For example, if Amazon Rekognition detects text at millisecond 2103, and there is already regular frame interval to be extracted at 2000 with tolerance of 250 millisecond, then this 2103 timestamp will be ignored assuming the text will be captured at 2000.
         text_timestamps_millis = []
-        for t in self.text_timestamps_millis:
-            include = True
-            for r in regular_timestamps_millis:
-                if abs(t-r) < self.frame_interval_tolerance:
-                    include = False
-                    break
-            if include:
+        text_timestamp_millis_joined_with_regular = []
+        sorted_regular_timestamps_millis = sorted(regular_timestamps_millis)
+        for t in self.snap_to_keyframes(list(filter(self.is_in_shard, self.text_timestamps_millis))):
+            r = self.find_nearby_timestamp(sorted_regular_timestamps_millis, t)
+            if r is not None:
+                text_timestamp_millis_joined_with_regular.append(r)
+            else:
                 text_timestamps_millis.append(t)
 
-        text_timestamps_millis =  list(filter(lambda t: t is not None, text_timestamps_millis))
+        text_timestamps_millis =  FrameBudgetPlanner.cap(list(filter(lambda t: t is not None, text_timestamps_millis)), plan.get("max_text_frames"))
 
         regular_and_text_timestamps_millis = regular_timestamps_millis + text_timestamps_millis
 
@@ -417,27 +1915,41 @@ class VideoPreprocessor(ABC):
         # For example, if Amazon Rekognition detects a person at millisecond 2789, and there is already regular frame interval to be extracted at 3000 with tolerance of 250 millisecond, then this 2789 timestamp will be ignored assuming the person will be captured at 3000.
         person_timestamps_millis = []
         person_timestamp_millis_joined_with_regular = []
-        for t in self.person_timestamps_millis:
-            include = True
-            for r in regular_and_text_timestamps_millis:
-                if abs(t-r) < self.frame_interval_tolerance:
-                    include = False
-                    person_timestamp_millis_joined_with_regular.append(r)
-                    break
-            if include:
+        sorted_regular_and_text_timestamps_millis = sorted(regular_and_text_timestamps_millis)
+        for t in self.snap_to_keyframes(list(filter(self.is_in_shard, self.person_timestamps_millis))):
+            r = self.find_nearby_timestamp(sorted_regular_and_text_timestamps_millis, t)
+            if r is not None:
+                person_timestamp_millis_joined_with_regular.append(r)
+            else:
                 person_timestamps_millis.append(t)
 
-        person_timestamps_millis =  list(filter(lambda t: t is not None, person_timestamps_millis))
-
-        with Pool(self.parallel_degree) as p:
-            self.frame_bytes = list(p.map(self._extract_frame, regular_and_text_timestamps_millis))
-        self.frame_bytes = list(filter(lambda f: f is not None, self.frame_bytes))
-
-        with Pool(self.parallel_degree) as p:
-            self.person_frame_bytes = list(p.map(self._extract_frame, person_timestamps_millis))
-        self.person_frame_bytes = list(filter(lambda f: f is not None, self.person_frame_bytes))
+        # Regular and text frames showing a person count towards the cap of frames going to face detection
+        person_timestamp_millis_joined_with_regular = FrameBudgetPlanner.cap(sorted(set(person_timestamp_millis_joined_with_regular)), plan.get("max_person_frames"))
+        max_extra_person_frames = plan["max_person_frames"] - len(person_timestamp_millis_joined_with_regular) if plan.get("max_person_frames") is not None else None
+        person_timestamps_millis =  FrameBudgetPlanner.cap(list(filter(lambda t: t is not None, person_timestamps_millis)), max_extra_person_frames)
+
+        # Regular and text frames which also show a person are consumed by both VQA and face detection
+        person_timestamp_millis_joined_with_regular = set(person_timestamp_millis_joined_with_regular)
+        # Regular frames close to a text detection show the text as well
+        self.text_frame_timestamps_millis = set(text_timestamps_millis + text_timestamp_millis_joined_with_regular)
+        self.plan_vqa_frame_dims(len(set(regular_and_text_timestamps_millis)), len(self.text_frame_timestamps_millis))
+        if len(plan) > 0:
+            self.run_report["plan"] = {
+                **plan,
+                "vqa_frames": len(set(regular_and_text_timestamps_millis)),
+                "person_frames": len(person_timestamps_millis) + len(person_timestamp_millis_joined_with_regular),
+                "vqa_frame_dims": {kind: list(dim) for kind, dim in self.vqa_frame_dims.items()}
+            }
+        self.frame_store = FrameStore()
+        self.frame_hashes = {}
+        self.frame_timestamps_millis = self._extract_frames_in_order(
+            regular_and_text_timestamps_millis,
+            lambda t: {FrameStore.consumer_vqa, FrameStore.consumer_faces} if t in person_timestamp_millis_joined_with_regular else {FrameStore.consumer_vqa},
+            self.text_frame_timestamps_millis
+        )
+        self.person_frame_timestamps_millis = self._extract_frames_in_order(person_timestamps_millis, lambda t: {FrameStore.consumer_faces})
         
-        self.person_frame_bytes = self.person_frame_bytes + list(filter(lambda f: f[0] in person_timestamp_millis_joined_with_regular, self.frame_bytes))
+        self.person_frame_timestamps_millis = self.person_frame_timestamps_millis + list(filter(lambda t: t in person_timestamp_millis_joined_with_regular, self.frame_timestamps_millis))
  
     def _extract_scene_from_vqa(self, frame_info: list[Union[int, bytes]]):
         timestamp_millis = frame_info[0]
@@ -446,7 +1958,7 @@ class VideoPreprocessor(ABC):
         logging.info(f"Extracting scene from VQA at timestamp: {timestamp_millis}")
 
         try:
-            vqa_response = self.call_vqa(image_data=image)
+            vqa_response = self.call_vqa(image_data=image, timestamp_millis=timestamp_millis)
         except Exception as e:
             logging(f"Error in extracting information for frame at timestamp: {timestamp_millis}")
             logging.error(e)
@@ -465,27 +1977,322 @@ class VideoPreprocessor(ABC):
                 self.visual_texts[timestamp_millis] = [t.strip().strip("\"") for t in text.replace("\n","").split(",")]
             self.visual_captions[timestamp_millis] = caption
 
-    def extract_scenes_from_vqa(self):
+    def score_frame_novelty(self):
+        # Novelty of each VQA frame compared to the previous one, from 0 for the same image to 1 for an unrelated image.
+        # It takes the larger of the difference hash distance, which follows the structure, and the color histogram distance.
+        self.frame_novelty = {}
+        previous_timestamp_millis = None
+        for timestamp_millis in sorted(self.frame_timestamps_millis):
+            if previous_timestamp_millis is None:
+                self.frame_novelty[timestamp_millis] = 1.0
+            else:
+                hash_distance = (self.frame_hashes[timestamp_millis] ^ self.frame_hashes[previous_timestamp_millis]).bit_count() / 64
+                histogram_distance = 0.5 * sum(abs(a - b) for a, b in zip(self.frame_histograms[timestamp_millis], self.frame_histograms[previous_timestamp_millis]))
+                self.frame_novelty[timestamp_millis] = max(hash_distance, histogram_distance)
+            previous_timestamp_millis = timestamp_millis
+
+    def extract_scenes_from_vqa(self, timestamps_millis: list[int] = None):
+        # Analyzes the given frames, or all frames going to VQA
+        if timestamps_millis is None: timestamps_millis = self.frame_timestamps_millis
+        self.score_frame_novelty()
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel_degree*15) as executor:
-            executor.map(self._extract_scene_from_vqa, self.frame_bytes)
+            executor.map(lambda t: self._consume_frame(t, FrameStore.consumer_vqa, self._extract_scene_from_vqa), timestamps_millis)
+        self.report_vqa_models()
+
+    def is_deadline_near(self) -> bool:
+        return self.deadline is not None and time.time() + FrameWorkScheduler.default_work_seconds > self.deadline
+
+    def analyze_frames_by_deadline(self):
+        # Face detection and VQA share one priority queue, ranked by novelty, text and person presence, and coverage of the timeline.
+        # Work which would end past the deadline is skipped, and the outputs are generated from the frames analyzed by then.
+        self.score_frame_novelty()
+        scheduler = FrameWorkScheduler(self.deadline, self.parallel_degree*15)
+        person_frame_timestamps_millis = set(self.person_frame_timestamps_millis) if self.label_detection_enabled else set()
+        # Face detection goes through the same mosaic groups as without a deadline, each group being one piece of work keyed by its first frame.
+        # With the video-level face jobs, the faces are already known and no frame is recognized.
+        face_groups: dict[int, list[int]] = {}
+        if self.label_detection_enabled and not self.is_video_face_detection_enabled():
+            recognized_timestamps_millis = self.track_faces()
+            groups = self.group_for_mosaic(recognized_timestamps_millis) if celebrity_mosaic_tiles > 1 else [[t] for t in recognized_timestamps_millis]
+            face_groups = {group[0]: group for group in groups}
+        def skip(consumer: str):
+            return lambda t: self.frame_store.release(t, consumer)
+        def detect_faces(group: list[int]):
+            return lambda t: self._detect_faces_and_celebrities_in_mosaic(group)
+        def skip_faces(group: list[int]):
+            def release_group(t: int):
+                for timestamp_millis in group: self.frame_store.release(timestamp_millis, FrameStore.consumer_faces)
+            return release_group
+
+        coverage_priorities = FrameWorkScheduler.get_coverage_priorities(self.frame_timestamps_millis)
+        for t in self.frame_timestamps_millis:
+            priority = FrameWorkScheduler.get_priority(
+                novelty=self.frame_novelty.get(t, 1.0),
+                has_text=t in self.text_frame_timestamps_millis,
+                has_person=t in person_frame_timestamps_millis,
+                coverage=coverage_priorities[t]
+            )
+            scheduler.push(priority, FrameStore.consumer_vqa, t, lambda t: self._consume_frame(t, FrameStore.consumer_vqa, self._extract_scene_from_vqa), skip(FrameStore.consumer_vqa))
+        coverage_priorities = FrameWorkScheduler.get_coverage_priorities(list(face_groups))
+        for t, group in face_groups.items():
+            priority = FrameWorkScheduler.get_priority(has_person=True, coverage=coverage_priorities[t])
+            scheduler.push(priority, FrameStore.consumer_faces, t, detect_faces(group), skip_faces(group))
+        scheduler.run()
+        self.propagate_face_tracks()
+        self.report_vqa_models()
+
+        # The largest gap between analyzed VQA frames tells how much of the timeline went without a scene description
+        # In sharded analysis, the gaps are measured within the time range of this shard
+        shard_start_millis, shard_stop_millis = self.get_shard_range_millis()
+        analyzed_timestamps_millis = sorted(scheduler.completed.get(FrameStore.consumer_vqa, []))
+        gaps_millis = [b - a for a, b in zip([shard_start_millis] + analyzed_timestamps_millis, analyzed_timestamps_millis + [shard_stop_millis])]
+        self.run_report["deadline"] = {
+            "deadline": datetime.fromtimestamp(self.deadline, tz=timezone.utc).isoformat(),
+            "vqa_frames": len(self.frame_timestamps_millis),
+            "vqa_frames_analyzed": len(analyzed_timestamps_millis),
+            "face_frames": sum(len(group) for group in face_groups.values()),
+            "face_frames_analyzed": sum(len(face_groups[t]) for t in scheduler.completed.get(FrameStore.consumer_faces, [])),
+            "largest_gap_millis": max(gaps_millis)
+        }
+        logging.info(f"Frame analysis by deadline: {self.run_report['deadline']}")
+
+    def report_vqa_models(self):
+        vqa_models: dict[str, dict] = {}
+        for model_id, latency_millis in self.vqa_calls:
+            vqa_models.setdefault(model_id, {"frames": 0, "total_latency_millis": 0})
+            vqa_models[model_id]["frames"] += 1
+            vqa_models[model_id]["total_latency_millis"] += latency_millis
+        for model_id, model_calls in vqa_models.items():
+            model_calls["average_latency_millis"] = int(model_calls.pop("total_latency_millis") / model_calls["frames"])
+        self.run_report["vqa_models"] = vqa_models
+
+    def store_run_report(self):
+        # In sharded analysis, the shard reports are carried in the shard results, and the reduce step stores them within the report of the whole video.
+        self.s3_client.put_object(
+            Body=json.dumps(self.run_report, indent=2),
+            Bucket=self.bucket_name,
+            Key=f"{run_report_folder}/{self.video_path}.json"
+        )
     
     def wait_for_dependencies(self):
-        if label_detection_enabled:
+        if self.label_detection_enabled:
             self.wait_for_rekognition_label_detection(sort_by="TIMESTAMP")
-        if transcription_enabled:
+        if self.is_video_face_detection_enabled():
+            self.wait_for_rekognition_face_jobs()
+        # With speech detection, the transcription job is not started yet
+        if self.transcription_enabled and self.transcription_job_name != "":
             self.wait_for_transcription_job()
 
+    def remove_video_file(self):
+        # Speech detection reads the whole file, so it is finished before the download is cancelled
+        if self.speech_detection_thread is not None:
+            self.speech_detection_thread.join()
+            self.speech_detection_thread = None
+        if self.video_download is not None:
+            self.video_download.cancel()
+            self.video_download = None
+        if self.video_directory != "":
+            shutil.rmtree(self.video_directory, ignore_errors=True)
+            self.video_directory = ""
+
     def run(self):
         self.retrieve_config()
         self.retrieve_prompts()
-        self.download_video_and_load_metadata()
-        if label_detection_enabled:
-            self.iterate_object_detection_result()
-        self.extract_frames()
-        if label_detection_enabled:
-            self.detect_faces_and_celebrities()
-        self.extract_scenes_from_vqa()
-        if transcription_enabled:
+        try:
+            try:
+                self.download_video_and_load_metadata()
+                if analysis_deadline_seconds > 0:
+                    self.deadline = self.video_download.last_modified.timestamp() + analysis_deadline_seconds - analysis_deadline_reserve_seconds
+                self.frame_budget_plan = self.plan_frame_budget(*self.get_shard_range_millis())
+                self.start_speech_detection()
+                if self.label_detection_enabled:
+                    self.iterate_object_detection_result()
+                if self.is_video_face_detection_enabled():
+                    # Faces and celebrities come from the video-level Rekognition jobs, so no frame is extracted for them
+                    self.iterate_face_detection_results()
+                    self.person_timestamps_millis = []
+                self.extract_frames()
+                self.align_video_findings()
+                # The video file is no longer needed once the frames are extracted, unless more frames are sampled after the first VQA pass.
+                # While speech detection still reads the file, it is kept until the frames are analyzed, so that the frame analysis does not wait for the speech detection.
+                if not self.is_refining() and (self.speech_detection_thread is None or not self.speech_detection_thread.is_alive()):
+                    self.remove_video_file()
+                # Frames matching an already analyzed video take that video's results and are not sent for analysis again
+                if fingerprint_enabled:
+                    self.reuse_matching_analysis()
+                if self.deadline is not None:
+                    self.analyze_frames_by_deadline()
+                else:
+                    if self.label_detection_enabled and not self.is_video_face_detection_enabled():
+                        self.detect_faces_and_celebrities()
+                    self.extract_scenes_from_vqa()
+                if self.is_refining():
+                    self.refine_sampling()
+            finally:
+                self.remove_video_file()
+        finally:
+            # The frames are no longer needed once consumed by face detection and VQA
+            if self.frame_store is not None:
+                self.frame_store.close()
+                self.frame_store = None
+        if fingerprint_enabled:
+            self.store_fingerprint()
+            # In sharded analysis, the reduce step stores the frame results of the whole video
+            if self.shard_count <= 1:
+                self.store_frame_results()
+        # In sharded analysis, the transcription is fetched once by the reduce step instead of by every shard.
+        if self.transcription_enabled and self.transcription_job_name != "" and self.shard_count <= 1:
+            self.wait_for_transcription_job()
+            self.fetch_transcription()
+        return self.visual_objects, self.visual_scenes, self.visual_captions, self.visual_texts, self.transcript, self.celebrities, self.faces
+
+    def get_preprocessing_result(self, include=lambda timestamp_millis: True) -> dict:
+        def included(items: dict) -> dict:
+            return {str(t): v for t, v in items.items() if include(t)}
+
+        return {
+            "video_duration_millis": self.video_duration_millis,
+            "visual_objects": {t: [o.to_dict() for o in v] for t, v in included(self.visual_objects).items()},
+            "visual_scenes": included(self.visual_scenes),
+            "visual_captions": included(self.visual_captions),
+            "visual_texts": included(self.visual_texts),
+            "celebrities": {t: [c.to_dict() for c in v] for t, v in included(self.celebrities).items()},
+            "faces": {t: [f.to_dict() for f in v] for t, v in included(self.faces).items()}
+        }
+
+    def apply_preprocessing_result(self, result: dict, offset_millis: int = 0, include=lambda timestamp_millis: True, include_visual_objects: bool = True):
+        # Adds the per-timestamp findings of a stored result, shifted by offset_millis, for the timestamps accepted by include
+        def shifted(items: dict) -> dict:
+            return {int(t) + offset_millis: v for t, v in items.items() if include(int(t) + offset_millis)}
+
+        if include_visual_objects:
+            self.visual_objects.update({t: [ObjectFinding(**o) for o in v] for t, v in shifted(result["visual_objects"]).items()})
+        self.visual_scenes.update(shifted(result["visual_scenes"]))
+        self.visual_captions.update(shifted(result["visual_captions"]))
+        self.visual_texts.update(shifted(result["visual_texts"]))
+        self.celebrities.update({t: [CelebrityFinding(c) for c in v] for t, v in shifted(result["celebrities"]).items()})
+        self.faces.update({t: [FaceFinding(f) for f in v] for t, v in shifted(result["faces"]).items()})
+
+    def store_shard_result(self):
+        shard_result: dict = self.get_preprocessing_result(include=self.is_in_shard)
+        shard_result["shard_index"] = self.shard_index
+        shard_result["run_report"] = self.run_report
+
+        self.s3_client.put_object(
+            Body=json.dumps(shard_result),
+            Bucket=self.bucket_name,
+            Key=f"{self.shard_s3_prefix}/{self.shard_index}.json"
+        )
+
+    def load_shard_results(self):
+        # The shards have disjoint time ranges, so merging is a plain union of the per-timestamp dictionaries.
+        for index in range(self.shard_count):
+            shard_key = f"{self.shard_s3_prefix}/{index}.json"
+            shard_result_file: dict = self.s3_client.get_object(Bucket=self.bucket_name, Key=shard_key)
+            shard_result: dict = json.loads(shard_result_file['Body'].read().decode('utf-8'))
+
+            self.video_duration_millis = max(self.video_duration_millis, int(shard_result["video_duration_millis"]))
+            self.apply_preprocessing_result(shard_result)
+            self.run_report.setdefault("shards", []).append(shard_result.get("run_report", {}))
+
+        self.video_duration_seconds = self.video_duration_millis/1000
+
+        # Shard results are intermediate data, so remove them once merged.
+        for index in range(self.shard_count):
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=f"{self.shard_s3_prefix}/{index}.json")
+
+    def store_frame_results(self):
+        # Per-frame results of the whole video, to be reused by later videos with matching fingerprint
+        self.s3_client.put_object(
+            Body=json.dumps(self.get_preprocessing_result()),
+            Bucket=self.bucket_name,
+            Key=f"{frame_analysis_folder}/{self.video_path}.json"
+        )
+
+    def store_fingerprint(self):
+        shard_start_millis, shard_stop_millis = self.get_shard_range_millis()
+        fingerprints: list[self.VideoFingerprints] = []
+        for timestamp_millis, frame_hash in self.frame_hashes.items():
+            if not self.is_in_shard(timestamp_millis): continue
+            bands = VideoFingerprint.get_bands(frame_hash)
+            fingerprints.append(self.VideoFingerprints(
+                video_name=self.video_path,
+                timestamp_millis=timestamp_millis,
+                frame_hash=VideoFingerprint.to_signed(frame_hash),
+                hash_band_0=bands[0],
+                hash_band_1=bands[1],
+                hash_band_2=bands[2],
+                hash_band_3=bands[3]
+            ))
+
+        # Replace the fingerprint of any previous upload with the same name, within this shard's time range
+        delete_stmt = delete(self.VideoFingerprints).where(self.VideoFingerprints.video_name == self.video_path)
+        if self.shard_count > 1:
+            delete_stmt = delete_stmt.where(self.VideoFingerprints.timestamp_millis >= shard_start_millis)
+            if self.shard_index < self.shard_count - 1:
+                delete_stmt = delete_stmt.where(self.VideoFingerprints.timestamp_millis < shard_stop_millis)
+
+        with Session() as session, session.begin():
+            session.execute(delete_stmt)
+            session.add_all(fingerprints)
+
+    def reuse_matching_analysis(self):
+        # Look up frames of other videos with a hash sharing at least one band with this video's frame hashes, and keep those within the Hamming distance in the database, so that only matching frames are read.
+        # The frames are looked up in batches joined against their hashes, so that each query stays small on long videos.
+        frame_hashes: dict[int, int] = {t: h for t, h in self.frame_hashes.items() if VideoFingerprint.is_informative(h)}
+        if len(frame_hashes) == 0: return
+
+        band_columns = [self.VideoFingerprints.hash_band_0, self.VideoFingerprints.hash_band_1, self.VideoFingerprints.hash_band_2, self.VideoFingerprints.hash_band_3]
+        distinct_hashes: list[int] = sorted(set(frame_hashes.values()))
+        candidates: set[tuple[str, int, int]] = set()
+        with Session() as session:
+            for i in range(0, len(distinct_hashes), VideoFingerprint.lookup_batch_size):
+                probes = values(
+                    column("frame_hash", BigInteger), *[column(f"hash_band_{band_number}", Integer) for band_number in range(VideoFingerprint.number_of_bands)],
+                    name="probes"
+                ).data([(VideoFingerprint.to_signed(h), *VideoFingerprint.get_bands(h)) for h in distinct_hashes[i:i + VideoFingerprint.lookup_batch_size]])
+                select_stmt = select(self.VideoFingerprints.video_name, self.VideoFingerprints.timestamp_millis, self.VideoFingerprints.frame_hash).distinct().join(
+                    probes, or_(*[band_column == probes.c[f"hash_band_{band_number}"] for band_number, band_column in enumerate(band_columns)])
+                ).where(
+                    self.VideoFingerprints.video_name != self.video_path,
+                    func.bit_count(cast(self.VideoFingerprints.frame_hash.op("#")(probes.c.frame_hash), BIT(64))) <= VideoFingerprint.max_hamming_distance
+                )
+                candidates.update((video_name, timestamp_millis, VideoFingerprint.to_unsigned(frame_hash)) for video_name, timestamp_millis, frame_hash in session.execute(select_stmt))
+
+        match = VideoFingerprint.find_best_match(frame_hashes, list(candidates), self.frame_interval)
+        if match is None: return
+        matched_video_name, offset_millis, matched_timestamps_millis = match
+
+        try:
+            frame_results_file: dict = self.s3_client.get_object(Bucket=self.bucket_name, Key=f"{frame_analysis_folder}/{matched_video_name}.json")
+        except self.s3_client.exceptions.NoSuchKey:
+            return # The matched video's analysis has not completed yet
+        frame_results: dict = json.loads(frame_results_file['Body'].read().decode('utf-8'))
+
+        matched_ranges = VideoFingerprint.get_matched_ranges(matched_timestamps_millis, self.frame_interval)
+        def in_matched_ranges(timestamp_millis: int) -> bool:
+            return self.is_in_shard(timestamp_millis) and any(start <= timestamp_millis <= stop for start, stop in matched_ranges)
+
+        # Visual objects come from this video's own label detection, so only the frame-level VQA and face results are reused
+        self.apply_preprocessing_result(frame_results, offset_millis=offset_millis, include=in_matched_ranges, include_visual_objects=False)
+        for timestamp_millis in filter(in_matched_ranges, self.frame_timestamps_millis):
+            self.frame_store.release(timestamp_millis, FrameStore.consumer_vqa)
+        for timestamp_millis in filter(in_matched_ranges, self.person_frame_timestamps_millis):
+            self.frame_store.release(timestamp_millis, FrameStore.consumer_faces)
+        self.frame_timestamps_millis = [t for t in self.frame_timestamps_millis if not in_matched_ranges(t)]
+        self.person_frame_timestamps_millis = [t for t in self.person_frame_timestamps_millis if not in_matched_ranges(t)]
+
+        logging.info(f"Reusing analysis of {matched_video_name} shifted by {offset_millis} milliseconds for {len(matched_timestamps_millis)} of {len(frame_hashes)} frames")
+
+    def run_reduce(self):
+        self.load_shard_results()
+        if fingerprint_enabled:
+            self.store_frame_results()
+        if self.transcription_enabled and self.transcription_job_name == "":
+            # With speech detection, the first shard started the transcription job if the video has speech
+            self.transcription_job_name = next((report["speech"]["transcription_job_name"] for report in self.run_report.get("shards", []) if "speech" in report), "")
+        if self.transcription_enabled and self.transcription_job_name != "":
+            self.wait_for_transcription_job()
             self.fetch_transcription()
         return self.visual_objects, self.visual_scenes, self.visual_captions, self.visual_texts, self.transcript, self.celebrities, self.faces
 
@@ -500,7 +2307,15 @@ class VideoPreprocessorBedrockVQA(VideoPreprocessor):
         video_s3_path: str,
         video_transcript_s3_path: str,
         frame_interval: str,
-        vqa_model_name: str
+        vqa_model_name: str,
+        vqa_fast_model_name: str = "",
+        shard_index: int = 0,
+        shard_count: int = 1,
+        label_detection_enabled: bool = True,
+        transcription_enabled: bool = True,
+        celebrity_recognition_job_id: str = "",
+        face_detection_job_id: str = "",
+        speech_detection_enabled: bool = False
         ):
 
         super().__init__(label_detection_job_id=label_detection_job_id,
@@ -508,10 +2323,18 @@ class VideoPreprocessorBedrockVQA(VideoPreprocessor):
             bucket_name=bucket_name,
             video_s3_path=video_s3_path,
             video_transcript_s3_path=video_transcript_s3_path,
-            frame_interval=frame_interval
+            frame_interval=frame_interval,
+            shard_index=shard_index,
+            shard_count=shard_count,
+            label_detection_enabled=label_detection_enabled,
+            transcription_enabled=transcription_enabled,
+            celebrity_recognition_job_id=celebrity_recognition_job_id,
+            face_detection_job_id=face_detection_job_id,
+            speech_detection_enabled=speech_detection_enabled
         )
 
         self.vqa_model_name = vqa_model_name
+        self.vqa_fast_model_name = vqa_fast_model_name
         self.inferenceConfig = {  
             "maxTokens": 2500,
             "temperature": 0
@@ -520,12 +2343,20 @@ class VideoPreprocessorBedrockVQA(VideoPreprocessor):
             "top_k": 1
         }
     
-    def call_vqa(self, image_data: bytes) -> str:
+    def get_vqa_model_name(self, timestamp_millis: int) -> str:
+        # Frames with text or with new content go to the primary model. Frames repeating the previous frame go to the fast model.
+        if self.vqa_fast_model_name == "": return self.vqa_model_name
+        if timestamp_millis in self.text_frame_timestamps_millis: return self.vqa_model_name
+        if self.frame_novelty.get(timestamp_millis, 1.0) >= vqa_novelty_threshold: return self.vqa_model_name
+        return self.vqa_fast_model_name
+
+    def call_vqa(self, image_data: bytes, timestamp_millis: int = 0) -> str:
+        model_name = self.get_vqa_model_name(timestamp_millis)
         messages = copy.deepcopy(self.visual_extraction_prompt_template['chat']['messages'])
         messages[0]['content'].insert(0, 
             {
                 'image': {
-                    'format': 'jpeg',
+                    'format': get_image_format(image_data),
                     'source': {
                         'bytes': image_data
                     }
@@ -536,12 +2367,14 @@ class VideoPreprocessorBedrockVQA(VideoPreprocessor):
         call_done = False
         while(not call_done):
             try:
+                call_start = time.time()
                 bedrock_response = self.bedrock_client.converse(
-                    modelId=self.vqa_model_name,
+                    modelId=model_name,
                     messages=messages,
                     inferenceConfig=self.inferenceConfig,
                     additionalModelRequestFields=self.additionalModelRequestFields
                 )
+                self.vqa_calls.append((model_name, int((time.time() - call_start) * 1000)))
                 call_done = True
             except self.bedrock_client.exceptions.ThrottlingException as e:
                 logging.warning("Amazon Bedrock throttling exception")
@@ -555,6 +2388,9 @@ class VideoPreprocessorBedrockVQA(VideoPreprocessor):
         return response
     
 class VideoAnalyzer(ABC):
+    s3_client = boto3.client("s3")
+    transcribe_client = boto3.client("transcribe")
+
     def __init__(self, 
         bucket_name: str,
         video_name: str, 
@@ -563,21 +2399,26 @@ class VideoAnalyzer(ABC):
         visual_scenes: dict[int, str], 
         visual_captions: dict[int, str],
         visual_texts: dict[int, list[str]], 
-        transcript: dict,
+        transcript: list[tuple[int, Union[int, None], Union[str, None], str]],
         celebrities: dict[int, list[str]],
         faces: dict[int, list[str]],
         summary_folder: str,
         entity_sentiment_folder: str,
         video_script_folder: str,
         transcription_job_name: str,
+        transcription_enabled: bool = True,
+        content_hash: str = "",
+        content_size: int = 0
         ):
 
-        self.s3_client = boto3.client("s3")
-        self.transcribe_client = boto3.client("transcribe")
+        self.session = Session() # Own session per video, as concurrent videos in worker mode must not share one
         self.bucket_name: str = bucket_name
         self.summary_folder: str = summary_folder
         self.entity_sentiment_folder: str = entity_sentiment_folder
         self.transcription_job_name: str = transcription_job_name
+        self.transcription_enabled: bool = transcription_enabled
+        self.content_hash: str = content_hash
+        self.content_size: int = content_size
         self.video_script_folder: str = video_script_folder
         self.video_caption_folder: str = video_caption_folder
         self.video_name: str = video_name
@@ -586,7 +2427,7 @@ class VideoAnalyzer(ABC):
         self.original_visual_scenes: dict[int, str] = visual_scenes
         self.original_visual_captions: dict[int, str] = visual_captions
         self.original_visual_texts: dict[int, list[str]] = visual_texts
-        self.original_transcript: dict = transcript
+        self.original_transcript: list[tuple[int, Union[int, None], Union[str, None], str]] = transcript
         self.original_celebrities: dict[int, list[CelebrityFinding]] = celebrities
         self.original_faces: dict[int, list[FaceFinding]] = faces
         self.visual_objects: list[list[Union[int, list[str]]]] = []
@@ -596,6 +2437,7 @@ class VideoAnalyzer(ABC):
         self.transcript: list[list[Union[int, str]]] = []
         self.celebrities:list[list[Union[int, list[str]]]]  = []
         self.faces: list[list[Union[int, list[str]]]]  = []
+        self.timeline_gap_tolerance: float = 1.5 # Entries of a type further apart than this multiple of their usual interval are not merged, as the content was absent in between
         self.video_script_chunk_size_for_summary_generation: int = 100000 # characters
         self.video_script_chunk_overlap_for_summary_generation: int = 500 # characters
         self.video_script_chunk_size_for_entities_extraction: int = 50000 #10000 # characters
@@ -638,6 +2480,13 @@ class VideoAnalyzer(ABC):
         chunk = Column(Text, nullable=False)
         chunk_embedding = Column(Vector(int(embedding_dimension))) 
         video_name = Column(ForeignKey(f"{video_table_name}.name"), nullable=False)
+
+    class ContentHashes(Base):
+        __tablename__ = content_hash_table_name
+
+        content_hash = Column(String(200), primary_key=True, nullable=False)
+        content_size = Column(BigInteger, primary_key=True, nullable=False)
+        video_name = Column(ForeignKey(f"{video_table_name}.name"), nullable=False)
   
     @abstractmethod
     def call_llm(self, system_prompt, prompt, prefilled_response):
@@ -692,32 +2541,19 @@ class VideoAnalyzer(ABC):
         self.visual_texts = sorted(visual_texts_across_timestamps.items())
 
     def preprocess_transcript(self):
-        transcript= dict()
-        previous_millis: int = 0
-        if "results" in self.original_transcript and "items" in self.original_transcript['results']:
-            for item in self.original_transcript["results"]["items"]:
-                if item['type'] == 'punctuation':
-                    current_millis = previous_millis + 1 # Just add 1 millisecond to avoid this punctuation replaces the previous word.
-                    transcript[current_millis] = item['alternatives'][0]['content']
-                else:
-                    try:
-                        time_millis: int = int(float(item['start_time'])*1000) # In millisecond
-                        content: str = ""
-                        
-                        if "speaker_label" in item:
-                            match = re.search(r"spk_(\d+)", item['speaker_label'])
-                            speaker_number = int(match.group(1)) + 1 # So that it starts from 1, not 0
-                            content += f" Speaker {speaker_number} "
-                        if "language_code" in item:
-                            content += f"in {item['language_code']}"
+        # Each utterance is one line at its start time, with the speaker and language given once
+        transcript: dict[int, str] = {}
+        for start_millis, speaker_number, language_code, text in self.original_transcript:
+            content: str = ""
+
+            if speaker_number is not None:
+                content += f" Speaker {speaker_number} "
+            if language_code is not None:
+                content += f"in {language_code}"
 
-                        content += f": {item['alternatives'][0]['content']}"
+            content += f": {text}"
 
-                        transcript[time_millis] = content
-                        previous_millis = time_millis
-                    except Exception as e:
-                        logging.error("Error in transcribing") 
-                        raise e
+            transcript[start_millis] = content
 
         self.transcript = sorted(transcript.items())
 
@@ -740,12 +2576,37 @@ class VideoAnalyzer(ABC):
             return (timestamp, f"Voice:{transcript}")
         transcript  = list(map(transform_transcript, self.transcript))
 
-        # Combine all inputs
-        combined_visual_captions = sorted( captions + transcript )
-        
-        combined_visual_captions = "\n".join(list(map(lambda x: f"{x[0]}:{x[1]}", combined_visual_captions)))
-        
-        self.combined_visual_captions = combined_visual_captions
+        # Combine all inputs. Consecutive near-identical captions become one line over their time range, while each utterance stays a line of its own.
+        combined_visual_captions = self.compact_timeline(captions, timeline_similarity_threshold) + [(t, t, text) for t, text in transcript]
+
+        self.combined_visual_captions = self.format_timeline(combined_visual_captions)
+
+    def compact_timeline(self, entries: list[tuple[float, str]], similarity_threshold: float = 1.0) -> list[tuple[float, float, str]]:
+        # Run-length encode the entries of one type, in time order, into (start, stop, text) ranges. An entry joins the current range when it has the same text, or a similar one below a threshold of 1, as the first entry of the range.
+        # The words of similar entries missing from the range so far are appended to its text, so that no detail of the later frames is dropped.
+        # The range is broken where the next entry is further away than usual for this type, since the content was absent in the frames in between.
+        if len(entries) == 0: return []
+        intervals = sorted(b[0] - a[0] for a, b in zip(entries, entries[1:]))
+        max_gap = self.timeline_gap_tolerance * intervals[len(intervals) // 2] if len(intervals) > 0 else 0
+
+        ranges: list[list] = [] # Start, stop, text of the first entry, words added by the later entries, and all lowercase words of the range
+        for timestamp, text in entries:
+            if len(ranges) > 0 and timestamp - ranges[-1][1] <= max_gap and (text == ranges[-1][2] or (similarity_threshold < 1.0 and token_jaccard_similarity(text, ranges[-1][2]) >= similarity_threshold)):
+                ranges[-1][1] = timestamp
+                for word in re.findall(r"\w+", text):
+                    if word.lower() in ranges[-1][4]: continue
+                    ranges[-1][3].append(word)
+                    ranges[-1][4].add(word.lower())
+            else:
+                ranges.append([timestamp, timestamp, text, [], set(re.findall(r"\w+", text.lower()))])
+        return [(start, stop, f"{text} (also: {' '.join(added_words)})" if len(added_words) > 0 else text) for start, stop, text, added_words, _ in ranges]
+
+    def format_timeline(self, ranges: list[tuple[float, float, str]]) -> str:
+        # One line per entry, prefixed with its timestamp, or with its time range when it spans several frames
+        return "\n".join(
+            f"{start}-{stop}:{text}" if stop != start else f"{start}:{text}"
+            for start, stop, text in sorted(ranges, key=lambda x: (x[0], x[2]))
+        )
       
     def generate_combined_video_script(self):
         def transform_objects(x):
@@ -784,18 +2645,23 @@ class VideoAnalyzer(ABC):
             return (timestamp, f"Faces:{faces}")
         visual_faces = list(map(transform_faces, self.faces))
  
-        # Combine all inputs
-        combined_video_script = sorted( objects + scenes + visual_texts + transcript + visual_celebrities + visual_faces )
-        
-        combined_video_script = "\n".join(list(map(lambda x: f"{x[0]}:{x[1]}", combined_video_script)))
-        
+        # Combine all inputs. Consecutive identical entries of each type become one line over their time range, and so do near-identical scenes. Each utterance stays a line of its own.
+        combined_video_script = self.compact_timeline(objects) \
+            + self.compact_timeline(scenes, timeline_similarity_threshold) \
+            + self.compact_timeline(visual_texts) \
+            + self.compact_timeline(visual_celebrities) \
+            + self.compact_timeline(visual_faces) \
+            + [(t, t, text) for t, text in transcript]
+
+        combined_video_script = self.format_timeline(combined_video_script)
+
         self.combined_video_script = combined_video_script
         self.all_combined_video_script += combined_video_script
   
     def get_language_code(self):
         language_code: str = 'en'
 
-        if transcription_enabled and self.transcription_job_name != "":
+        if self.transcription_enabled and self.transcription_job_name != "":
             get_transcription = self.transcribe_client.get_transcription_job(TranscriptionJobName=self.transcription_job_name)
         
             language_code_validity_duration_threshold: float = 2.0 # Only consider the language code as valid if the speech is longer than 2 seconds, otherwise it might be invalid data.
@@ -836,7 +2702,7 @@ class VideoAnalyzer(ABC):
         # When the video is short enough to fit into 1 chunk
         if video_script_length <= self.video_script_chunk_size_for_summary_generation:
             core_prompt = f"The VIDEO TIMELINE has format below.\n" \
-                            "timestamp in seconds:scene / text / voice\n" \
+                            "timestamp in seconds, or start-end for the seconds over which it stays the same:scene / text / voice\n" \
                             "<Video Timeline>\n" \
                             f"{self.combined_video_script}\n" \
                             "</Video Timeline>\n"
@@ -870,7 +2736,7 @@ class VideoAnalyzer(ABC):
                         pass
                     
                 core_prompt = f"The VIDEO TIMELINE has format below.\n" \
-                        "timestamp in milliseconds:scene / text / voice\n" \
+                        "timestamp in seconds, or start-end for the seconds over which it stays the same:scene / text / voice\n" \
                         "<Video Timeline>\n" \
                         f"{chunk_combined_video_script}\n" \
                         "</Video Timeline>\n"
@@ -942,7 +2808,7 @@ class VideoAnalyzer(ABC):
         # When the video is short enough to fit into 1 chunk
         if video_script_length <= self.video_script_chunk_size_for_entities_extraction:
             core_prompt = f"The Video Timeline has a format below.\n" \
-                            "timestamp in seconds:scene / text / voice\n" \
+                            "timestamp in seconds, or start-end for the seconds over which it stays the same:scene / text / voice\n" \
                             "<Video Timeline>\n" \
                             f"{self.combined_video_script}\n" \
                             "</Video Timeline>\n"
@@ -985,7 +2851,7 @@ class VideoAnalyzer(ABC):
                         pass
                     
                 core_prompt = f"The VIDEO TIMELINE has format below.\n" \
-                        "timestamp in seconds:scene / text / voice\n" \
+                        "timestamp in seconds, or start-end for the seconds over which it stays the same:scene / text / voice\n" \
                         "<Video Timeline>\n" \
                         f"{chunk_combined_video_script}\n" \
                         "</Video Timeline>\n"
@@ -1086,8 +2952,8 @@ class VideoAnalyzer(ABC):
             values(summary = self.summary, summary_embedding = summary_embedding)
         )
         
-        session.execute(update_stmt)
-        session.commit()
+        self.session.execute(update_stmt)
+        self.session.commit()
 
     def store_sentiment_result(self):
         # Extract entities and sentiment from the string
@@ -1119,8 +2985,8 @@ class VideoAnalyzer(ABC):
             ))
 
         # Store into database
-        session.add_all(entities)
-        session.commit()
+        self.session.add_all(entities)
+        self.session.commit()
         
     def store_video_script_result(self):
         self.s3_client.put_object(
@@ -1160,8 +3026,8 @@ class VideoAnalyzer(ABC):
             ))
 
         # Store in database
-        session.add_all(chunks)
-        session.commit()
+        self.session.add_all(chunks)
+        self.session.commit()
     
     def store_video_visual_captions(self):
         self.s3_client.put_object(
@@ -1185,14 +3051,35 @@ class VideoAnalyzer(ABC):
         self.entities = self.extract_sentiment()
         self.video_script = self.all_combined_video_script
     
+    def store_content_hash(self):
+        # Register the video file content as analyzed, so that identical uploads under other names reuse this analysis. The first analyzed video stays registered.
+        # A previous upload with the same name may have had other content, which this analysis no longer describes.
+        self.session.execute(delete(self.ContentHashes).where(self.ContentHashes.video_name == self.video_path))
+        insert_stmt = db_insert(self.ContentHashes).values(
+            content_hash=self.content_hash,
+            content_size=self.content_size,
+            video_name=self.video_path
+        ).on_conflict_do_nothing()
+
+        self.session.execute(insert_stmt)
+        self.session.commit()
+
     def store(self):
-        self.store_video_visual_captions()
-        self.store_video_script_result()
-        self.store_summary_result()
-        self.store_sentiment_result()
+        try:
+            self.store_video_visual_captions()
+            self.store_video_script_result()
+            self.store_summary_result()
+            self.store_sentiment_result()
+            if self.content_hash != "":
+                self.store_content_hash()
+        finally:
+            self.session.close()
         
 
 class VideoAnalyzerBedrock(VideoAnalyzer):    
+    config = Config(read_timeout=1000) # Extends botocore read timeout to 1000 seconds
+    bedrock_client = boto3.client(service_name="bedrock-runtime", config=config)
+
     def __init__(self, 
         model_name: str,
         embedding_model_name: str,
@@ -1203,18 +3090,18 @@ class VideoAnalyzerBedrock(VideoAnalyzer):
         visual_scenes: dict[int, str], 
         visual_captions: dict[int, str],
         visual_texts: dict[int, list[str]], 
-        transcript: dict,
+        transcript: list[tuple[int, Union[int, None], Union[str, None], str]],
         celebrities: dict[int, list[str]],
         faces: dict[int, list[str]],
         summary_folder: str,
         entity_sentiment_folder: str,
         video_script_folder: str,
-        transcription_job_name: str
+        transcription_job_name: str,
+        transcription_enabled: bool = True,
+        content_hash: str = "",
+        content_size: int = 0
         ):
-        super().__init__(bucket_name, video_name, video_path, visual_objects, visual_scenes, visual_captions, visual_texts, transcript, celebrities, faces,summary_folder, entity_sentiment_folder, video_script_folder, transcription_job_name)
-        
-        config = Config(read_timeout=1000) # Extends botocore read timeout to 1000 seconds
-        self.bedrock_client = boto3.client(service_name="bedrock-runtime", config=config)
+        super().__init__(bucket_name, video_name, video_path, visual_objects, visual_scenes, visual_captions, visual_texts, transcript, celebrities, faces,summary_folder, entity_sentiment_folder, video_script_folder, transcription_job_name, transcription_enabled, content_hash, content_size)
 
         self.model_name = model_name
         self.embedding_model_name = embedding_model_name
@@ -1281,7 +3168,22 @@ class VideoAnalyzerBedrock(VideoAnalyzer):
         embedding = json.loads(response.get("body").read().decode())["embeddings"][0] #["embedding"]
         return embedding
 
-def handler():
+def handler(job: dict = os.environ):
+    # The job carries the per-video parameters with the same names as the environment variables of a single-video task.
+    video_s3_path: str = job['VIDEO_S3_PATH']
+    transcription_job_name: str = job['TRANSCRIPTION_JOB_NAME']
+    label_detection_job_id: str = job['LABEL_DETECTION_JOB_ID']
+    celebrity_recognition_job_id: str = job.get('CELEBRITY_RECOGNITION_JOB_ID', "")
+    face_detection_job_id: str = job.get('FACE_DETECTION_JOB_ID', "")
+    label_detection_enabled: bool = True if job[CONFIG_LABEL_DETECTION_ENABLED] == "1" else False
+    transcription_enabled: bool = True if job[CONFIG_TRANSCRIPTION_ENABLED] == "1" else False
+    speech_detection_enabled: bool = True if job.get(CONFIG_SPEECH_DETECTION_ENABLED, "0") == "1" else False
+    job_analyzer_mode: str = job.get('ANALYZER_MODE', ANALYZER_MODE_FULL)
+    shard_index: int = int(job.get('SHARD_INDEX', "0"))
+    shard_count: int = int(job.get('SHARD_COUNT', "1"))
+    content_hash: str = job.get('CONTENT_HASH', "")
+    content_size: int = int(job.get('CONTENT_SIZE', "0"))
+
     video_name = os.path.basename(video_s3_path)
     video_path= '/'.join(video_s3_path.split('/')[1:])
     video_transcript_s3_path = f"{transcription_folder}/{video_path}.txt"
@@ -1295,13 +3197,40 @@ def handler():
             video_s3_path=video_s3_path,
             video_transcript_s3_path=video_transcript_s3_path,
             frame_interval=frame_interval,
-            vqa_model_name=vqa_model_id
+            vqa_model_name=vqa_model_id,
+            vqa_fast_model_name=vqa_fast_model_id,
+            shard_index=shard_index,
+            shard_count=shard_count if job_analyzer_mode != ANALYZER_MODE_FULL else 1,
+            label_detection_enabled=label_detection_enabled,
+            transcription_enabled=transcription_enabled,
+            celebrity_recognition_job_id=celebrity_recognition_job_id,
+            face_detection_job_id=face_detection_job_id,
+            speech_detection_enabled=speech_detection_enabled
         )
-        # Wait for extraction jobs to finish
-        video_preprocessor.wait_for_dependencies()
-        
-        # Preprocess and extract information
-        visual_objects, visual_scenes, visual_captions, visual_texts, transcript, celebrities, faces = video_preprocessor.run()
+
+        if job_analyzer_mode == ANALYZER_MODE_REDUCE:
+            # Merge the results of all shards, which were preprocessed in parallel by the shard tasks
+            visual_objects, visual_scenes, visual_captions, visual_texts, transcript, celebrities, faces = video_preprocessor.run_reduce()
+        else:
+            # Download the video while waiting for the extraction jobs to finish
+            video_preprocessor.start_video_download()
+            try:
+                video_preprocessor.wait_for_dependencies()
+            except:
+                video_preprocessor.remove_video_file()
+                raise
+
+            # Preprocess and extract information
+            visual_objects, visual_scenes, visual_captions, visual_texts, transcript, celebrities, faces = video_preprocessor.run()
+
+        if job_analyzer_mode == ANALYZER_MODE_SHARD:
+            # The shard result is merged and analyzed later by the reduce task
+            video_preprocessor.store_shard_result()
+            return {
+                'statusCode': 200,
+                'body': json.dumps({"main_analyzer": "success", "shard_index": shard_index})
+            }
+        video_preprocessor.store_run_report()
         
         # Initiate class for video analysis
         video_analyzer = VideoAnalyzerBedrock(
@@ -1320,7 +3249,10 @@ def handler():
             summary_folder=summary_folder,
             entity_sentiment_folder=entity_sentiment_folder,
             video_script_folder=video_script_folder,
-            transcription_job_name=transcription_job_name
+            transcription_job_name=video_preprocessor.transcription_job_name, # Started by the analyzer with speech detection
+            transcription_enabled=transcription_enabled,
+            content_hash=content_hash,
+            content_size=content_size
         )
         # Run video analysis
         video_analyzer.run()
@@ -1337,5 +3269,76 @@ def handler():
         'body': json.dumps({"main_analyzer": "success"})
     }
 
+in_flight_messages: dict[str, dict] = {} # Job messages being processed by this worker, by message ID
+in_flight_messages_lock = threading.Lock()
+
+def send_job_heartbeats(message: dict, task_token: str, done: threading.Event):
+    # Tells the state machine that the job is still in progress, and keeps the message hidden from the other workers.
+    # When a worker crashes, the heartbeats stop, so the message is redelivered to another worker, and the state machine fails the job if no worker takes it over.
+    while not done.wait(job_heartbeat_seconds):
+        try:
+            sfn.send_task_heartbeat(taskToken=task_token)
+            sqs.change_message_visibility(QueueUrl=job_queue_url, ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=job_visibility_timeout_seconds)
+        except Exception as err:
+            logging.warning(f"Heartbeat of job message {message['MessageId']} failed: {err=}")
+
+def process_job_message(message: dict):
+    # The message is sent by the state machine, which waits until the task token is reported back as success or failure.
+    job_message: dict = json.loads(message['Body'])
+    task_token: str = job_message['taskToken']
+    with in_flight_messages_lock:
+        in_flight_messages[message['MessageId']] = message
+    done = threading.Event()
+    threading.Thread(target=send_job_heartbeats, args=(message, task_token, done), daemon=True).start()
+    try:
+        result = handler(job_message['job'])
+        sfn.send_task_success(taskToken=task_token, output=json.dumps(result))
+    except Exception as err:
+        sfn.send_task_failure(taskToken=task_token, error=type(err).__name__, cause=str(err)[:32768])
+    finally:
+        done.set()
+        with in_flight_messages_lock:
+            in_flight_messages.pop(message['MessageId'], None)
+        sqs.delete_message(QueueUrl=job_queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+def release_jobs_and_exit(signum, frame):
+    # ECS stops a worker with SIGTERM, for example on scale-in, and kills it shortly after.
+    # The jobs in progress are made visible in the queue again right away, so that other workers take them over with the same task tokens instead of the state machine waiting for their heartbeats to time out.
+    with in_flight_messages_lock:
+        for message in in_flight_messages.values():
+            try:
+                sqs.change_message_visibility(QueueUrl=job_queue_url, ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=0)
+            except Exception as err:
+                logging.error(f"Could not release job message {message['MessageId']}: {err=}")
+        logging.info(f"Analyzer worker stopped, released {len(in_flight_messages)} jobs")
+    os._exit(0)
+
+def worker():
+    # Clients, the database connection pool, the prompt template cache and the decode pool are created once and stay warm between videos.
+    get_decode_pool()
+    signal.signal(signal.SIGTERM, release_jobs_and_exit)
+    logging.info(f"Analyzer worker started, processing up to {worker_concurrency} videos concurrently from {job_queue_url}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_concurrency) as executor:
+        running_jobs: set[concurrent.futures.Future] = set()
+        while True:
+            # Only pull as many jobs as there are free slots, so that queued jobs remain available to other workers.
+            free_slots = worker_concurrency - len(running_jobs)
+            if free_slots > 0:
+                received = sqs.receive_message(
+                    QueueUrl=job_queue_url,
+                    MaxNumberOfMessages=min(free_slots, 10),
+                    WaitTimeSeconds=20
+                )
+                for message in received.get('Messages', []):
+                    running_jobs.add(executor.submit(process_job_message, message))
+
+            if len(running_jobs) == 0: continue
+            done_jobs, _ = concurrent.futures.wait(running_jobs, timeout=0 if free_slots > 0 else None, return_when=concurrent.futures.FIRST_COMPLETED)
+            running_jobs -= done_jobs
+
 if __name__ == "__main__":
-    handler()
+    if analyzer_mode == ANALYZER_MODE_WORKER:
+        worker()
+    else:
+        handler()
@@ -0,0 +1,71 @@
+import os, re, json, shutil, importlib
+from unittest import mock
+
+import cv2
+import numpy
+import pytest
+
+# The analyzer reads its configuration and the database credentials when it is imported, so these are given placeholder values and the AWS clients are mocked
+for name in ["MODEL_ID", "VQA_MODEL_ID", "EMBEDDING_MODEL_ID", "BUCKET_NAME", "RAW_FOLDER", "VIDEO_SCRIPT_FOLDER", "VIDEO_CAPTION_FOLDER", "TRANSCRIPTION_FOLDER",
+             "ENTITY_SENTIMENT_FOLDER", "SUMMARY_FOLDER", "DATABASE_NAME", "VIDEO_TABLE_NAME", "ENTITIES_TABLE_NAME", "CONTENT_TABLE_NAME", "CONTENT_HASH_TABLE_NAME",
+             "FINGERPRINT_TABLE_NAME", "SECRET_NAME", "DB_WRITER_ENDPOINT", "CONFIG_PARAMETER_NAME"]:
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("FRAME_INTERVAL", "1000")
+os.environ.setdefault("EMBEDDING_DIMENSION", "1024")
+
+@pytest.fixture(scope="module")
+def analyzer():
+    client = mock.MagicMock()
+    client.get_secret_value.return_value = {"SecretString": json.dumps({"username": "test", "password": "test"})}
+    with mock.patch("boto3.client", return_value=client):
+        return importlib.import_module("index")
+
+def get_words(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+def test_compact_timeline_keeps_the_words_of_merged_entries(analyzer):
+    video_analyzer = analyzer.VideoAnalyzerBedrock.__new__(analyzer.VideoAnalyzerBedrock)
+    video_analyzer.timeline_gap_tolerance = 1.5
+    entries = [
+        (0.0, "Scene:A man walks a dog in the park"),
+        (1.0, "Scene:A man walks a dog in the park"),
+        (2.0, "Scene:A man walks a brown dog in the park"),
+        (3.0, "Scene:A man walks a brown dog in the sunny park"),
+        (4.0, "Scene:Cars drive on a highway")
+    ]
+    ranges = video_analyzer.compact_timeline(entries, 0.7)
+
+    assert [(start, stop) for start, stop, _ in ranges] == [(0.0, 3.0), (4.0, 4.0)]
+    for timestamp, text in entries:
+        range_text = next(range_text for start, stop, range_text in ranges if start <= timestamp <= stop)
+        assert get_words(text) <= get_words(range_text)
+
+def test_compact_timeline_merges_only_identical_entries_by_default(analyzer):
+    video_analyzer = analyzer.VideoAnalyzerBedrock.__new__(analyzer.VideoAnalyzerBedrock)
+    video_analyzer.timeline_gap_tolerance = 1.5
+    entries = [(0.0, "Objects:Person,Dog"), (1.0, "Objects:Person,Dog"), (2.0, "Objects:Person,Dog,Car")]
+
+    assert video_analyzer.compact_timeline(entries) == [(0.0, 1.0, "Objects:Person,Dog"), (2.0, 2.0, "Objects:Person,Dog,Car")]
+
+def write_video(filename: str, number_of_frames: int, dim: tuple[int, int]):
+    # MPEG-4 Part 2, one of the codecs which FFmpeg decodes at reduced resolution
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"XVID"), 10, dim)
+    for _ in range(number_of_frames):
+        writer.write(numpy.random.randint(0, 256, (dim[1], dim[0], 3), dtype=numpy.uint8))
+    writer.release()
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="The FFmpeg CLI is installed in the analyzer image")
+def test_lowres_decoding_reduces_the_decoded_frame_size(analyzer, tmp_path):
+    filename = str(tmp_path / "video.avi")
+    write_video(filename, 10, (640, 480))
+    decoder = analyzer.FrameDecoder(filename, 1, (512, 512), {kind: (512, 512) for kind in ["text", "detailed", "regular", "simple"]}, 250, [])
+
+    # Without any scaling, a frame decoded at full resolution would be read as four frames of the reduced size
+    frames, damaged = decoder._decode_with_ffmpeg(decoder.get_lowres_options(), ["-frames:v", "1"], (320, 240))
+    assert not damaged
+    assert len(frames) == 1
+    assert frames[0].shape == (240, 320, 3)
+
+    extracted_frames = decoder._extract_lowres_frames([0, 300, 500], {t: analyzer.FRAME_KIND_SHARED for t in [0, 300, 500]})
+    assert sorted(extracted_frames) == [0, 300, 500]
+    assert all(frame[1] is not None for frame in extracted_frames.values())
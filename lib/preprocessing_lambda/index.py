@@ -1,7 +1,7 @@
 import json, os
 import boto3
 from datetime import datetime, timezone
-from sqlalchemy import create_engine, Column, Text, DateTime, String, func
+from sqlalchemy import create_engine, Column, Text, DateTime, String, Integer, BigInteger, ForeignKey, select, delete, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import mapped_column, sessionmaker
 from sqlalchemy.sql import bindparam
@@ -10,15 +10,27 @@ from pgvector.sqlalchemy import Vector
 
 database_name = os.environ['DATABASE_NAME']
 video_table_name = os.environ['VIDEO_TABLE_NAME']
+entities_table_name = os.environ['ENTITIES_TABLE_NAME']
+content_table_name = os.environ['CONTENT_TABLE_NAME']
+content_hash_table_name = os.environ['CONTENT_HASH_TABLE_NAME']
 secret_name = os.environ['SECRET_NAME']
 configuration_parameter_name = os.environ['CONFIGURATION_PARAMETER_NAME']
 writer_endpoint = os.environ['DB_WRITER_ENDPOINT']
 embedding_dimension = os.environ['EMBEDDING_DIMENSION']
+bucket_name = os.environ['BUCKET_NAME']
+raw_folder = os.environ['RAW_FOLDER']
+# Folders of the analysis artifacts which are copied when a duplicate upload reuses the analysis of an identical video. The transcription is stored with the raw folder in its key.
+analysis_artifact_folders = os.environ['ANALYSIS_ARTIFACT_FOLDERS'].split(",")
+transcription_root_folder = os.environ['TRANSCRIPTION_ROOT_FOLDER']
 CONFIG_LABEL_DETECTION_ENABLED = "label_detection_enabled"
 CONFIG_TRANSCRIPTION_ENABLED = "transcription_enabled"
+CONFIG_ANALYSIS_SHARD_COUNT = "analysis_shard_count"
+CONFIG_VIDEO_FACE_DETECTION_ENABLED = "video_face_detection_enabled"
+CONFIG_SPEECH_DETECTION_ENABLED = "speech_detection_enabled"
 
 ssm = boto3.client('ssm')
 secrets_manager = boto3.client('secretsmanager')
+s3 = boto3.client('s3')
 
 credentials = json.loads(secrets_manager.get_secret_value(SecretId=secret_name)["SecretString"])
 username = credentials["username"]
@@ -34,9 +46,87 @@ class Videos(Base):
     uploaded_at = Column(DateTime(timezone=True), nullable=False)
     summary = Column(Text)
     summary_embedding = mapped_column(Vector(int(embedding_dimension)))
+
+class Entities(Base):
+    __tablename__ = entities_table_name
+    
+    id = Column(Integer, primary_key=True) 
+    name = Column(String(100), nullable=False)
+    sentiment = Column(String(20))
+    reason = Column(Text)
+    video_name = Column(ForeignKey(f"{video_table_name}.name"), nullable=False)
+    
+class Contents(Base):
+    __tablename__ = content_table_name
+    
+    id = Column(Integer, primary_key=True)
+    chunk = Column(Text, nullable=False)
+    chunk_embedding = Column(Vector(int(embedding_dimension))) 
+    video_name = Column(ForeignKey(f"{video_table_name}.name"), nullable=False)
+
+class ContentHashes(Base):
+    __tablename__ = content_hash_table_name
+
+    content_hash = Column(String(200), primary_key=True, nullable=False)
+    content_size = Column(BigInteger, primary_key=True, nullable=False)
+    video_name = Column(ForeignKey(f"{video_table_name}.name"), nullable=False)
     
 Session = sessionmaker(bind=engine)  
 session = Session()
+
+def get_content_hash(video_s3_path: str) -> tuple[str, int]:
+    # Use the full object checksum when the uploader provided one, otherwise the ETag. The ETag of a multipart upload also depends on the part size, so identical files uploaded with different part sizes are not detected as duplicates.
+    head = s3.head_object(Bucket=bucket_name, Key=video_s3_path, ChecksumMode='ENABLED')
+    if "ChecksumSHA256" in head and "-" not in head["ChecksumSHA256"]:
+        content_hash = f"sha256:{head['ChecksumSHA256']}"
+    else:
+        content_hash = f"etag:{head['ETag'].strip(chr(34))}"
+    return content_hash, int(head["ContentLength"])
+
+def find_analyzed_duplicate(content_hash: str, content_size: int, video_name: str) -> Videos:
+    # Only a video whose analysis has completed (has a summary) can be the source of the clone
+    statement = select(Videos).join(ContentHashes, ContentHashes.video_name == Videos.name).where(
+        ContentHashes.content_hash == content_hash,
+        ContentHashes.content_size == content_size,
+        Videos.name != video_name,
+        Videos.summary.is_not(None)
+    )
+    return session.execute(statement).scalars().first()
+
+def clone_analysis_artifacts(source_video_name: str, video_name: str):
+    # Copy the analysis artifacts in S3
+    artifact_keys: list[tuple[str, str]] = [(f"{folder}/{source_video_name}.txt", f"{folder}/{video_name}.txt") for folder in analysis_artifact_folders]
+    artifact_keys.append((f"{transcription_root_folder}/{raw_folder}/{source_video_name}.txt", f"{transcription_root_folder}/{raw_folder}/{video_name}.txt"))
+    for source_key, destination_key in artifact_keys:
+        try:
+            s3.copy_object(Bucket=bucket_name, Key=destination_key, CopySource={"Bucket": bucket_name, "Key": source_key})
+        except s3.exceptions.ClientError as e:
+            # Some artifacts are optional e.g. the transcription when transcription is disabled
+            if e.response['Error']['Code'] not in ["NoSuchKey", "404"]: raise e
+
+def clone_analysis_records(source_video: Videos, video_name: str, uploaded_at: datetime):
+    # Copy the summary, entities, and content chunks, replacing those of any previous upload with the same name
+    upsert = db_insert(Videos).values(
+        name=video_name,
+        uploaded_at=uploaded_at,
+        summary=source_video.summary,
+        summary_embedding=source_video.summary_embedding
+    ).on_conflict_do_update(
+        constraint=f"{video_table_name}_pkey",
+        set_={
+            Videos.uploaded_at: uploaded_at,
+            Videos.summary: source_video.summary,
+            Videos.summary_embedding: source_video.summary_embedding
+        }
+    )
+    session.execute(upsert)
+    session.execute(delete(Entities).where(Entities.video_name == video_name))
+    session.execute(delete(Contents).where(Contents.video_name == video_name))
+
+    source_entities = session.execute(select(Entities).where(Entities.video_name == source_video.name)).scalars().all()
+    session.add_all([Entities(name=e.name, sentiment=e.sentiment, reason=e.reason, video_name=video_name) for e in source_entities])
+    source_contents = session.execute(select(Contents).where(Contents.video_name == source_video.name)).scalars().all()
+    session.add_all([Contents(chunk=c.chunk, chunk_embedding=c.chunk_embedding, video_name=video_name) for c in source_contents])
     
 def handler(event, context):
     video_s3_path = event["videoS3Path"]
@@ -73,20 +163,42 @@ def handler(event, context):
     )['Parameter']['Value']
     configuration_parameter = json.loads(configuration_parameter_json)
 
+    analysis_shard_count = max(1, int(configuration_parameter.get(CONFIG_ANALYSIS_SHARD_COUNT, "1")))
 
+    content_hash, content_size = get_content_hash(video_s3_path)
+    date_now = datetime.now(timezone.utc)
+
+    # When an identical file was already analyzed under another name, reuse its analysis instead of analyzing again
+    duplicate_of = ""
     with session.begin():
-        date_now = datetime.now(timezone.utc)
-        session.execute(upsert, {
-            "name": video_name,  
-            "uploaded_at": date_now
-        })
-        session.commit()
+        # The name now holds this upload, so any content registered for a previous upload with the same name is no longer analyzed under it
+        session.execute(delete(ContentHashes).where(ContentHashes.video_name == video_name))
+        source_video = find_analyzed_duplicate(content_hash, content_size, video_name)
+        if source_video is not None:
+            duplicate_of = source_video.name
+            clone_analysis_records(source_video, video_name, date_now)
+        else:
+            session.execute(upsert, {
+                "name": video_name,  
+                "uploaded_at": date_now
+            })
+
+    if duplicate_of != "":
+        clone_analysis_artifacts(duplicate_of, video_name)
 
     return {
         'statusCode': 200,
         'body': {
             "preprocessing": "success",
             CONFIG_LABEL_DETECTION_ENABLED:configuration_parameter[CONFIG_LABEL_DETECTION_ENABLED],
-            CONFIG_TRANSCRIPTION_ENABLED:configuration_parameter[CONFIG_TRANSCRIPTION_ENABLED]
+            CONFIG_TRANSCRIPTION_ENABLED:configuration_parameter[CONFIG_TRANSCRIPTION_ENABLED],
+            CONFIG_VIDEO_FACE_DETECTION_ENABLED:configuration_parameter.get(CONFIG_VIDEO_FACE_DETECTION_ENABLED, "0"),
+            CONFIG_SPEECH_DETECTION_ENABLED:configuration_parameter.get(CONFIG_SPEECH_DETECTION_ENABLED, "0"),
+            CONFIG_ANALYSIS_SHARD_COUNT:str(analysis_shard_count),
+            # The shard indexes are listed as strings so that the state machine can iterate them with a Map state and pass them as environment variables.
+            "analysis_shards": [str(index) for index in range(analysis_shard_count)],
+            "content_hash": content_hash,
+            "content_size": str(content_size),
+            "duplicate_of": duplicate_of
         }
     }
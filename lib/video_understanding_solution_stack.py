@@ -19,6 +19,7 @@ from aws_cdk import (
     aws_kms as _kms,
     aws_stepfunctions as _sfn,
     aws_stepfunctions_tasks as _sfn_tasks,
+    aws_sqs as _sqs,
     aws_codebuild as _codebuild,
     aws_codepipeline as _codepipeline,
     aws_codepipeline_actions as _codepipeline_actions,
@@ -38,7 +39,42 @@ from cdk_nag import AwsSolutionsChecks, NagSuppressions
 
 model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 vqa_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+vqa_fast_model_id = "" # Optional faster model, taking the same request fields as vqa_model_id, for frames repeating the previous frame. Empty to use vqa_model_id for all frames.
+vqa_novelty_threshold = "0.15" # Frames differing from the previous frame by at least this much (from 0 to 1) go to vqa_model_id
 frame_interval = "1000" # milliseconds
+analyzer_worker_count = 0 # Number of long-running analyzer workers. When more than 0, videos are queued to these workers instead of starting one Fargate task per video.
+analyzer_worker_concurrency = "2" # Number of videos each analyzer worker processes concurrently
+analyzer_job_heartbeat_seconds = 60 # How often an analyzer worker reports that a video job is still in progress. A job without a heartbeat for 15 times this long fails.
+analyzer_job_timeout_hours = 12 # A video job of the analyzer workers fails after this long
+video_analysis_timeout_hours = 24 # The analysis of a video fails after this long
+download_chunk_size_mb = "8" # Size of each ranged GET when the analyzer downloads a video
+download_concurrency = "8" # Number of ranged GETs in flight per video
+frame_store_memory_mb = "256" # Memory budget for extracted frames per video. Frames beyond it are spilled to local disk.
+sampling_mode = "all" # Set to "keyframe" to only decode the keyframes nearest to each frame timestamp, which is much faster for very long videos where exact timestamps matter less. Set to "refine" to sample at a coarse interval first, then sample in between down to frame_interval only where the scene changes.
+refinement_coarse_interval_multiple = "8" # In "refine" sampling mode, the first pass samples at this multiple of frame_interval
+refinement_scene_distance = "0.5" # In "refine" sampling mode, word-level Jaccard distance between scene descriptions (from 0 to 1) above which the frames in between are sampled
+refinement_hash_distance = "0.25" # In "refine" sampling mode, fraction of differing frame hash bits above which the frames in between are sampled
+keyframe_tolerance_millis = "" # In keyframe sampling mode, maximum distance from a timestamp to its keyframe. Defaults to the frame interval when empty.
+frame_image_format = "jpeg" # Format of the frames sent to VQA, "jpeg" or "webp". Frames sent to Rekognition are always JPEG.
+frame_image_quality = "75" # Encoding quality of the frames, from 1 to 100
+frame_image_max_bytes = "0" # Byte budget per frame, enforced by lowering the quality. "0" means no budget.
+frame_quality_filter_enabled = "1" # When "1", black, blank, blurry, and solid color frames are not sent to VQA. The thresholds are in the FrameQualityFilter class of the main analyzer.
+vqa_adaptive_resolution_enabled = "1" # When "1", simple frames go to VQA at a smaller size, and, when vqa_image_token_budget is set, frames with text or many details at a larger size within the budget
+vqa_image_token_budget = "0" # Image input tokens for all VQA frames of a video, which the frame sizes shrink to fit. "0" means no budget.
+frame_budget_max_frames = "0" # Maximum VQA frames per video. When set, the frame interval of each video is sized to this budget instead of frame_interval, e.g. denser for short clips and sparser for long videos. "0" means no budget.
+frame_budget_target_seconds = "0" # Target time for the frame analysis of a video. When set, the frame interval grows and the text and person frames are capped to meet it. "0" means no target.
+frame_budget_concurrency = "8" # Number of frames analyzed at the same time, as allowed by the Amazon Bedrock and Amazon Rekognition quotas, used to estimate the completion time
+analysis_deadline_seconds = "0" # Time from the video upload by which the frame analysis stops. Frames are analyzed by priority (novelty, text and person presence, timeline coverage) and the least valuable ones are skipped when the deadline approaches. "0" means no deadline.
+analysis_deadline_reserve_seconds = "120" # Time kept before analysis_deadline_seconds for the summary and the other video-level outputs
+person_segment_max_gap_millis = "1000" # Person detections of the label detection closer than this are merged into one segment
+person_frame_min_interval_millis = "1000" # Minimum time between the frames picked for face detection within a person segment
+celebrity_mosaic_tiles = "4" # Number of person frames tiled into one image per Rekognition celebrity recognition call. Frames with small faces are still sent on their own. "1" sends every frame on its own.
+utterance_max_pause_millis = "1000" # Transcribed words further apart than this start a new utterance, which is one line of the video script
+timeline_similarity_threshold = "0.8" # Consecutive scene and caption descriptions with at least this word overlap (Jaccard similarity) are merged into one time range of the video script. Identical consecutive entries of any type are always merged. "1" merges only identical descriptions.
+face_tracking_enabled = "1" # When "1", faces are tracked across consecutive person frames with a local face detector, and Rekognition is only called where a track starts, ends, or becomes uncertain. The thresholds are in the FaceTracker class of the main analyzer.
+fingerprint_enabled = "1" # When "1", frames matching an already analyzed video (e.g. re-encoded or trimmed copies) reuse that video's frame analysis
+fingerprint_match_threshold = "0.5" # Minimum fraction of a video's frames matching another video for the reuse to apply
+fingerprint_max_hamming_distance = "3" # Maximum differing bits out of the 64-bit frame hash for two frames to match. At most "3", as the hash is looked up by 4 bands of 16 bits, which only guarantee a shared band below 4 differing bits.
 fast_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
 balanced_model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 embedding_model_id = "cohere.embed-multilingual-v3"
@@ -49,14 +85,22 @@ video_caption_folder = "captions"
 transcription_root_folder = "audio_transcript"
 transcription_folder = f"{transcription_root_folder}/{raw_folder}"
 entity_sentiment_folder = "entities"
+analysis_shard_folder = "analysis_shards"
+frame_analysis_folder = "frame_analysis"
+run_report_folder = "run_reports"
 database_name = "videos"
 video_table_name = "videos"
 entities_table_name = "entities"
 content_table_name = "content"
+content_hash_table_name = "content_hashes"
+fingerprint_table_name = "video_fingerprints"
+database_schema_version = "3" # Increase this when the database setup adds tables, so that the setup runs again on stack update
 embedding_dimension = 1024
 video_search_by_summary_acceptable_embedding_distance = 0.50 # Using cosine distance
 videos_api_resource = "videos"
-visual_objects_detection_confidence_threshold = 30.0
+visual_objects_detection_confidence_threshold = 30.0 # Minimum confidence of the labels returned by the label detection job. Raising it shrinks the results, but also drops the less confident "Text" detections which add frames with text.
+label_inclusion_filters: list[str] = [] # Labels returned by the label detection job, e.g. ["Person", "Text", "Car", "Building"]. "Person" and "Text" are always included as the analyzer uses them. Empty for all labels.
+label_aggregate_by = "TIMESTAMPS" # Set to "SEGMENTS" to read one label entry per continuous appearance instead of one per sampled frame, which makes the results of long videos much smaller
 visual_extraction_prompt_name = "vus-visual-extraction-prompt"
 visual_extraction_prompt_variant_name = "claude3"
 visual_extraction_prompt_version_description = "Default version"
@@ -65,6 +109,9 @@ BASE_DIR = os.getcwd()
 CONFIG_LABEL_DETECTION_ENABLED = "label_detection_enabled" # Value is "1" or "0"
 CONFIG_TRANSCRIPTION_ENABLED = "transcription_enabled" # Value is "1" or "0"
 CONFIG_VISUAL_EXTRACTION_PROMPT = "visual_extraction_prompt" # Value is a JSON
+CONFIG_VIDEO_FACE_DETECTION_ENABLED = "video_face_detection_enabled" # Value is "1" or "0". When "1" and label detection is enabled, faces and celebrities come from video-level Rekognition jobs instead of per-frame calls.
+CONFIG_SPEECH_DETECTION_ENABLED = "speech_detection_enabled" # Value is "1" or "0". When "1" and transcription is enabled, the analyzer only starts the transcription job once it finds speech in the audio track.
+CONFIG_ANALYSIS_SHARD_COUNT = "analysis_shard_count" # Value is a number in string e.g. "1". When more than 1, the video timeline is split into this many shards analyzed in parallel.
 
 with open('./lib//main_analyzer/default_visual_extraction_system_prompt.txt', 'r') as file:
     default_visual_extraction_system_prompt = file.read()
@@ -115,6 +162,9 @@ class VideoUnderstandingSolutionStack(Stack):
         default_configuration_parameters = {
             CONFIG_LABEL_DETECTION_ENABLED: "1",
             CONFIG_TRANSCRIPTION_ENABLED: "1",
+            CONFIG_VIDEO_FACE_DETECTION_ENABLED: "0",
+            CONFIG_SPEECH_DETECTION_ENABLED: "0",
+            CONFIG_ANALYSIS_SHARD_COUNT: "1",
             CONFIG_VISUAL_EXTRACTION_PROMPT: {
                 "prompt_id": "",  # Will be updated by custom resource
                 "variant_name": "claude3",  # Default variant
@@ -382,6 +432,8 @@ class VideoUnderstandingSolutionStack(Stack):
                 'VIDEO_TABLE_NAME': video_table_name,
                 'ENTITIES_TABLE_NAME': entities_table_name,
                 'CONTENT_TABLE_NAME': content_table_name,
+                'CONTENT_HASH_TABLE_NAME': content_hash_table_name,
+                'FINGERPRINT_TABLE_NAME': fingerprint_table_name,
                 'SECRET_NAME': self.db_secret_name,
                 "EMBEDDING_DIMENSION": str(embedding_dimension)
             },
@@ -420,7 +472,8 @@ class VideoUnderstandingSolutionStack(Stack):
             id='DatabaseSetup',
             service_token=provider.service_token,
             removal_policy=RemovalPolicy.DESTROY,
-            resource_type="Custom::DatabaseSetupCustomResource"
+            resource_type="Custom::DatabaseSetupCustomResource",
+            properties={"SchemaVersion": database_schema_version}
         )
 
         db_setup_custom_resource.node.add_dependency(aurora_cluster) 
@@ -443,6 +496,30 @@ class VideoUnderstandingSolutionStack(Stack):
                             actions=["ssm:GetParameter"],
                             resources=[configuration_parameters_ssm.parameter_arn],
                             effect=_iam.Effect.ALLOW
+                        ),
+                        _iam.PolicyStatement(
+                            actions=["s3:GetObject", "s3:ListBucket"],
+                            resources=[
+                                video_bucket_s3.bucket_arn,
+                                video_bucket_s3.arn_for_objects(f"{raw_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{summary_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{video_script_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{video_caption_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{entity_sentiment_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{transcription_folder}/*")
+                            ],
+                            effect=_iam.Effect.ALLOW
+                        ),
+                        _iam.PolicyStatement(
+                            actions=["s3:PutObject"],
+                            resources=[
+                                video_bucket_s3.arn_for_objects(f"{summary_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{video_script_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{video_caption_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{entity_sentiment_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{transcription_folder}/*")
+                            ],
+                            effect=_iam.Effect.ALLOW
                         )
                     ]
                 ),
@@ -457,6 +534,7 @@ class VideoUnderstandingSolutionStack(Stack):
         # Suppress cdk_nag it for using * in IAM policy as reasonable in the resources and for using AWSLambdaBasicExecutionRole  and AWSLambdaVPCAccessExecutionRole managed role by AWS.
         NagSuppressions.add_resource_suppressions(preprocessing_lambda_role, [
             { "id": 'AwsSolutions-IAM4', "reason": 'Allow to use AWSLambdaBasicExecutionRole and AWSLambdaVPCAccessExecutionRole AWS managed service role'},
+            { "id": 'AwsSolutions-IAM5', "reason": 'Allow to use <arn>/* for the video and analysis artifact folders since the video file names can vary'},
         ], True)
         
 
@@ -483,9 +561,16 @@ class VideoUnderstandingSolutionStack(Stack):
                 'DB_WRITER_ENDPOINT': self.db_writer_endpoint.hostname,
                 'DATABASE_NAME': database_name,
                 'VIDEO_TABLE_NAME': video_table_name,
+                'ENTITIES_TABLE_NAME': entities_table_name,
+                'CONTENT_TABLE_NAME': content_table_name,
+                'CONTENT_HASH_TABLE_NAME': content_hash_table_name,
                 'SECRET_NAME': self.db_secret_name,
                 'CONFIGURATION_PARAMETER_NAME': configuration_parameters_ssm.parameter_name,
-                'EMBEDDING_DIMENSION': str(embedding_dimension)
+                'EMBEDDING_DIMENSION': str(embedding_dimension),
+                'BUCKET_NAME': video_bucket_s3.bucket_name,
+                'RAW_FOLDER': raw_folder,
+                'ANALYSIS_ARTIFACT_FOLDERS': ",".join([summary_folder, video_script_folder, video_caption_folder, entity_sentiment_folder]),
+                'TRANSCRIPTION_ROOT_FOLDER': transcription_root_folder
             }
         )
         # Add provisioned concurrency configuration
@@ -523,6 +608,7 @@ class VideoUnderstandingSolutionStack(Stack):
                     }
                 },
                 "MinConfidence": visual_objects_detection_confidence_threshold,
+                **({"Settings": {"GeneralLabels": {"LabelInclusionFilters": sorted(set(label_inclusion_filters) | {"Person", "Text"})}}} if len(label_inclusion_filters) > 0 else {})
             },
             result_path="$.startLabelDetectionResult",
             iam_resources=["*"],
@@ -567,6 +653,67 @@ class VideoUnderstandingSolutionStack(Stack):
         start_rekognition_label_detection_sfn_task.next(get_rekognition_label_detection_sfn_task).next(label_detection_choice)
         label_detection_choice.when(label_detection_success_condition, label_detection_success).when(label_detection_failure_condition,label_detection_failure).otherwise(label_detection_wait)
 
+        # Branch which starts a Rekognition Video job for faces or celebrities and waits for it, when both label detection and video-level face detection are enabled.
+        # Like label detection, a failed job does not fail the analysis, and the analyzer skips its results.
+        def rekognition_video_job_branch(id: str, start_action: str, get_action: str, result_key: str, additional_parameters: dict = {}):
+            start_task = _sfn_tasks.CallAwsService(
+                self,
+                f"Start{id}SfnTask",
+                service="rekognition",
+                action=start_action,
+                parameters={
+                    "Video": {
+                        "S3Object": {
+                            "Bucket": video_bucket_s3.bucket_name,
+                            "Name.$": "$.videoS3Path",
+                        }
+                    },
+                    **additional_parameters
+                },
+                result_path=f"$.start{id}Result",
+                iam_resources=["*"],
+                additional_iam_statements=[
+                    _iam.PolicyStatement(
+                        actions=["s3:GetObject", "s3:ListBucket"], 
+                        resources=[
+                            f"arn:aws:s3:::{video_bucket_s3.bucket_name}", 
+                            f"arn:aws:s3:::{video_bucket_s3.bucket_name}/{raw_folder}/*"
+                        ]
+                    )
+                ],
+            )
+            get_task = _sfn_tasks.CallAwsService(
+                self,
+                f"Get{id}SfnTask",
+                service="rekognition",
+                action=get_action,
+                parameters={
+                    "JobId.$": f"$.start{id}Result.JobId",
+                    "MaxResults": 1
+                },
+                result_path=f"$.{result_key}",
+                result_selector={
+                    "JobId.$": "$.JobId",
+                    "JobStatus.$": "$.JobStatus"
+                },
+                iam_resources=["*"],
+            )
+
+            job_success = _sfn.Succeed(self, f"{id} is successful")
+            job_skipped = _sfn.Pass(self, f"{id} is skipped", result_path=f"$.{result_key}", result=_sfn.Result.from_object({"JobId": ""}))
+            job_failure = _sfn.Pass(self, f"{id} is failed, but continuing anyway.", result_path=f"$.{result_key}", result=_sfn.Result.from_object({"JobId": ""}))
+            job_choice = _sfn.Choice(self, f"{id} choice")
+            job_wait = _sfn.Wait(self, f"{id} wait", time=_sfn.WaitTime.duration(Duration.seconds(30))).next(get_task)
+            start_task.next(get_task).next(job_choice)
+            job_choice.when(_sfn.Condition.string_equals(f"$.{result_key}.JobStatus", "SUCCEEDED"), job_success).when(_sfn.Condition.string_equals(f"$.{result_key}.JobStatus", "FAILED"), job_failure).otherwise(job_wait)
+
+            start_choice = _sfn.Choice(self, f"Start{id}Choice")
+            start_choice.when(_sfn.Condition.and_(
+                _sfn.Condition.string_equals(f"$.preprocessingResult.Payload.body.{CONFIG_LABEL_DETECTION_ENABLED}", "1"),
+                _sfn.Condition.string_equals(f"$.preprocessingResult.Payload.body.{CONFIG_VIDEO_FACE_DETECTION_ENABLED}", "1")
+            ), start_task).otherwise(job_skipped)
+            return start_choice
+
         # Step function task to start the Transcribe transcription task to extract human voice and transcribe it
         start_transcription_job_sfn_task = _sfn_tasks.CallAwsService(
             self,
@@ -640,11 +787,21 @@ class VideoUnderstandingSolutionStack(Stack):
         parallel_sfn = parallel_sfn.branch(start_label_detection_choice)
 
         start_transcription_choice = _sfn.Choice(self, "StartTranscriptionChoice")
-        start_transcription_choice.when(_sfn.Condition.string_equals(f"$.preprocessingResult.Payload.body.{CONFIG_TRANSCRIPTION_ENABLED}", "1"), start_transcription_job_sfn_task).otherwise(transcription_skipped)
+        # With speech detection, the analyzer starts the transcription job itself
+        start_transcription_choice.when(_sfn.Condition.and_(
+            _sfn.Condition.string_equals(f"$.preprocessingResult.Payload.body.{CONFIG_TRANSCRIPTION_ENABLED}", "1"),
+            _sfn.Condition.not_(_sfn.Condition.string_equals(f"$.preprocessingResult.Payload.body.{CONFIG_SPEECH_DETECTION_ENABLED}", "1"))
+        ), start_transcription_job_sfn_task).otherwise(transcription_skipped)
         parallel_sfn = parallel_sfn.branch(start_transcription_choice)
 
-        # Chain parallel task after preprocessing lambda
-        preprocessing_task.next(parallel_sfn)
+        parallel_sfn = parallel_sfn.branch(rekognition_video_job_branch("CelebrityRecognition", "startCelebrityRecognition", "getCelebrityRecognition", "celebrityRecognitionResult"))
+        parallel_sfn = parallel_sfn.branch(rekognition_video_job_branch("FaceDetection", "startFaceDetection", "getFaceDetection", "faceDetectionResult", {"FaceAttributes": "ALL"}))
+
+        # Chain parallel task after preprocessing lambda, unless the video is a duplicate of an analyzed one whose analysis has been reused by the preprocessing lambda
+        duplicate_video_skipped = _sfn.Succeed(self, "Duplicate video, analysis is reused")
+        duplicate_video_choice = _sfn.Choice(self, "DuplicateVideoChoice")
+        duplicate_video_choice.when(_sfn.Condition.string_equals("$.preprocessingResult.Payload.body.duplicate_of", ""), parallel_sfn).otherwise(duplicate_video_skipped)
+        preprocessing_task.next(duplicate_video_choice)
 
         # Role for the main video analysis ECS task execution
         main_analyzer_execution_role = _iam.Role(
@@ -685,12 +842,12 @@ class VideoUnderstandingSolutionStack(Stack):
                             effect=_iam.Effect.ALLOW,
                         ),
                         _iam.PolicyStatement(
-                            actions=["rekognition:GetLabelDetection", "rekognition:GetTextDetection", "rekognition:RecognizeCelebrities", "rekognition:DetectFaces"],
+                            actions=["rekognition:GetLabelDetection", "rekognition:GetTextDetection", "rekognition:RecognizeCelebrities", "rekognition:DetectFaces", "rekognition:GetCelebrityRecognition", "rekognition:GetFaceDetection"],
                             resources=["*"],
                             effect=_iam.Effect.ALLOW,
                         ),
                         _iam.PolicyStatement(
-                            actions=["transcribe:GetTranscriptionJob"],
+                            actions=["transcribe:GetTranscriptionJob", "transcribe:StartTranscriptionJob"],
                             resources=[f"arn:aws:transcribe:{aws_region}:{aws_account_id}:transcription-job/*"],
                             effect=_iam.Effect.ALLOW,
                         ),
@@ -709,7 +866,29 @@ class VideoUnderstandingSolutionStack(Stack):
                                 video_bucket_s3.arn_for_objects(f"{summary_folder}/*"),
                                 video_bucket_s3.arn_for_objects(f"{video_script_folder}/*"),
                                 video_bucket_s3.arn_for_objects(f"{video_caption_folder}/*"),
-                                video_bucket_s3.arn_for_objects(f"{entity_sentiment_folder}/*")
+                                video_bucket_s3.arn_for_objects(f"{entity_sentiment_folder}/*"),
+                                video_bucket_s3.arn_for_objects(f"{transcription_folder}/*") # Transcription jobs started by the analyzer write with its permissions
+                            ],
+                            effect=_iam.Effect.ALLOW,
+                        ),
+                        _iam.PolicyStatement(
+                            actions=["s3:PutObject", "s3:GetObject", "s3:DeleteObject"],
+                            resources=[
+                                video_bucket_s3.arn_for_objects(f"{analysis_shard_folder}/*")
+                            ],
+                            effect=_iam.Effect.ALLOW,
+                        ),
+                        _iam.PolicyStatement(
+                            actions=["s3:PutObject", "s3:GetObject"],
+                            resources=[
+                                video_bucket_s3.arn_for_objects(f"{frame_analysis_folder}/*")
+                            ],
+                            effect=_iam.Effect.ALLOW,
+                        ),
+                        _iam.PolicyStatement(
+                            actions=["s3:PutObject"],
+                            resources=[
+                                video_bucket_s3.arn_for_objects(f"{run_report_folder}/*")
                             ],
                             effect=_iam.Effect.ALLOW,
                         ),
@@ -774,47 +953,209 @@ class VideoUnderstandingSolutionStack(Stack):
 
         )
 
-        main_analyzer_task = _sfn_tasks.EcsRunTask(self, "CallMainAnalyzer",
-            integration_pattern=_sfn.IntegrationPattern.RUN_JOB,
-            cluster=ecs_cluster,
-            task_definition=analyzer_task_definition,
-            assign_public_ip=True,
-            launch_target=_sfn_tasks.EcsFargateLaunchTarget(
-                platform_version=_ecs.FargatePlatformVersion.VERSION1_4
-            ),
-            subnets=private_with_egress_subnets,
-            container_overrides=[_sfn_tasks.ContainerOverride(
-                container_definition=analyzer_container_definition,
-                environment=[
-                    _sfn_tasks.TaskEnvironmentVariable(name="VIDEO_S3_PATH", value=_sfn.JsonPath.string_at("$[0].videoS3Path")),
-                    _sfn_tasks.TaskEnvironmentVariable(name="LABEL_DETECTION_JOB_ID", value=_sfn.JsonPath.string_at("$[0].labelDetectionResult.JobId")),
-                    _sfn_tasks.TaskEnvironmentVariable(name="TRANSCRIPTION_JOB_NAME", value=_sfn.JsonPath.string_at("$[1].transcriptionResult.TranscriptionJobName")),
-                    _sfn_tasks.TaskEnvironmentVariable(name=CONFIG_LABEL_DETECTION_ENABLED, value=_sfn.JsonPath.string_at(f"$[0].preprocessingResult.Payload.body.{CONFIG_LABEL_DETECTION_ENABLED}")),
-                    _sfn_tasks.TaskEnvironmentVariable(name=CONFIG_TRANSCRIPTION_ENABLED, value=_sfn.JsonPath.string_at(f"$[0].preprocessingResult.Payload.body.{CONFIG_TRANSCRIPTION_ENABLED}")),
-                    _sfn_tasks.TaskEnvironmentVariable(name='CONFIG_PARAMETER_NAME', value= configuration_parameters_ssm.parameter_name),
-                    _sfn_tasks.TaskEnvironmentVariable(name='DATABASE_NAME', value= database_name),
-                    _sfn_tasks.TaskEnvironmentVariable(name='VIDEO_TABLE_NAME', value= video_table_name),
-                    _sfn_tasks.TaskEnvironmentVariable(name='ENTITIES_TABLE_NAME', value= entities_table_name),
-                    _sfn_tasks.TaskEnvironmentVariable(name='CONTENT_TABLE_NAME', value= content_table_name),
-                    _sfn_tasks.TaskEnvironmentVariable(name='SECRET_NAME', value= self.db_secret_name),
-                    _sfn_tasks.TaskEnvironmentVariable(name="EMBEDDING_DIMENSION", value=str(embedding_dimension)),
-                    _sfn_tasks.TaskEnvironmentVariable(name='DB_WRITER_ENDPOINT', value= self.db_writer_endpoint.hostname),
-                    _sfn_tasks.TaskEnvironmentVariable(name="EMBEDDING_MODEL_ID", value= embedding_model_id),
-                    _sfn_tasks.TaskEnvironmentVariable(name="MODEL_ID", value= model_id),
-                    _sfn_tasks.TaskEnvironmentVariable(name='VQA_MODEL_ID', value= vqa_model_id),
-                    _sfn_tasks.TaskEnvironmentVariable(name="BUCKET_NAME", value= video_bucket_s3.bucket_name),
-                    _sfn_tasks.TaskEnvironmentVariable(name="RAW_FOLDER", value= raw_folder),
-                    _sfn_tasks.TaskEnvironmentVariable(name="VIDEO_SCRIPT_FOLDER", value= video_script_folder),
-                    _sfn_tasks.TaskEnvironmentVariable(name="TRANSCRIPTION_FOLDER", value= transcription_folder),
-                    _sfn_tasks.TaskEnvironmentVariable(name="ENTITY_SENTIMENT_FOLDER", value= entity_sentiment_folder),
-                    _sfn_tasks.TaskEnvironmentVariable(name="SUMMARY_FOLDER", value= summary_folder),
-                    _sfn_tasks.TaskEnvironmentVariable(name="VIDEO_CAPTION_FOLDER", value= video_caption_folder),
-                    _sfn_tasks.TaskEnvironmentVariable(name='FRAME_INTERVAL', value= frame_interval)
-                ]
-            )],
+        # Environment variables of the main analyzer which are the same for all videos
+        main_analyzer_static_environment: dict[str, str] = {
+            'CONFIG_PARAMETER_NAME': configuration_parameters_ssm.parameter_name,
+            'DATABASE_NAME': database_name,
+            'VIDEO_TABLE_NAME': video_table_name,
+            'ENTITIES_TABLE_NAME': entities_table_name,
+            'CONTENT_TABLE_NAME': content_table_name,
+            'CONTENT_HASH_TABLE_NAME': content_hash_table_name,
+            'FINGERPRINT_TABLE_NAME': fingerprint_table_name,
+            'SECRET_NAME': self.db_secret_name,
+            "EMBEDDING_DIMENSION": str(embedding_dimension),
+            'DB_WRITER_ENDPOINT': self.db_writer_endpoint.hostname,
+            "EMBEDDING_MODEL_ID": embedding_model_id,
+            "MODEL_ID": model_id,
+            'VQA_MODEL_ID': vqa_model_id,
+            'VQA_FAST_MODEL_ID': vqa_fast_model_id,
+            'VQA_NOVELTY_THRESHOLD': vqa_novelty_threshold,
+            "BUCKET_NAME": video_bucket_s3.bucket_name,
+            "RAW_FOLDER": raw_folder,
+            "VIDEO_SCRIPT_FOLDER": video_script_folder,
+            "TRANSCRIPTION_FOLDER": transcription_folder,
+            "ENTITY_SENTIMENT_FOLDER": entity_sentiment_folder,
+            "SUMMARY_FOLDER": summary_folder,
+            "VIDEO_CAPTION_FOLDER": video_caption_folder,
+            "ANALYSIS_SHARD_FOLDER": analysis_shard_folder,
+            "FRAME_ANALYSIS_FOLDER": frame_analysis_folder,
+            "RUN_REPORT_FOLDER": run_report_folder,
+            "DOWNLOAD_CHUNK_SIZE_MB": download_chunk_size_mb,
+            "DOWNLOAD_CONCURRENCY": download_concurrency,
+            "FRAME_STORE_MEMORY_MB": frame_store_memory_mb,
+            "SAMPLING_MODE": sampling_mode,
+            "KEYFRAME_TOLERANCE_MILLIS": keyframe_tolerance_millis,
+            "REFINEMENT_COARSE_INTERVAL_MULTIPLE": refinement_coarse_interval_multiple,
+            "REFINEMENT_SCENE_DISTANCE": refinement_scene_distance,
+            "REFINEMENT_HASH_DISTANCE": refinement_hash_distance,
+            "FRAME_IMAGE_FORMAT": frame_image_format,
+            "FRAME_IMAGE_QUALITY": frame_image_quality,
+            "FRAME_IMAGE_MAX_BYTES": frame_image_max_bytes,
+            "FRAME_QUALITY_FILTER_ENABLED": frame_quality_filter_enabled,
+            "VQA_ADAPTIVE_RESOLUTION_ENABLED": vqa_adaptive_resolution_enabled,
+            "VQA_IMAGE_TOKEN_BUDGET": vqa_image_token_budget,
+            "FRAME_BUDGET_MAX_FRAMES": frame_budget_max_frames,
+            "FRAME_BUDGET_TARGET_SECONDS": frame_budget_target_seconds,
+            "FRAME_BUDGET_CONCURRENCY": frame_budget_concurrency,
+            "ANALYSIS_DEADLINE_SECONDS": analysis_deadline_seconds,
+            "ANALYSIS_DEADLINE_RESERVE_SECONDS": analysis_deadline_reserve_seconds,
+            "LABEL_AGGREGATE_BY": label_aggregate_by,
+            "PERSON_SEGMENT_MAX_GAP_MILLIS": person_segment_max_gap_millis,
+            "PERSON_FRAME_MIN_INTERVAL_MILLIS": person_frame_min_interval_millis,
+            "CELEBRITY_MOSAIC_TILES": celebrity_mosaic_tiles,
+            "FACE_TRACKING_ENABLED": face_tracking_enabled,
+            "UTTERANCE_MAX_PAUSE_MILLIS": utterance_max_pause_millis,
+            "TIMELINE_SIMILARITY_THRESHOLD": timeline_similarity_threshold,
+            "FINGERPRINT_ENABLED": fingerprint_enabled,
+            "FINGERPRINT_MATCH_THRESHOLD": fingerprint_match_threshold,
+            "FINGERPRINT_MAX_HAMMING_DISTANCE": fingerprint_max_hamming_distance,
+            'FRAME_INTERVAL': frame_interval
+        }
+
+        # Environment variables of the main analyzer which are specific to a video. The input_path points to the output of the parallel step, which is [label detection branch, transcription branch, celebrity recognition branch, face detection branch].
+        def main_analyzer_job_environment(input_path: str, additional_environment: dict[str, str] = {}) -> dict[str, str]:
+            return {
+                "VIDEO_S3_PATH": _sfn.JsonPath.string_at(f"{input_path}[0].videoS3Path"),
+                "LABEL_DETECTION_JOB_ID": _sfn.JsonPath.string_at(f"{input_path}[0].labelDetectionResult.JobId"),
+                "TRANSCRIPTION_JOB_NAME": _sfn.JsonPath.string_at(f"{input_path}[1].transcriptionResult.TranscriptionJobName"),
+                "CELEBRITY_RECOGNITION_JOB_ID": _sfn.JsonPath.string_at(f"{input_path}[2].celebrityRecognitionResult.JobId"),
+                "FACE_DETECTION_JOB_ID": _sfn.JsonPath.string_at(f"{input_path}[3].faceDetectionResult.JobId"),
+                CONFIG_LABEL_DETECTION_ENABLED: _sfn.JsonPath.string_at(f"{input_path}[0].preprocessingResult.Payload.body.{CONFIG_LABEL_DETECTION_ENABLED}"),
+                CONFIG_TRANSCRIPTION_ENABLED: _sfn.JsonPath.string_at(f"{input_path}[0].preprocessingResult.Payload.body.{CONFIG_TRANSCRIPTION_ENABLED}"),
+                CONFIG_SPEECH_DETECTION_ENABLED: _sfn.JsonPath.string_at(f"{input_path}[0].preprocessingResult.Payload.body.{CONFIG_SPEECH_DETECTION_ENABLED}"),
+                "CONTENT_HASH": _sfn.JsonPath.string_at(f"{input_path}[0].preprocessingResult.Payload.body.content_hash"),
+                "CONTENT_SIZE": _sfn.JsonPath.string_at(f"{input_path}[0].preprocessingResult.Payload.body.content_size"),
+                **additional_environment
+            }
+
+        # Queue of video jobs for the long-running analyzer workers, only used when analyzer_worker_count is more than 0
+        analyzer_job_dead_letter_queue = _sqs.Queue(self, "AnalyzerJobDeadLetterQueue",
+            encryption=_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            retention_period=Duration.days(14)
         )
-        # Chain the analysis step after the parallel step
-        parallel_sfn.next(main_analyzer_task)
+        NagSuppressions.add_resource_suppressions(analyzer_job_dead_letter_queue, [
+            { "id": 'AwsSolutions-SQS3', "reason": 'This queue is the dead letter queue itself'}
+        ], True)
+
+        analyzer_job_queue = _sqs.Queue(self, "AnalyzerJobQueue",
+            encryption=_sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            visibility_timeout=Duration.seconds(analyzer_job_heartbeat_seconds * 5), # Extended by the worker at every heartbeat, so that the job of a crashed worker is redelivered to another worker soon
+            dead_letter_queue=_sqs.DeadLetterQueue(max_receive_count=3, queue=analyzer_job_dead_letter_queue)
+        )
+
+        # Runs the main analyzer for one video, either as its own Fargate task or as a job for the long-running workers
+        def main_analyzer_invocation(id: str, input_path: str, additional_job_environment: dict[str, str] = {}):
+            job_environment = main_analyzer_job_environment(input_path, additional_job_environment)
+            if analyzer_worker_count > 0:
+                return _sfn_tasks.SqsSendMessage(self, id,
+                    queue=analyzer_job_queue,
+                    integration_pattern=_sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+                    # Longer than the redelivery of the job of a crashed worker, so that another worker can take it over with the same task token
+                    heartbeat_timeout=_sfn.Timeout.duration(Duration.seconds(analyzer_job_heartbeat_seconds * 15)),
+                    task_timeout=_sfn.Timeout.duration(Duration.hours(analyzer_job_timeout_hours)),
+                    message_body=_sfn.TaskInput.from_object({
+                        "taskToken": _sfn.JsonPath.task_token,
+                        "job": job_environment
+                    })
+                )
+
+            return _sfn_tasks.EcsRunTask(self, id,
+                integration_pattern=_sfn.IntegrationPattern.RUN_JOB,
+                cluster=ecs_cluster,
+                task_definition=analyzer_task_definition,
+                assign_public_ip=True,
+                launch_target=_sfn_tasks.EcsFargateLaunchTarget(
+                    platform_version=_ecs.FargatePlatformVersion.VERSION1_4
+                ),
+                subnets=private_with_egress_subnets,
+                container_overrides=[_sfn_tasks.ContainerOverride(
+                    container_definition=analyzer_container_definition,
+                    environment=[_sfn_tasks.TaskEnvironmentVariable(name=name, value=value) for name, value in {**main_analyzer_static_environment, **job_environment}.items()]
+                )],
+            )
+
+        main_analyzer_task = main_analyzer_invocation("CallMainAnalyzer", "$")
+
+        # Map-reduce analysis for long videos. Each shard task preprocesses one time range of the video, then the reduce task merges the shard results and runs the video analysis.
+        main_analyzer_shard_task = main_analyzer_invocation("CallMainAnalyzerShard", "$.analysisInput", {
+            "ANALYZER_MODE": "shard",
+            "SHARD_INDEX": _sfn.JsonPath.string_at("$.shardIndex"),
+            "SHARD_COUNT": _sfn.JsonPath.string_at(f"$.analysisInput[0].preprocessingResult.Payload.body.{CONFIG_ANALYSIS_SHARD_COUNT}")
+        })
+
+        main_analyzer_shards_map = _sfn.Map(self, "MainAnalyzerShardsMap",
+            items_path=f"$[0].preprocessingResult.Payload.body.analysis_shards",
+            item_selector={
+                "shardIndex.$": "$$.Map.Item.Value",
+                "analysisInput.$": "$"
+            },
+            result_path=_sfn.JsonPath.DISCARD
+        )
+        main_analyzer_shards_map.item_processor(main_analyzer_shard_task)
+
+        main_analyzer_reduce_task = main_analyzer_invocation("CallMainAnalyzerReduce", "$", {
+            "ANALYZER_MODE": "reduce",
+            "SHARD_COUNT": _sfn.JsonPath.string_at(f"$[0].preprocessingResult.Payload.body.{CONFIG_ANALYSIS_SHARD_COUNT}")
+        })
+        main_analyzer_shards_map.next(main_analyzer_reduce_task)
+
+        # Chain the analysis step after the parallel step. Sharded analysis is only used when configured with more than 1 shard.
+        analysis_sharding_choice = _sfn.Choice(self, "AnalysisShardingChoice")
+        analysis_sharding_choice.when(_sfn.Condition.string_equals(f"$[0].preprocessingResult.Payload.body.{CONFIG_ANALYSIS_SHARD_COUNT}", "1"), main_analyzer_task).otherwise(main_analyzer_shards_map)
+        parallel_sfn.next(analysis_sharding_choice)
+
+        # Long-running analyzer workers, which keep clients, database connections, prompt templates and decode processes warm across videos
+        if analyzer_worker_count > 0:
+            analyzer_job_queue.grant_consume_messages(main_analyzer_role)
+            main_analyzer_role.add_to_policy(_iam.PolicyStatement(
+                actions=["states:SendTaskSuccess", "states:SendTaskFailure", "states:SendTaskHeartbeat"],
+                resources=["*"],
+                effect=_iam.Effect.ALLOW,
+            ))
+
+            analyzer_worker_task_definition = _ecs.FargateTaskDefinition(self, "WorkerTaskDefinition",
+                cpu=4096,
+                memory_limit_mib=8192,
+                task_role= main_analyzer_role,
+                execution_role= main_analyzer_execution_role
+            )
+
+            analyzer_worker_task_definition.add_container("analyzer-worker",
+                image=_ecs.ContainerImage.from_docker_image_asset(
+                    DockerImageAsset(self, "AnalyzerWorkerImageBuild",
+                        directory=f"{BASE_DIR}/lib/main_analyzer/"
+                    ),
+                ),
+                memory_limit_mib=8192,
+                environment={
+                    **main_analyzer_static_environment,
+                    "ANALYZER_MODE": "worker",
+                    "JOB_QUEUE_URL": analyzer_job_queue.queue_url,
+                    "WORKER_CONCURRENCY": analyzer_worker_concurrency,
+                    "JOB_HEARTBEAT_SECONDS": str(analyzer_job_heartbeat_seconds),
+                    "JOB_VISIBILITY_TIMEOUT_SECONDS": str(analyzer_job_heartbeat_seconds * 5)
+                },
+                logging=_ecs.LogDrivers.aws_logs(
+                    log_group=main_analyzer_log_group,
+                    stream_prefix="worker",
+                    mode=_ecs.AwsLogDriverMode.NON_BLOCKING,
+                    max_buffer_size=Size.mebibytes(25)
+                )
+            )
+
+            NagSuppressions.add_resource_suppressions(analyzer_worker_task_definition, [
+                { "id": 'AwsSolutions-ECS2', "reason": 'The environment variables are non-secret configuration. The database credentials are read from Secrets Manager at runtime.'}
+            ], True)
+
+            _ecs.FargateService(self, "AnalyzerWorkerService",
+                cluster=ecs_cluster,
+                task_definition=analyzer_worker_task_definition,
+                desired_count=analyzer_worker_count,
+                platform_version=_ecs.FargatePlatformVersion.VERSION1_4,
+                vpc_subnets=private_with_egress_subnets
+            )
 
         # CloudWatch Log Group for the Step Functions
         sfn_log_group = _logs.LogGroup(self, "SFNLogGroup")
@@ -824,6 +1165,7 @@ class VideoUnderstandingSolutionStack(Stack):
             self,
             "StartVideoAnalysisSfn",
             definition_body=_sfn.DefinitionBody.from_chainable(preprocessing_task),
+            timeout=Duration.hours(video_analysis_timeout_hours),
             logs=_sfn.LogOptions(
                 destination=sfn_log_group,
                 level=_sfn.LogLevel.ALL
@@ -298,7 +298,7 @@ export class VideoTable extends Component {
     prompt += "Below is the <timeline> with information about the voice heard in the video, visual scenes seen, visual text visible, and any face or celebrity visible.\n"
     prompt += "For voice, the same speaker number ALWAYS indicates the same person throughout the video.\n"
     prompt += "For faces, while the estimated age may differ across timestamp, if they are very close, they can refer to the same person.\n"
-    prompt += "The numbers on the left represents the seconds into the video where the information was extracted.\n"
+    prompt += "The numbers on the left represent the seconds into the video where the information was extracted, or start-end for the seconds over which it stays the same.\n"
     prompt += `<timeline>\n${video.videoScript}</timeline>\n\n`
     prompt += "Now your job is to find the part of the video based on the <question>.\n"
     prompt += "The answer MUST be expressed as the start and stop second of the relevant part.\n"
@@ -349,7 +349,7 @@ export class VideoTable extends Component {
     videoScriptPrompt += "Below is the video timeline with information about the voice heard in the video, visual scenes seen, visual text visible, and any face or celebrity visible.\n"
     videoScriptPrompt += "For voice, the same speaker number ALWAYS indicates the same person throughout the video.\n"
     videoScriptPrompt += "For faces, while the estimated age may differ across timestamp, if they are very close, they can refer to the same person.\n"
-    videoScriptPrompt += "The numbers on the left represents the seconds into the video where the information was extracted.\n"
+    videoScriptPrompt += "The numbers on the left represent the seconds into the video where the information was extracted, or start-end for the seconds over which it stays the same.\n"
     videoScriptPrompt += `<VideoTimeline>\n${video.videoScript}</VideoTimeline>\n\n`
 
     // If the chat history is not too long, then include the whole history in the prompt
@@ -415,7 +415,7 @@ export class VideoTable extends Component {
       videoScriptPrompt += "The video timeline has information about the voice heard in the video, visual scenes seen, visual texts visible, and any face or celebrity visible.\n"
       videoScriptPrompt += "For voice, the same speaker number ALWAYS indicates the same person throughout the video.\n"
       videoScriptPrompt += "For faces, while the estimated age may differ across timestamp, if they are very close, they can refer to the same person.\n"
-      videoScriptPrompt += "The numbers on the left represents the seconds into the video where the information was extracted.\n"
+      videoScriptPrompt += "The numbers on the left represent the seconds into the video where the information was extracted, or start-end for the seconds over which it stays the same.\n"
       videoScriptPrompt += `Because the video is long, the video timeline is split into ${numberOfFragments} parts. `
       if (currentFragment == numberOfFragments){
         videoScriptPrompt += "Below is the last part of the video timeline.\n"